@@ -0,0 +1,20 @@
+"""
+Launcher script to start a worker for a distributed PASTIS matrix calculation. Start as many of these as you like, on
+any machine that sees the queue directory on a shared file system:
+    python pastis/launchers/run_queue_worker.py /path/to/data/<run>/matrix_numerical/task_queue
+The queue directory is created by PastisMatrixIntensities.calc(distributed=True) or
+PastisMatrixEfields.calc(distributed=True). Each worker exits once all tasks in the queue are finished.
+"""
+import os
+import sys
+
+from pastis.matrix_generation.task_queue import run_queue_worker
+import pastis.util as util
+
+
+if __name__ == '__main__':
+
+    QUEUE_DIR = sys.argv[1]
+
+    util.setup_pastis_logging(os.path.dirname(QUEUE_DIR), f'queue_worker_{os.uname().nodename}_{os.getpid()}')
+    run_queue_worker(QUEUE_DIR)
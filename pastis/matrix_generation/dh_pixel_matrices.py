@@ -0,0 +1,120 @@
+"""
+Calculate contrast and PASTIS matrices for any part of the dark hole from the dark hole pixels stored by a matrix run.
+
+An intensity matrix run with savepsfs='dh' keeps the dark hole pixels of every pair PSF as float32 vectors in the cube
+"psfs/dh_pixel_cube.npy" of its result folder. The mean contrast of a pair in a sub-mask of the dark hole, like a
+smaller zone or a radial annulus, is then just an average over some of the stored pixels, and no propagation through
+the simulator is needed to get the matrices of that sub-mask.
+"""
+
+import logging
+import os
+import hcipy
+import numpy as np
+
+from pastis.matrix_generation.matrix_building_numerical import DH_PIXEL_CUBE_NAME, pastis_from_contrast_matrix
+import pastis.util as util
+
+log = logging.getLogger()
+
+
+def read_dh_pixel_cube(resDir):
+    """
+    Open the dark hole pixel cube of a matrix run, together with the dark hole mask it was taken with.
+    :param resDir: str, "matrix_numerical" result folder of a run with savepsfs='dh'
+    :return: the cube as read-only memmap with one row of dark hole pixels per pair, its index table (see
+             util.read_frame_cube()), the 2D boolean dark hole mask, and the dark hole pixels of the unaberrated
+             coronagraphic PSF
+    """
+    cube_path = os.path.join(resDir, 'psfs', DH_PIXEL_CUBE_NAME)
+    cube, index = util.read_frame_cube(cube_path)
+    dh_mask = np.load(os.path.splitext(cube_path)[0] + '_mask.npy')
+    reference = np.load(os.path.splitext(cube_path)[0] + '_reference.npy')
+    return cube, index, dh_mask, reference
+
+
+def annulus_mask(shape, inner_radius, outer_radius, center=None):
+    """
+    Create a mask of the pixels whose centers lie within a radial annulus, e.g. to pick a radial bin of the dark hole.
+    :param shape: tuple, shape of the PSF frames
+    :param inner_radius: float, inner radius of the annulus in pixels, included; multiply by the sampling for lambda/D
+    :param outer_radius: float, outer radius of the annulus in pixels, excluded
+    :param center: tuple of floats, (y, x) pixel coordinates of the center; the center of the frame if None
+    :return: 2D boolean ndarray
+    """
+    if center is None:
+        center = ((shape[0] - 1) / 2, (shape[1] - 1) / 2)
+    y, x = np.indices(shape)
+    radius = np.hypot(y - center[0], x - center[1])
+    return (radius >= inner_radius) & (radius < outer_radius)
+
+
+def contrast_matrix_from_dh_pixels(resDir, sub_mask, frames_per_block=1024):
+    """
+    Calculate the contrast matrix of a matrix run for a sub-mask of its dark hole, from the stored dark hole pixels.
+    :param resDir: str, "matrix_numerical" result folder of a run with savepsfs='dh'
+    :param sub_mask: 2D boolean array of the shape of the PSF frames, pixels to average over; it has to lie within the
+                     dark hole of the run
+    :param frames_per_block: int, number of pairs to read from the cube at once
+    :return: the contrast matrix, half filled like PastisMatrixIntensities.contrast_matrix, and the coronagraph floor
+             in the sub-mask
+    """
+    cube, index, dh_mask, reference = read_dh_pixel_cube(resDir)
+    sub_mask = np.asarray(sub_mask, dtype=bool)
+    if sub_mask.shape != dh_mask.shape:
+        raise ValueError(f'The sub-mask has shape {sub_mask.shape}, but the PSF frames have shape {dh_mask.shape}.')
+    if np.any(sub_mask & ~dh_mask):
+        raise ValueError('The sub-mask contains pixels outside of the dark hole, which were not stored.')
+    selection = sub_mask[dh_mask]
+    if not np.any(selection):
+        raise ValueError('The sub-mask does not contain any pixels.')
+    log.info(f'Averaging {np.count_nonzero(selection)} of {selection.size} dark hole pixels')
+
+    # Average in double precision, the cube is read in blocks to limit the memory use
+    contrasts = np.empty(cube.shape[0])
+    for start in range(0, cube.shape[0], frames_per_block):
+        block = np.asarray(cube[start:start + frames_per_block])
+        contrasts[start:start + frames_per_block] = np.mean(block[:, selection], axis=1, dtype=np.float64)
+
+    nb_seg = util.nseg_from_measurements(cube.shape[0])
+    contrast_matrix = np.zeros([nb_seg, nb_seg])
+    contrast_matrix[index[:, 1], index[:, 2]] = contrasts[index[:, 0]]
+    coro_floor = np.mean(reference[selection])
+    return contrast_matrix, coro_floor
+
+
+def pastis_matrix_from_dh_pixels(resDir, sub_mask, wfe_aber, seglist=None):
+    """
+    Calculate the contrast and PASTIS matrices of a matrix run for a sub-mask of its dark hole.
+    :param resDir: str, "matrix_numerical" result folder of a run with savepsfs='dh'
+    :param sub_mask: 2D boolean array of the shape of the PSF frames, pixels to average over, within the dark hole
+    :param wfe_aber: float, calibration aberration of the run in m
+    :param seglist: list of segment indices; 0 to nb_seg-1 if None
+    :return: the contrast matrix (half filled, floor not subtracted), and the PASTIS matrix in contrast per nm^2
+    """
+    contrast_matrix, coro_floor = contrast_matrix_from_dh_pixels(resDir, sub_mask)
+    if seglist is None:
+        seglist = np.arange(contrast_matrix.shape[0])
+    matrix_pastis = pastis_from_contrast_matrix(contrast_matrix.copy(), seglist, wfe_aber, coro_floor)
+    return contrast_matrix, matrix_pastis
+
+
+def save_dh_zone_matrices(resDir, sub_mask, wfe_aber, zone_name, seglist=None):
+    """
+    Calculate the contrast and PASTIS matrices for a sub-mask of the dark hole and save them into the result folder.
+
+    The files are "contrast_matrix_<zone_name>.fits", "pastis_matrix_<zone_name>.fits" and the sub-mask itself,
+    "dh_zone_<zone_name>_mask.npy".
+    :param resDir: str, "matrix_numerical" result folder of a run with savepsfs='dh'
+    :param sub_mask: 2D boolean array of the shape of the PSF frames, pixels to average over, within the dark hole
+    :param wfe_aber: float, calibration aberration of the run in m
+    :param zone_name: str, name of the zone for the file names
+    :param seglist: list of segment indices; 0 to nb_seg-1 if None
+    :return: the contrast matrix and the PASTIS matrix
+    """
+    contrast_matrix, matrix_pastis = pastis_matrix_from_dh_pixels(resDir, sub_mask, wfe_aber, seglist)
+    hcipy.write_fits(contrast_matrix, os.path.join(resDir, f'contrast_matrix_{zone_name}.fits'))
+    hcipy.write_fits(matrix_pastis, os.path.join(resDir, f'pastis_matrix_{zone_name}.fits'))
+    np.save(os.path.join(resDir, f'dh_zone_{zone_name}_mask.npy'), np.asarray(sub_mask, dtype=bool))
+    log.info(f'Matrices of dark hole zone "{zone_name}" saved to {resDir}')
+    return contrast_matrix, matrix_pastis
@@ -11,6 +11,7 @@ and saves it.
 """
 
 import os
+import re
 import time
 import functools
 import shutil
@@ -18,15 +19,14 @@ import logging
 import matplotlib
 import matplotlib.pyplot as plt
 import multiprocessing
-try:    # kinda forgot why I added this try: ... except: ...
-    multiprocessing.set_start_method('spawn')
-except RuntimeError:
-    pass
 import numpy as np
+import scipy.sparse
 import hcipy
 
 from pastis.config import CONFIG_PASTIS
 import pastis.util as util
+from pastis.matrix_generation import matrix_completion, pair_symmetry
+from pastis.matrix_generation.task_queue import FileTaskQueue, wait_for_queue
 from pastis.simulators.hicat_imaging import set_up_hicat
 from pastis.simulators.luvoir_imaging import LuvoirAPLC
 import pastis.simulators.webbpsf_imaging as webbpsf_imaging
@@ -36,6 +36,17 @@ log = logging.getLogger()
 matplotlib.rc('image', origin='lower')
 matplotlib.rc('pdf', fonttype=42)
 
+PROCESS_SPLIT_NAME = 'process_split.txt'
+PSF_CUBE_NAME = 'psf_cube.npy'
+DH_PIXEL_CUBE_NAME = 'dh_pixel_cube.npy'
+OPD_CUBE_NAME = 'opd_cube.npy'
+
+# Simulator instances of the current process, keyed by (instrument, design). The worker processes of the matrix pools
+# fill this once through the pool initializer and then reuse their simulator for all the pairs they calculate.
+_SIMULATOR_CACHE = {}
+# Dark hole masks of the dark hole pixel cubes that the current process writes into, see save_pair_psf()
+_DH_PIXEL_MASKS = {}
+
 
 class PastisMatrix:
     """ Main class for PASTIS matrix generation.
@@ -46,7 +57,7 @@ class PastisMatrix:
 
     instrument = None
 
-    def __init__(self, nb_seg, seglist, save_path=''):
+    def __init__(self, nb_seg, seglist, save_path='', resume_dir=None):
         """
         Parameters:
         ----------
@@ -56,6 +67,9 @@ class PastisMatrix:
             List of all segment indices, as given in the indexed aperture file.
         save_path : string
             Path to top-level directory where result folder should be saved to.
+        resume_dir : string or None
+            Path to the result folder of an earlier, interrupted run that should be continued. If None (default), a new
+            result folder is created in save_path.
         """
 
         # General telescope parameters
@@ -66,7 +80,11 @@ class PastisMatrix:
 
         # Create directory names
         tel_name = f'{self.instrument.lower()}'
-        self.overall_dir = util.create_data_path(save_path, telescope=tel_name)
+        if resume_dir is None:
+            # A folder of its own, even if another run started within the same second
+            self.overall_dir = util.create_unique_data_path(save_path, telescope=tel_name)
+        else:
+            self.overall_dir = resume_dir
         os.makedirs(self.overall_dir, exist_ok=True)
         self.resDir = os.path.join(self.overall_dir, 'matrix_numerical')
 
@@ -77,6 +95,8 @@ class PastisMatrix:
         # Set up logger
         util.setup_pastis_logging(self.resDir, f'pastis_matrix_{tel_name}')
         log.info(f'Building numerical matrix for {tel_name}\n')
+        if resume_dir is not None:
+            log.info(f'Resuming run in {self.overall_dir}')
 
         # Record some of the defined parameters
         log.info(f'Instrument: {tel_name}')
@@ -88,19 +108,41 @@ class PastisMatrix:
         # Copy configfile to resulting matrix directory
         util.copy_config(self.resDir)
 
+        # Version of the matrix files written by an incremental update, None for the original run
+        self.matrix_version = None
+
     def calc(self):
         """ This is the main method that should be called to calculate a PASTIS matrix. """
         raise NotImplementedError()
 
+    def versioned_name(self, name):
+        """ Append the matrix version to a result file name, if this is an incremental update. """
+        return name if self.matrix_version is None else f'{name}_v{self.matrix_version}'
+
+    def next_matrix_version(self):
+        """ Version number for the next incremental update, one higher than the highest finished PASTIS matrix version in
+        the result folder. The matrix of the original run counts as version 1. """
+        versions = [int(match.group(1)) for match in (re.fullmatch(r'pastis_matrix_v(\d+)\.fits', fname)
+                                                      for fname in os.listdir(self.resDir)) if match]
+        return max(versions, default=1) + 1
+
+    def record_matrix_version(self, segments):
+        """ Append the current matrix version and the segments that were updated for it to "matrix_versions.txt". """
+        with open(os.path.join(self.resDir, 'matrix_versions.txt'), 'a') as version_file:
+            version_file.write(f'v{self.matrix_version} {time.strftime("%Y-%m-%dT%H-%M-%S")} updated segments: '
+                               f'{" ".join(str(segment) for segment in sorted(segments))}\n')
+
 
 class PastisMatrixIntensities(PastisMatrix):
     """ Main class for PASTIS matrix calculations from pair-wise intensities.
 
-    Contrast matrix calculation is multiprocessed.
+    Contrast matrix calculation is multiprocessed. Every finished pair is appended to a journal file in the result
+    folder, so that a run that was interrupted can be resumed by passing its result folder as "resume_dir"; only the
+    pairs missing from the journal will then be calculated.
     """
     instrument = None
 
-    def __init__(self, nb_seg, seglist, initial_path='', savepsfs=True, saveopds=True):
+    def __init__(self, nb_seg, seglist, initial_path='', savepsfs=True, saveopds=True, resume_dir=None):
         """
         Parameters:
         ----------
@@ -108,29 +150,79 @@ class PastisMatrixIntensities(PastisMatrix):
             Number of segments in the segmented aperture.
         initial_path: string
             Path to top-level directory where result folder should be saved to.
-        savepsfs: bool
-            Whether to save pair-wise aberrated PSFs as fits file to disk or not
+        savepsfs: bool or str
+            Whether to save pair-wise aberrated PSFs to disk or not. True writes one fits file per pair, 'cube' writes
+            all of them into the memory-mappable cube "psfs/psf_cube.npy", with the frames in the order of
+            util.segment_pairs_non_repeating() and an index table "psfs/psf_cube_index.txt". 'shared' creates the same
+            cube, but the workers write the PSFs into a shared memory block that is written to disk once at the end of
+            calculate_contrast_matrix(); this needs enough memory for all pair PSFs and cannot be used with the task
+            queue. 'dh' only keeps the pixels inside the dark hole, as float32 vectors in the cube
+            "psfs/dh_pixel_cube.npy", from which matrices for any part of the dark hole can be calculated later with
+            pastis.matrix_generation.dh_pixel_matrices.
         saveopds: bool
             Whether to save images of pair-wise aberrated pupils to disk or not
+        resume_dir : string or None
+            Path to the result folder of an interrupted run to resume. If None (default), start a new run.
         """
-        super().__init__(nb_seg=nb_seg, seglist=seglist, save_path=initial_path)
+        super().__init__(nb_seg=nb_seg, seglist=seglist, save_path=initial_path, resume_dir=resume_dir)
         self.savepsfs = savepsfs
         self.saveopds = saveopds
         self.calculate_matrix_pair = None
+        self.design = None
+        self.journal_path = os.path.join(self.resDir, 'contrast_journal.txt')
+        self.resuming = resume_dir is not None
+        self.skipped_pairs = []
+        self.symmetry_verified = None
 
         os.makedirs(os.path.join(self.resDir, 'psfs'), exist_ok=True)
         log.info(f'Total number of actuator pairs in {self.instrument} pupil: {len(list(util.segment_pairs_all(self.nb_seg)))}')
         log.info(
             f'Non-repeating pairs in {self.instrument} pupil calculated here: {len(list(util.segment_pairs_non_repeating(self.nb_seg)))}')
 
-    def calc(self):
-        """ Main method that calculates the PASTIS matrix """
+    def calc(self, distributed=False, separation_cutoff=None, num_error_samples=None, use_symmetry=False,
+             measured_fraction=None, pair_selection='random'):
+        """ Main method that calculates the PASTIS matrix
+
+        Parameters:
+        ----------
+        distributed : bool
+            If True, distribute the pairs through a task queue in the result folder to workers started on any number
+            of machines, see calculate_contrast_matrix(). If False (default), use a multiprocessing pool on this machine.
+        separation_cutoff : float or None
+            If given, only calculate the pairs of segments whose centers are at most this far apart, in the units of
+            segment_positions() (m for LUVOIR-A), and treat the PASTIS matrix elements of all other pairs as zero, see
+            calculate_contrast_matrix_with_cutoff(). If None (default), calculate all pairs.
+        num_error_samples : int or None
+            Number of randomly chosen pairs beyond separation_cutoff that get calculated anyway, to estimate the error
+            of leaving them out. If None, read from the configfile.
+        use_symmetry : bool
+            If True, only calculate one pair out of each class of pairs that are equivalent under the rotation and
+            reflection symmetries of the aperture and coronagraph, see calculate_contrast_matrix_with_symmetry().
+        measured_fraction : float or None
+            If given, only calculate this fraction of the off-axis segment pairs and fill in the others by low-rank
+            matrix completion, see calculate_contrast_matrix_with_completion(). If None (default), calculate all pairs.
+        pair_selection : str
+            Which off-axis pairs to calculate for the matrix completion: 'random', or 'baseline' for the pairs with the
+            closest segment centers.
+        Only one of separation_cutoff, use_symmetry and measured_fraction can be used at a time.
+        """
+        if sum([separation_cutoff is not None, use_symmetry, measured_fraction is not None]) > 1:
+            raise ValueError('Only one of separation_cutoff, use_symmetry and measured_fraction can be used at a time.')
         start_time = time.time()
 
         # Calculate coronagraph floor, and normalization factor from direct image
         self.calculate_ref_image()
         self.setup_one_pair_function()
-        self.calculate_contrast_matrix()
+        if use_symmetry:
+            self.calculate_contrast_matrix_with_symmetry(distributed=distributed)
+        elif measured_fraction is not None:
+            self.calculate_contrast_matrix_with_completion(measured_fraction, pair_selection=pair_selection,
+                                                           distributed=distributed)
+        elif separation_cutoff is not None:
+            self.calculate_contrast_matrix_with_cutoff(separation_cutoff, num_error_samples=num_error_samples,
+                                                       distributed=distributed)
+        else:
+            self.calculate_contrast_matrix(distributed=distributed)
         self.calculate_pastis_from_contrast_matrix()
 
         end_time = time.time()
@@ -138,59 +230,453 @@ class PastisMatrixIntensities(PastisMatrix):
             f'Runtime for {self.__class__.__name__}.calc(): {end_time - start_time}sec = {(end_time - start_time) / 60}min')
         log.info(f'Data saved to {self.resDir}')
 
-    def calculate_contrast_matrix(self):
+    def update_segments(self, segments, distributed=False):
+        """ Recalculate only the pairs that involve some segments, after their model changed, on top of a finished run.
+
+        This object needs to have been created with the result folder of a finished run as "resume_dir". The reference
+        images are calculated again with the current model, and all pairs that contain one of the given segments are
+        recalculated; the contrasts of all other pairs are taken from "contrast_matrix.fits" of the original run. They
+        are shifted by the change of the coronagraph floor, which leaves their PASTIS matrix elements unchanged. The
+        result is written as a new matrix version next to the original one, e.g. "contrast_matrix_v2.fits" and
+        "pastis_matrix_v2.fits", and the updated segments are recorded in "matrix_versions.txt".
+        Each update starts from the original run; to combine several changes, pass all of their segments at once. No
+        PSFs, OPDs or reference images are saved, so that the products of the original run stay untouched. An update that
+        got interrupted is resumed from its own journal file when this is called again.
+
+        Parameters:
+        ----------
+        segments : iterable of int
+            Matrix indices of the segments whose model changed, 0-indexed like the segment pairs.
+        distributed : bool
+            Whether to use the file system task queue instead of a local multiprocessing pool.
+        """
+        original_contrast_path = os.path.join(self.resDir, 'contrast_matrix.fits')
+        if not os.path.isfile(original_contrast_path):
+            raise FileNotFoundError(f'No contrast matrix in {self.resDir}; update_segments() needs the result folder of '
+                                    f'a finished run as "resume_dir".')
+        original_contrast_matrix = hcipy.read_fits(original_contrast_path)
+        original_floor_path = os.path.join(self.overall_dir, 'coronagraph_floor.txt')
+        original_floor = util.read_coro_floor_from_txt(self.overall_dir) if os.path.isfile(original_floor_path) else None
+
+        segments = {int(segment) for segment in segments}
+        self.matrix_version = self.next_matrix_version()
+        self.journal_path = os.path.join(self.resDir, self.versioned_name('contrast_journal') + '.txt')
+        self.savepsfs = False
+        self.saveopds = False
+        log.info(f'Updating segments {sorted(segments)} as matrix version {self.matrix_version}')
+
+        self.calculate_ref_image(save_coro_floor=False, save_psfs=False)
+        if original_floor is None:
+            log.warning(f'No coronagraph floor of the original run in {self.overall_dir}, assuming it did not change')
+            original_floor = float(self.contrast_floor)
+        self.setup_one_pair_function()
+
+        all_pairs = list(util.segment_pairs_non_repeating(self.nb_seg))
+        updated_pairs = [pair for pair in all_pairs if pair[0] in segments or pair[1] in segments]
+        self.calculate_contrast_matrix(distributed=distributed, pairs=updated_pairs)
+
+        floor_change = float(self.contrast_floor) - original_floor
+        updated = set(updated_pairs)
+        for pair in all_pairs:
+            if pair not in updated:
+                self.contrast_matrix[pair[0], pair[1]] = original_contrast_matrix[pair[0], pair[1]] + floor_change
+        self.save_contrast_matrix()
+        self.calculate_pastis_from_contrast_matrix()
+        self.record_matrix_version(segments)
+
+    def calculate_contrast_matrix(self, distributed=False, pairs=None):
         """ Calculate the contrast matrix.
 
         Uses the class attribute "self.calculate_matrix_pair", which needs to be a partial function, to calculate the
-        PSFs of all pair-wise aberrated segments in the pupil. This is using multiprocessing. The contrast matrix will
-        be saved to disk as fits file and as a PDF image.
+        PSFs of all pair-wise aberrated segments in the pupil. This is using multiprocessing on this machine, or a task
+        queue on the shared file system if "distributed" is True. In the latter case, the pairs are put into the
+        directory "task_queue" in the result folder and this method waits until they are all done; the work is done by
+        workers that need to be started separately, on any machine that sees the result folder, with:
+            python pastis/launchers/run_queue_worker.py <resDir>/task_queue
+        When resuming a run, pairs that are already recorded in the journal file are read from there instead of being
+        recalculated; a new run starts a new journal. Each newly calculated pair gets appended to the journal as soon as
+        it is collected. The contrast matrix will be
+        saved to disk as fits file and as a PDF image.
+
+        Parameters:
+        ----------
+        distributed : bool
+            Whether to use the file system task queue instead of a local multiprocessing pool.
+        pairs : list of tuples or None
+            Segment pairs to calculate; all non-repeating pairs if None (default). Matrix entries of the other pairs are
+            left at zero, unless they are in the journal.
         """
+        if pairs is None:
+            pairs = list(util.segment_pairs_non_repeating(self.nb_seg))
 
-        # Figure out how many processes is optimal and create a Pool.
-        # Assume we're the only one on the machine so we can hog all the resources.
-        # We expect numpy to use multithreaded math via the Intel MKL library, so
-        # we check how many threads MKL will use, and create enough processes so
-        # as to use 100% of the CPU cores.
-        # You might think we should divide number of cores by 2 to get physical cores
-        # to account for hyperthreading, however empirical testing on telserv3 shows that
-        # it is slightly more performant on telserv3 to use all logical cores
-        num_cpu = multiprocessing.cpu_count()
-        # try:
-        #     import mkl
-        #     num_core_per_process = mkl.get_max_threads()
-        # except ImportError:
-        #     # typically this is 4, so use that as default
-        #     log.info("Couldn't import MKL; guessing default value of 4 cores per process")
-        #     num_core_per_process = 4
-
-        num_core_per_process = 1  # NOTE: this was changed by Scott Will in HiCAT and makes more sense, somehow
-        num_processes = int(num_cpu // num_core_per_process)
-        log.info(
-            f"Multiprocess PASTIS matrix for {self.instrument} will use {num_processes} processes (with {num_core_per_process} threads per process)")
+        # Fill in the pairs that have been calculated already in an earlier run, when resuming it
+        self.contrast_matrix = np.zeros([self.nb_seg, self.nb_seg])  # Generate empty matrix
+        if self.resuming:
+            finished_pairs = read_contrast_journal(self.journal_path)
+        else:
+            finished_pairs = {}
+            open(self.journal_path, 'w').close()
+        for pair, contrast in finished_pairs.items():
+            self.contrast_matrix[pair[0], pair[1]] = contrast
+        missing_pairs = [pair for pair in pairs if pair not in finished_pairs]
+        log.info(f'{len(finished_pairs)} pairs read from {self.journal_path}, {len(missing_pairs)} pairs left to calculate')
+
+        # Preallocate the cube for the pupil surface maps of all pairs, if the instrument stores them in one
+        if self.saveopds and not os.path.isfile(os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME)):
+            self.create_opd_cube()
+
+        # Preallocate the cube that all pair PSFs get written into, unless it exists from an earlier run already
+        psf_cube_path = os.path.join(self.resDir, 'psfs', PSF_CUBE_NAME)
+        if self.savepsfs == 'cube' and not os.path.isfile(psf_cube_path):
+            util.create_frame_cube(psf_cube_path, list(util.segment_pairs_non_repeating(self.nb_seg)),
+                                   self.reference_images['coro_psf'].shape)
+            log.info(f'Writing pair PSFs into {psf_cube_path}')
+        elif self.savepsfs == 'dh' and not os.path.isfile(os.path.join(self.resDir, 'psfs', DH_PIXEL_CUBE_NAME)):
+            self.create_dh_pixel_cube()
+        elif self.savepsfs == 'shared':
+            if distributed:
+                raise ValueError("savepsfs='shared' needs the local multiprocessing pool, use 'cube' with the task queue.")
+            self.create_shared_psf_cube(psf_cube_path)
 
-        # Iterate over all segment pairs via a multiprocess pool
-        mypool = multiprocessing.Pool(num_processes)
         t_start = time.time()
-        results = mypool.map(self.calculate_matrix_pair,
-                             util.segment_pairs_non_repeating(self.nb_seg))  # this util function returns a generator
+        if distributed:
+            results = self._calculate_pairs_in_task_queue(missing_pairs)
+        else:
+            results = self._calculate_pairs_in_pool(missing_pairs)
+
+        # Each result is a tuple that contains the return from the partial function, in this case: (c, (seg1, seg2))
+        try:
+            with open(self.journal_path, 'a') as journal:
+                for contrast, pair in results:
+                    # Fill according entry in the contrast matrix and record it in the journal
+                    self.contrast_matrix[pair[0], pair[1]] = contrast
+                    journal.write(f'{pair[0]} {pair[1]} {float(contrast)!r}\n')
+                    journal.flush()
+            if self.savepsfs == 'shared':
+                self.save_shared_psf_cube(psf_cube_path)
+        finally:
+            if self.savepsfs == 'shared':
+                util.release_shared_array(util.shared_array_name(psf_cube_path))
         t_stop = time.time()
 
         log.info(f"Multiprocess calculation complete in {t_stop - t_start}sec = {(t_stop - t_start) / 60}min")
+        self.save_contrast_matrix()
 
-        # Unscramble results
-        # results is a list of tuples that contain the return from the partial function, in this case: result[i] = (c, (seg1, seg2))
-        self.contrast_matrix = np.zeros([self.nb_seg, self.nb_seg])  # Generate empty matrix
-        for i in range(len(results)):
-            # Fill according entry in the contrast matrix
-            self.contrast_matrix[results[i][1][0], results[i][1][1]] = results[i][0]
-        mypool.close()
+    def create_shared_psf_cube(self, psf_cube_path):
+        """ Allocate the shared memory block that the workers write the pair PSFs into, for savepsfs='shared'.
+
+        The PSFs of an earlier run that are in the cube on disk already are copied into it, so that they are kept when
+        the cube gets written again by save_shared_psf_cube().
+
+        Parameters:
+        ----------
+        psf_cube_path : string
+            Path of the PSF cube on disk; the name of the shared memory block is derived from it, see save_pair_psf().
+        """
+        cube_shape = (util.pastis_matrix_measurements(self.nb_seg),) + self.reference_images['coro_psf'].shape
+        shared_cube = util.create_shared_array(util.shared_array_name(psf_cube_path), cube_shape)
+        if os.path.isfile(psf_cube_path):
+            shared_cube[:] = util.read_frame_cube(psf_cube_path)[0]
+        log.info(f'Collecting pair PSFs in shared memory, {shared_cube.nbytes / 1e9:.3g} GB')
+
+    def save_shared_psf_cube(self, psf_cube_path):
+        """ Write the pair PSFs from the shared memory block to the PSF cube on disk, for savepsfs='shared'.
+
+        Parameters:
+        ----------
+        psf_cube_path : string
+            Path of the PSF cube on disk.
+        """
+        shared_cube = util.attach_shared_array(util.shared_array_name(psf_cube_path))
+        cube = util.create_frame_cube(psf_cube_path, list(util.segment_pairs_non_repeating(self.nb_seg)),
+                                      shared_cube.shape[1:])
+        cube[:] = shared_cube
+        cube.flush()
+        log.info(f'Pair PSFs saved to {psf_cube_path}')
+
+    def create_dh_pixel_cube(self):
+        """ Preallocate the cube for the dark hole pixels of all pair PSFs, for savepsfs='dh'.
+
+        Next to the cube, the dark hole mask and the dark hole pixels of the unaberrated coronagraphic PSF are saved,
+        see dh_pixel_matrices.read_dh_pixel_cube().
+        """
+        cube_path = os.path.join(self.resDir, 'psfs', DH_PIXEL_CUBE_NAME)
+        dh_mask = self.reference_images['dh_mask'] != 0
+        util.create_frame_cube(cube_path, list(util.segment_pairs_non_repeating(self.nb_seg)),
+                               (np.count_nonzero(dh_mask),), dtype=np.float32)
+        np.save(os.path.splitext(cube_path)[0] + '_mask.npy', dh_mask)
+        np.save(os.path.splitext(cube_path)[0] + '_reference.npy', self.reference_images['coro_psf'][dh_mask])
+        log.info(f'Writing dark hole pixels of the pair PSFs into {cube_path}')
+
+    def save_contrast_matrix(self):
+        """ Save the contrast matrix to disk as fits file and as a PDF image. """
 
         # Save all contrasts to disk, WITHOUT subtraction of coronagraph floor
-        hcipy.write_fits(self.contrast_matrix, os.path.join(self.resDir, 'contrast_matrix.fits'))
+        filename_contrast = self.versioned_name('contrast_matrix')
+        hcipy.write_fits(self.contrast_matrix, os.path.join(self.resDir, filename_contrast + '.fits'))
         plt.figure(figsize=(10, 10))
         plt.imshow(self.contrast_matrix)
         plt.colorbar()
-        plt.savefig(os.path.join(self.resDir, 'contrast_matrix.pdf'))
+        plt.savefig(os.path.join(self.resDir, filename_contrast + '.pdf'))
+
+    def calculate_contrast_matrix_with_cutoff(self, separation_cutoff, num_error_samples=None, distributed=False):
+        """ Calculate the contrast matrix only for segment pairs that are closer than a cutoff separation.
+
+        Off-axis PASTIS matrix elements of widely separated segments are usually tiny compared to the on-axis ones, so
+        this saves most of the pair calculations on apertures with many segments. The pairs beyond the cutoff get the
+        contrast they would have if the two segments did not interfere at all, c_ij = c_ii + c_jj - c_floor, which makes
+        their PASTIS matrix elements zero. A random sample of them is calculated anyway to estimate the error this
+        introduces, see estimate_separation_cutoff_error(); the sample uses a fixed seed so that a resumed run picks
+        the same pairs again. The sampled pairs are only used for the error estimate, they do not end up in the matrix.
+
+        Parameters:
+        ----------
+        separation_cutoff : float
+            Largest center-to-center separation of a segment pair that gets calculated, in units of segment_positions().
+        num_error_samples : int or None
+            Number of pairs beyond the cutoff to calculate for the error estimate. If None, read from the configfile.
+        distributed : bool
+            Whether to use the file system task queue instead of a local multiprocessing pool.
+        """
+        if num_error_samples is None:
+            num_error_samples = CONFIG_PASTIS.getint('numerical', 'separation_cutoff_error_samples', fallback=50)
+
+        seg_pos_x, seg_pos_y = self.segment_positions()
+        computed_pairs, self.skipped_pairs = util.segment_pairs_within_separation(seg_pos_x, seg_pos_y, separation_cutoff)
+        rng = np.random.default_rng(seed=0)
+        sample_indices = rng.choice(len(self.skipped_pairs), size=min(num_error_samples, len(self.skipped_pairs)),
+                                    replace=False)
+        sampled_pairs = [self.skipped_pairs[index] for index in np.sort(sample_indices)]
+        log.info(f'Separation cutoff {separation_cutoff}: calculating {len(computed_pairs)} pairs, skipping '
+                 f'{len(self.skipped_pairs)} pairs, of which {len(sampled_pairs)} are sampled for an error estimate')
+
+        self.calculate_contrast_matrix(distributed=distributed, pairs=computed_pairs + sampled_pairs)
+
+        # Estimate the error from the sampled pairs before replacing them with the no-interference contrast
+        self.separation_cutoff_error = estimate_separation_cutoff_error(self.contrast_matrix, computed_pairs,
+                                                                        sampled_pairs, len(self.skipped_pairs),
+                                                                        float(self.contrast_floor), self.wfe_aber)
+        with open(os.path.join(self.resDir, 'separation_cutoff_error.txt'), 'w') as error_file:
+            error_file.write(f'separation_cutoff: {separation_cutoff}\n')
+            error_file.write(f'computed pairs: {len(computed_pairs)}\n')
+            error_file.write(f'skipped pairs: {len(self.skipped_pairs)}\n')
+            for key, value in self.separation_cutoff_error.items():
+                error_file.write(f'{key}: {value}\n')
+
+        for seg_i, seg_j in self.skipped_pairs:
+            self.contrast_matrix[seg_i, seg_j] = (self.contrast_matrix[seg_i, seg_i] + self.contrast_matrix[seg_j, seg_j]
+                                                  - float(self.contrast_floor))
+        self.save_contrast_matrix()
+
+    def calculate_contrast_matrix_with_symmetry(self, tolerance=None, num_verification_samples=None, distributed=False,
+                                                verification_rtol=None):
+        """ Calculate the contrast matrix from one representative pair per class of symmetry-equivalent pairs.
+
+        The rotations and reflections of a hexagon are tested on the segment centers and on the optics returned by
+        symmetry_fields(); all pairs that are mapped onto each other by the symmetries that hold within the tolerance
+        form a class, see pastis.matrix_generation.pair_symmetry. This assumes that the calibration aberration on each
+        segment is invariant under these symmetries, which holds for segment piston. Only the first pair of each class
+        is calculated and its contrast is copied to all other pairs of the class. A random sample of the other pairs is
+        calculated as well to verify this; the sample uses a fixed seed so that a resumed run picks the same pairs again,
+        and its calculated contrasts are kept in the matrix. The outcome of the verification is kept in
+        self.symmetry_verified: True if all verification pairs agree with their class within "verification_rtol",
+        False if not, and None if there were no pairs to verify.
+
+        Parameters:
+        ----------
+        tolerance : float or None
+            Geometric tolerance of the symmetry detection, see pair_symmetry.find_aperture_symmetries(). If None, read
+            from the configfile.
+        num_verification_samples : int or None
+            Number of non-representative pairs to calculate for the verification. If None, read from the configfile.
+        distributed : bool
+            Whether to use the file system task queue instead of a local multiprocessing pool.
+        verification_rtol : float or None
+            Largest allowed PASTIS matrix element error of a verification pair, relative to the mean on-axis PASTIS
+            matrix element. If None, read from the configfile.
+        """
+        if tolerance is None:
+            tolerance = CONFIG_PASTIS.getfloat('numerical', 'symmetry_tolerance', fallback=0.05)
+        if num_verification_samples is None:
+            num_verification_samples = CONFIG_PASTIS.getint('numerical', 'symmetry_verification_samples', fallback=20)
+        if verification_rtol is None:
+            verification_rtol = CONFIG_PASTIS.getfloat('numerical', 'symmetry_verification_rtol', fallback=0.01)
+
+        seg_pos_x, seg_pos_y = self.segment_positions()
+        permutations = pair_symmetry.find_aperture_symmetries(seg_pos_x, seg_pos_y, self.symmetry_fields(), tolerance)
+        representatives = pair_symmetry.segment_pair_classes(permutations, self.nb_seg)
+
+        all_pairs = list(util.segment_pairs_non_repeating(self.nb_seg))
+        representative_pairs = [all_pairs[index] for index in np.unique(representatives)]
+        others = [index for index in range(len(all_pairs)) if representatives[index] != index]
+        rng = np.random.default_rng(seed=0)
+        sample_indices = np.sort(rng.choice(others, size=min(num_verification_samples, len(others)), replace=False))
+        sampled_pairs = [all_pairs[index] for index in sample_indices]
+        log.info(f'{len(permutations)} aperture symmetries found: calculating {len(representative_pairs)} pair classes '
+                 f'out of {len(all_pairs)} pairs, and {len(sampled_pairs)} pairs for verification')
+
+        self.calculate_contrast_matrix(distributed=distributed, pairs=representative_pairs + sampled_pairs)
+
+        sampled = set(sampled_pairs)
+        for index, pair in enumerate(all_pairs):
+            if representatives[index] != index and pair not in sampled:
+                self.contrast_matrix[pair[0], pair[1]] = self.contrast_matrix[all_pairs[representatives[index]]]
+
+        # Compare the verification sample to the contrast of its class representatives. A contrast error of a pair
+        # changes its PASTIS matrix element by half of it, which is compared to the mean on-axis PASTIS matrix element.
+        calculated = np.array([self.contrast_matrix[pair[0], pair[1]] for pair in sampled_pairs])
+        broadcast = np.array([self.contrast_matrix[all_pairs[representatives[index]]] for index in sample_indices])
+        mean_diagonal = np.mean(np.diag(self.contrast_matrix)) - float(self.contrast_floor)
+        deviations = np.abs(calculated - broadcast) / 2 / mean_diagonal
+        self.symmetry_verified = bool(np.all(deviations <= verification_rtol)) if deviations.size > 0 else None
+        with open(os.path.join(self.resDir, 'symmetry_verification.txt'), 'w') as verification_file:
+            verification_file.write(f'symmetries: {len(permutations)}\n')
+            verification_file.write(f'pair classes: {len(representative_pairs)}\n')
+            verification_file.write(f'verified: {self.symmetry_verified} (relative tolerance {verification_rtol})\n')
+            verification_file.write('# seg_i seg_j calculated_contrast representative_contrast relative_matrix_error\n')
+            for pair, value, reference, deviation in zip(sampled_pairs, calculated, broadcast, deviations):
+                verification_file.write(f'{pair[0]} {pair[1]} {value!r} {reference!r} {deviation!r}\n')
+        if deviations.size > 0:
+            log.info(f'Symmetry verification on {deviations.size} pairs: PASTIS matrix element errors relative to the '
+                     f'mean on-axis element are {np.mean(deviations)} on average, {np.max(deviations)} at most')
+            if not self.symmetry_verified:
+                log.warning(f'Symmetry-equivalent pairs deviate by up to {np.max(deviations)} of the mean on-axis '
+                            f'PASTIS matrix element, more than the tolerance {verification_rtol}; check '
+                            f'{os.path.join(self.resDir, "symmetry_verification.txt")}')
+
+        self.save_contrast_matrix()
+
+    def calculate_contrast_matrix_with_completion(self, measured_fraction, pair_selection='random', num_holdout=None,
+                                                  distributed=False):
+        """ Calculate all on-axis and a fraction of the off-axis pairs, and fill in the others by matrix completion.
+
+        The PASTIS matrix elements of the calculated pairs are fitted with a low-rank positive semi-definite matrix,
+        see pastis.matrix_generation.matrix_completion, and the contrasts of the remaining pairs are set to the ones that
+        reproduce the fitted elements. The rank is read from the configfile; if it is "auto", it is chosen by leaving
+        out part of the calculated pairs. In addition, a random set of held-out pairs is calculated that is not used in
+        the fit, to report the error of the completed matrix; the held-out pairs keep their calculated contrasts.
+        All random choices use a fixed seed, so that a resumed run picks the same pairs again.
+
+        Parameters:
+        ----------
+        measured_fraction : float
+            Fraction of the off-axis segment pairs to calculate and fit, between 0 and 1.
+        pair_selection : str
+            'random' for randomly chosen off-axis pairs, 'baseline' for the pairs with the closest segment centers, see
+            segment_positions().
+        num_holdout : int or None
+            Number of additional off-axis pairs to calculate for the error estimate. If None, read from the configfile.
+        distributed : bool
+            Whether to use the file system task queue instead of a local multiprocessing pool.
+        """
+        if num_holdout is None:
+            num_holdout = CONFIG_PASTIS.getint('numerical', 'completion_holdout_pairs', fallback=20)
+        rng = np.random.default_rng(seed=0)
+
+        diagonal_pairs = [(seg, seg) for seg in range(self.nb_seg)]
+        off_axis_pairs = [pair for pair in util.segment_pairs_non_repeating(self.nb_seg) if pair[0] != pair[1]]
+        if pair_selection == 'random':
+            order = rng.permutation(len(off_axis_pairs))
+        elif pair_selection == 'baseline':
+            seg_pos_x, seg_pos_y = self.segment_positions()
+            separations = [np.hypot(seg_pos_x[i] - seg_pos_x[j], seg_pos_y[i] - seg_pos_y[j]) for i, j in off_axis_pairs]
+            order = np.argsort(separations, kind='stable')
+        else:
+            raise ValueError(f'Pair selection "{pair_selection}" not recognized, use "random" or "baseline".')
+        num_measured = int(round(measured_fraction * len(off_axis_pairs)))
+        measured_pairs = [off_axis_pairs[index] for index in order[:num_measured]]
+        remaining = order[num_measured:]
+        holdout_indices = rng.choice(remaining, size=min(num_holdout, len(remaining)), replace=False)
+        holdout_pairs = [off_axis_pairs[index] for index in np.sort(holdout_indices)]
+        log.info(f'Matrix completion: calculating {self.nb_seg} on-axis, {len(measured_pairs)} off-axis and '
+                 f'{len(holdout_pairs)} held-out pairs, out of {self.nb_seg + len(off_axis_pairs)} pairs')
+
+        self.calculate_contrast_matrix(distributed=distributed, pairs=diagonal_pairs + measured_pairs + holdout_pairs)
+
+        # PASTIS matrix elements of the calculated pairs, in units of contrast
+        floor = float(self.contrast_floor)
+        diagonal = np.diag(self.contrast_matrix)
+        measured_matrix = np.diag(diagonal - floor)
+        known = np.eye(self.nb_seg, dtype=bool)
+        for seg_i, seg_j in measured_pairs + holdout_pairs:
+            element = (self.contrast_matrix[seg_i, seg_j] + floor - diagonal[seg_i] - diagonal[seg_j]) / 2
+            measured_matrix[seg_i, seg_j] = measured_matrix[seg_j, seg_i] = element
+        for seg_i, seg_j in measured_pairs:
+            known[seg_i, seg_j] = known[seg_j, seg_i] = True
+
+        rank = CONFIG_PASTIS.get('numerical', 'completion_rank', fallback='auto')
+        rank = matrix_completion.choose_completion_rank(measured_matrix, known, rng) if rank == 'auto' else int(rank)
+        completed_matrix = matrix_completion.complete_psd_matrix(measured_matrix, known, rank)
+
+        # Error of the completed matrix on the held-out pairs
+        with open(os.path.join(self.resDir, 'completion_error.txt'), 'w') as error_file:
+            error_file.write(f'measured off-axis pairs: {len(measured_pairs)}\n')
+            error_file.write(f'held-out pairs: {len(holdout_pairs)}\n')
+            error_file.write(f'rank: {rank}\n')
+            if holdout_pairs:
+                seg_i, seg_j = np.array(holdout_pairs).T
+                relative_error = matrix_completion.relative_rms_error(completed_matrix[seg_i, seg_j],
+                                                                      measured_matrix[seg_i, seg_j])
+                max_error = np.max(np.abs(completed_matrix[seg_i, seg_j] - measured_matrix[seg_i, seg_j]))
+                error_file.write(f'relative_rms_holdout_error: {relative_error}\n')
+                error_file.write(f'max_holdout_error_over_mean_diagonal: {max_error / np.mean(diagonal - floor)}\n')
+                log.info(f'Rank {rank} matrix completion: relative RMS error on {len(holdout_pairs)} held-out pairs '
+                         f'{relative_error}, largest error {max_error / np.mean(diagonal - floor)} of the mean on-axis '
+                         f'element')
+
+        # Contrasts of the pairs that were not calculated, consistent with the completed PASTIS matrix
+        calculated = set(measured_pairs + holdout_pairs)
+        for seg_i, seg_j in off_axis_pairs:
+            if (seg_i, seg_j) not in calculated:
+                self.contrast_matrix[seg_i, seg_j] = 2 * completed_matrix[seg_i, seg_j] + diagonal[seg_i] + diagonal[seg_j] - floor
+        self.save_contrast_matrix()
+
+    def _calculate_pairs_in_pool(self, pairs):
+        """ Calculate pairs with a multiprocessing pool, yield (contrast, pair) tuples as soon as they are done. """
+
+        # Figure out how many processes and threads per process are optimal, unless they are set in the configfile or
+        # have been tuned for this result folder before; the pairs calculated while tuning are not calculated again
+        trial_results = {}
+        num_processes, num_threads = get_process_split(self.calculate_matrix_pair, pairs[:self.nb_seg],
+                                                       self.instrument, self.design, cache_dir=self.resDir,
+                                                       trial_results=trial_results)
+        yield from trial_results.values()
+        remaining_pairs = [pair for pair in pairs if pair not in trial_results]
+        if len(remaining_pairs) == 0:
+            return
+
+        # Iterate over all segment pairs via a multiprocess pool, each worker sets up its simulator only once.
+        # Results stream in as soon as they are done, in whichever order the workers finish them.
+        # If the calculation fails or the caller stops early, the workers are stopped instead of finishing their pairs.
+        chunksize = CONFIG_PASTIS.getint('numerical', 'pair_chunksize', fallback=1)
+        mypool = create_pair_pool(num_processes, num_threads, self.instrument, self.design)
+        t_start = time.time()
+        try:
+            for num_done, result in enumerate(mypool.imap_unordered(self.calculate_matrix_pair, remaining_pairs,
+                                                                    chunksize=chunksize), start=1):
+                log_progress(num_done, len(remaining_pairs), t_start)
+                yield result
+            mypool.close()
+            mypool.join()
+        except BaseException:
+            mypool.terminate()
+            raise
+
+    def _calculate_pairs_in_task_queue(self, pairs):
+        """ Calculate pairs through the file system task queue, yield (contrast, pair) tuples once all are done. """
+
+        if len(pairs) == 0:
+            return
+
+        queue = FileTaskQueue(os.path.join(self.resDir, self.versioned_name('task_queue')))
+        queue.submit(self.calculate_matrix_pair, pairs,
+                     initializer=_init_simulator_cache, initargs=(self.instrument, self.design))
+        log.info(f'Waiting for workers, start them with: python pastis/launchers/run_queue_worker.py {queue.queue_dir}')
+
+        t_start = time.time()
+        wait_for_queue(queue, progress_function=lambda num_done, num_total: log_progress(num_done, num_total, t_start,
+                                                                                         num_reports=num_total))
+        yield from queue.results()
 
     def calculate_pastis_from_contrast_matrix(self):
         """ Take the contrast matrix and calculate the PASTIS matrix from it. """
@@ -198,13 +684,23 @@ class PastisMatrixIntensities(PastisMatrix):
         # Calculate the PASTIS matrix from the contrast matrix: analytical matrix element calculation and normalization
         self.matrix_pastis = pastis_from_contrast_matrix(self.contrast_matrix, self.seglist, self.wfe_aber, float(self.contrast_floor))
 
+        # Pairs beyond a separation cutoff are exactly zero, rather than zero up to rounding errors
+        filename_matrix = self.versioned_name('pastis_matrix')
+        if len(self.skipped_pairs) > 0:
+            seg_i, seg_j = np.array(self.skipped_pairs).T
+            self.matrix_pastis[seg_i, seg_j] = 0
+            self.matrix_pastis[seg_j, seg_i] = 0
+            scipy.sparse.save_npz(os.path.join(self.resDir, filename_matrix + '_sparse.npz'),
+                                  scipy.sparse.csr_matrix(self.matrix_pastis))
+            log.info(f'Sparse PASTIS matrix saved to: {os.path.join(self.resDir, filename_matrix + "_sparse.npz")}')
+
         # Save matrix to file
-        filename_matrix = f'pastis_matrix'
         hcipy.write_fits(self.matrix_pastis, os.path.join(self.resDir, filename_matrix + '.fits'))
-        ppl.plot_pastis_matrix(self.matrix_pastis, self.wvln * 1e9, out_dir=self.resDir, save=True)  # convert wavelength to nm
+        ppl.plot_pastis_matrix(self.matrix_pastis, self.wvln * 1e9, out_dir=self.resDir,
+                               fname_suffix=self.versioned_name('')[1:], save=True)  # convert wavelength to nm
         log.info(f'PASTIS matrix saved to: {os.path.join(self.resDir, filename_matrix + ".fits")}')
 
-    def calculate_ref_image(self):
+    def calculate_ref_image(self, save_coro_floor=True, save_psfs=True):
         """ Create the attributes self.norm, self.contrast_floor and self.coro_simulator. """
         raise NotImplementedError()
 
@@ -213,8 +709,73 @@ class PastisMatrixIntensities(PastisMatrix):
         segment/actuator pair. This needs to create self.calculate_matrix_pair. """
         raise NotImplementedError()
 
+    def segment_positions(self):
+        """ Return the x- and y-coordinates of the segment centers, as two arrays in the order of the segment indices.
+
+        This is only needed for calculations with a separation cutoff. """
+        raise NotImplementedError(f'Segment positions are not available for {self.instrument}.')
+
+    def symmetry_fields(self):
+        """ Return a dict of the optics that need to be invariant under a symmetry of the aperture, as hcipy.Fields
+        centered on the optical axis, e.g. aperture, apodizer, Lyot stop, focal plane mask and dark hole mask.
+
+        This is only needed for calculations with use_symmetry. """
+        raise NotImplementedError(f'Aperture symmetry detection is not available for {self.instrument}.')
+
+    def create_opd_cube(self):
+        """ Preallocate the cube that the pair functions store their pupil surface maps in, if saveopds is True.
+
+        Instruments that do not override this render each surface map to a PDF file directly in the pair function. """
+        pass
+
 
-def calculate_unaberrated_contrast_and_normalization(instrument, design=None, return_coro_simulator=True, save_coro_floor=False, save_psfs=False, outpath=''):
+def log_progress(num_done, num_total, start_time, num_reports=100, unit='pairs'):
+    """
+    Log the throughput and estimated time to completion of a long loop, about "num_reports" times over the whole loop.
+    :param num_done: int, number of items finished so far
+    :param num_total: int, total number of items in the loop
+    :param start_time: float, time.time() at the start of the loop
+    :param num_reports: int, how many progress messages to log over the whole loop
+    :param unit: string, name of the items in the loop, used in the log message
+    """
+    if num_total == 0 or (num_done != num_total and num_done % max(num_total // max(num_reports, 1), 1) != 0):
+        return
+
+    elapsed = time.time() - start_time
+    rate = num_done / elapsed if elapsed > 0 else float('inf')
+    eta = (num_total - num_done) / rate if rate > 0 else float('inf')
+    log.info(f'{num_done}/{num_total} {unit} done ({100 * num_done / num_total:.1f}%), '
+             f'{rate:.2f} {unit}/s, ETA {eta:.0f}sec = {eta / 60:.1f}min')
+
+
+def read_contrast_journal(journal_path):
+    """
+    Read the pair-wise contrasts recorded in the journal file of a (partial) contrast matrix calculation.
+
+    Each line of the journal holds the two segment indices of a pair and the DH mean contrast that was calculated for
+    it, separated by spaces. An incomplete last line, as left behind by an interrupted run, is skipped.
+    :param journal_path: string, path to the journal file
+    :return: dict with segment pair tuples (0-indexed) as keys and their contrast as values; empty if the file does not exist
+    """
+    finished_pairs = {}
+    if not os.path.isfile(journal_path):
+        return finished_pairs
+
+    with open(journal_path, 'r') as journal:
+        for line in journal:
+            entries = line.split()
+            try:
+                seg1, seg2, contrast = int(entries[0]), int(entries[1]), float(entries[2])
+            except (IndexError, ValueError):
+                log.warning(f'Skipping incomplete journal entry: {line.strip()}')
+                continue
+            finished_pairs[(seg1, seg2)] = contrast
+
+    return finished_pairs
+
+
+def calculate_unaberrated_contrast_and_normalization(instrument, design=None, return_coro_simulator=True, save_coro_floor=False, save_psfs=False, outpath='',
+                                                      return_reference_images=False):
     """
     Calculate the direct PSF peak and unaberrated coronagraph floor of an instrument.
     :param instrument: string, 'LUVOIR', 'HiCAT', 'RST' or 'JWST'
@@ -224,7 +785,10 @@ def calculate_unaberrated_contrast_and_normalization(instrument, design=None, re
     :param save_coro_floor: bool, if True, will save coro floor value to txt file, default False
     :param save_psfs: bool, if True, will save direct and coro PSF images to disk, default False
     :param outpath: string, where to save outputs to if save=True
-    :return: contrast floor and PSF normalization factor, and optionally (by default) the simulator in coron mode
+    :param return_reference_images: bool, whether to additionally return a dict with the 2D arrays "direct_psf",
+                                    "coro_psf" (normalized) and "dh_mask" as last return, default False
+    :return: contrast floor and PSF normalization factor, optionally (by default) the simulator in coron mode, and
+             optionally the reference images
     """
 
     if instrument == 'LUVOIR':
@@ -234,6 +798,7 @@ def calculate_unaberrated_contrast_and_normalization(instrument, design=None, re
         if design is None:
             design = CONFIG_PASTIS.get('LUVOIR', 'coronagraph_design')
         luvoir = LuvoirAPLC(optics_input, design, sampling)
+        set_up_focal_grid(luvoir)
 
         # Calculate reference images for contrast normalization and coronagraph floor
         unaberrated_coro_psf, direct = luvoir.calc_psf(ref=True, display_intermediate=False, return_intermediate=None)
@@ -327,10 +892,397 @@ def calculate_unaberrated_contrast_and_normalization(instrument, design=None, re
     if save_psfs:
         ppl.plot_direct_coro_dh(direct_psf, coro_psf, dh_mask, outpath)
 
+    returns = [contrast_floor, norm]
     if return_coro_simulator:
-        return contrast_floor, norm, coro_simulator
+        returns.append(coro_simulator)
+    if return_reference_images:
+        returns.append({'direct_psf': np.asarray(direct_psf), 'coro_psf': np.asarray(coro_psf),
+                        'dh_mask': np.asarray(dh_mask)})
+
+    return tuple(returns)
+
+
+def estimate_separation_cutoff_error(contrast_matrix, computed_pairs, sampled_pairs, num_skipped, coro_floor, wfe_aber):
+    """
+    Estimate the error of a PASTIS matrix in which all pairs beyond a separation cutoff are set to zero.
+
+    The off-axis PASTIS matrix elements of a random sample of the skipped pairs are calculated from the contrast matrix
+    and compared to the elements that are kept. The Frobenius norm of the skipped part of the matrix is extrapolated
+    from the sample's mean square element.
+    :param contrast_matrix: nd.array, nseg x nseg contrast matrix with the calculated and the sampled pairs filled in,
+                            coronagraph floor NOT SUBTRACTED yet
+    :param computed_pairs: list of segment pair tuples that are kept in the matrix, including all pairs i == j
+    :param sampled_pairs: list of segment pair tuples beyond the cutoff that have been calculated for the estimate
+    :param num_skipped: int, total number of pairs beyond the cutoff
+    :param coro_floor: float, coronagraph floor
+    :param wfe_aber: float, calibration aberration in m
+    :return: dict of error estimates; matrix elements are in units of contrast per nanometers squared
+    """
+    norm = np.square(wfe_aber * 1e9)
+    diagonal = (np.diag(contrast_matrix) - coro_floor) / norm
+
+    def off_axis_elements(pairs):
+        pairs = [pair for pair in pairs if pair[0] != pair[1]]
+        if len(pairs) == 0:
+            return np.zeros(0)
+        seg_i, seg_j = np.array(pairs).T
+        return (contrast_matrix[seg_i, seg_j] + coro_floor - contrast_matrix[seg_i, seg_i] - contrast_matrix[seg_j, seg_j]) / 2. / norm
+
+    kept = off_axis_elements(computed_pairs)
+    sampled = off_axis_elements(sampled_pairs)
+    if sampled.size == 0:
+        log.warning('No skipped pairs sampled, cannot estimate the error of the separation cutoff')
+        return {'num_samples': 0}
+
+    # Each off-axis element appears twice in the symmetric matrix
+    kept_norm = np.sqrt(np.sum(np.square(diagonal)) + 2 * np.sum(np.square(kept)))
+    skipped_norm = np.sqrt(2 * num_skipped * np.mean(np.square(sampled)))
+    error = {'num_samples': sampled.size,
+             'mean_abs_skipped_element': np.mean(np.abs(sampled)),
+             'max_abs_skipped_element': np.max(np.abs(sampled)),
+             'mean_diagonal_element': np.mean(diagonal),
+             'skipped_frobenius_norm_estimate': skipped_norm,
+             'relative_frobenius_error_estimate': skipped_norm / kept_norm}
+
+    log.info(f'Separation cutoff error estimate from {sampled.size} sampled pairs: mean |M_ij| = '
+             f'{error["mean_abs_skipped_element"]}, max |M_ij| = {error["max_abs_skipped_element"]}, mean diagonal = '
+             f'{error["mean_diagonal_element"]}, relative Frobenius norm of the skipped part = '
+             f'{error["relative_frobenius_error_estimate"]}')
+    return error
+
+
+def create_pair_simulator(instrument, design=None):
+    """
+    Create the coronagraphic simulator that the pair-wise functions use to calculate aberrated PSFs.
+    :param instrument: string, 'LUVOIR', 'HiCAT', 'JWST' or 'RST'
+    :param design: str, optional, default=None, which means we read from the configfile: what coronagraph design
+                   to use - 'small', 'medium' or 'large'; only used for LUVOIR
+    :return: simulator instance in coronagraphic mode; a tuple of (NIRCam instrument, OTE) in the JWST case
+    """
+
+    if instrument == 'LUVOIR':
+        sampling = CONFIG_PASTIS.getfloat('LUVOIR', 'sampling')
+        optics_input = os.path.join(util.find_repo_location(), CONFIG_PASTIS.get('LUVOIR', 'optics_path_in_repo'))
+        if design is None:
+            design = CONFIG_PASTIS.get('LUVOIR', 'coronagraph_design')
+        simulator = LuvoirAPLC(optics_input, design, sampling)
+        set_up_focal_grid(simulator)
+
+    elif instrument == 'HiCAT':
+        simulator = set_up_hicat(apply_continuous_dm_maps=True)
+        simulator.include_fpm = True
+
+    elif instrument == 'JWST':
+        jwst_instrument, jwst_ote = webbpsf_imaging.set_up_nircam()
+        jwst_instrument.image_mask = CONFIG_PASTIS.get('JWST', 'focal_plane_mask')
+        simulator = (jwst_instrument, jwst_ote)
+
+    elif instrument == 'RST':
+        simulator = webbpsf_imaging.set_up_cgi()
+
     else:
-        return contrast_floor, norm
+        raise ValueError(f'Instrument "{instrument}" is not supported for pair-wise matrix calculations.')
+
+    return simulator
+
+
+def set_up_focal_grid(simulator):
+    """
+    Switch a SegmentedAPLC simulator to the focal grid that only covers its dark hole, if "dh_focal_grid" is set in the
+    configfile. All matrix calculations only need the DH pixels, the reference images and DH mask get cropped alike.
+    :param simulator: SegmentedAPLC instance, e.g. LuvoirA_APLC or HexRingAPLC
+    """
+    if CONFIG_PASTIS.getboolean('numerical', 'dh_focal_grid', fallback=False):
+        simulator.use_dh_focal_grid()
+
+
+def get_cached_simulator(instrument, design=None):
+    """
+    Return the simulator of the current process, and create it if it does not exist yet.
+
+    All aberrations are set by the pair-wise functions themselves, which flatten the simulator before each pair, so one
+    instance can be reused for any number of pairs.
+    :param instrument: string, 'LUVOIR', 'HiCAT', 'JWST' or 'RST'
+    :param design: str, optional, LUVOIR coronagraph design - 'small', 'medium' or 'large'
+    :return: simulator instance as returned by create_pair_simulator()
+    """
+    key = (instrument, design)
+    if key not in _SIMULATOR_CACHE:
+        log.info(f'Setting up {instrument} simulator in process {os.getpid()}')
+        _SIMULATOR_CACHE[key] = create_pair_simulator(instrument, design)
+    return _SIMULATOR_CACHE[key]
+
+
+def _init_simulator_cache(instrument, design=None, num_threads=None):
+    """ Pool initializer: limit the math threads of a worker process and create its simulator once, before it
+    calculates its first pair. """
+    if num_threads is not None:
+        set_math_threads(num_threads)
+    get_cached_simulator(instrument, design)
+
+
+# Environment variables read by the BLAS/OpenMP/FFT backends numpy, scipy and numexpr may be linked against
+THREAD_ENVIRONMENT_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'BLIS_NUM_THREADS',
+                                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+_THREADPOOL_LIMITS = None
+
+
+def set_math_threads(num_threads):
+    """
+    Limit the number of threads the numerical libraries use in the current process.
+
+    The environment variables are picked up by libraries loaded after this call, which includes all worker processes
+    started from here with the "spawn" method. Libraries that are loaded already, like the ones preloaded by the
+    forkserver, are limited through threadpoolctl, if it is installed.
+    :param num_threads: int, number of threads per process
+    """
+    global _THREADPOOL_LIMITS
+
+    for variable in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = str(num_threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+        _THREADPOOL_LIMITS = threadpool_limits(limits=num_threads)
+    except ImportError:
+        pass
+
+
+# Simulator module of each instrument, imported once in the forkserver, see pool_preload_modules()
+SIMULATOR_MODULES = {'LUVOIR': 'pastis.simulators.luvoir_imaging',
+                     'HiCAT': 'pastis.simulators.hicat_imaging',
+                     'JWST': 'pastis.simulators.webbpsf_imaging',
+                     'RST': 'pastis.simulators.webbpsf_imaging',
+                     'HexRingTelescope': 'pastis.simulators.scda_telescopes'}
+
+
+def pool_preload_modules(instrument):
+    """
+    List the modules that the workers of a matrix calculation need, to import them once in the forkserver.
+    :param instrument: string, 'LUVOIR', 'HiCAT', 'JWST', 'RST' or 'HexRingTelescope'
+    :return: list of module names
+    """
+    modules = ['hcipy', 'pastis.matrix_generation.matrix_building_numerical']
+    if instrument in SIMULATOR_MODULES:
+        modules.append(SIMULATOR_MODULES[instrument])
+    return modules
+
+
+def create_pair_pool(num_processes, num_threads, instrument, design=None):
+    """
+    Create a multiprocessing pool for pair-wise calculations, with a fixed number of math threads per worker.
+
+    Each worker sets up its own simulator once, see get_cached_simulator().
+    :param num_processes: int, number of worker processes
+    :param num_threads: int, number of BLAS/FFT threads in each worker process
+    :param instrument: string, 'LUVOIR', 'HiCAT', 'JWST' or 'RST'
+    :param design: str, optional, LUVOIR coronagraph design - 'small', 'medium' or 'large'
+    :return: multiprocessing.Pool
+    """
+    return create_worker_pool(num_processes, num_threads, pool_preload_modules(instrument),
+                              initializer=_init_simulator_cache, initargs=(instrument, design, num_threads))
+
+
+def create_worker_pool(num_processes, num_threads, preload_modules, initializer=None, initargs=()):
+    """
+    Create a multiprocessing pool with a fixed number of math threads per worker.
+
+    The workers are started with the start method from the configfile, see util.get_multiprocessing_context(). The
+    initializer needs to limit the math threads of the workers that come from a forkserver, with set_math_threads().
+    :param num_processes: int, number of worker processes
+    :param num_threads: int, number of BLAS/FFT threads in each worker process
+    :param preload_modules: list of str, modules to import once in the forkserver
+    :param initializer: function to call in each worker when it starts
+    :param initargs: tuple, arguments of the initializer
+    :return: multiprocessing.Pool
+    """
+    # Spawned workers inherit the environment at start-up, set it before the pool is created and restore it afterwards;
+    # workers from the forkserver have the environment of the server, they are limited in the pool initializer
+    saved_environment = {variable: os.environ.get(variable) for variable in THREAD_ENVIRONMENT_VARIABLES}
+    for variable in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = str(num_threads)
+    try:
+        context = util.get_multiprocessing_context(preload_modules)
+        pool = context.Pool(num_processes, initializer=initializer, initargs=initargs)
+    finally:
+        for variable, value in saved_environment.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+    return pool
+
+
+def _timed_pair_calculation(calculate_matrix_pair, segment_pair):
+    """ Run one pair-wise calculation and return its result, together with how long it took inside the worker, in
+    seconds. """
+    start = time.perf_counter()
+    result = calculate_matrix_pair(segment_pair)
+    return result, time.perf_counter() - start
+
+
+def tune_process_split(calculate_matrix_pair, trial_pairs, instrument, design=None, trial_results=None):
+    """
+    Find the split of the CPU cores into worker processes and math threads per process with the highest pair throughput.
+
+    For every candidate number of threads per process (powers of two), a full pool is started and each of its
+    workers calculates one trial pair while all others run concurrently, so that memory bandwidth contention is
+    included in the measurement. The time a pair takes inside the worker is measured, which excludes the simulator
+    set-up.
+    :param calculate_matrix_pair: partial function that calculates a single pair, see e.g. _luvoir_matrix_one_pair()
+    :param trial_pairs: list of segment pair tuples to use for the trials
+    :param instrument: string, 'LUVOIR', 'HiCAT', 'JWST' or 'RST'
+    :param design: str, optional, LUVOIR coronagraph design - 'small', 'medium' or 'large'
+    :param trial_results: dict or None, if a dict, the results of calculate_matrix_pair() for the trial pairs get
+                          stored in it, keyed by pair, so that they do not need to be calculated again
+    :return: tuple of (number of processes, number of threads per process)
+    """
+    num_cpu = multiprocessing.cpu_count()
+    timed_pair = functools.partial(_timed_pair_calculation, calculate_matrix_pair)
+
+    best_split = (num_cpu, 1)
+    best_throughput = 0
+    num_threads = 1
+    while num_threads <= num_cpu:
+        num_processes = num_cpu // num_threads
+        pairs = [trial_pairs[i % len(trial_pairs)] for i in range(num_processes)]
+
+        pool = create_pair_pool(num_processes, num_threads, instrument, design)
+        try:
+            timed_results = pool.map(timed_pair, pairs, chunksize=1)
+            pool.close()
+            pool.join()
+        except BaseException:
+            pool.terminate()
+            raise
+
+        pair_times = [pair_time for _result, pair_time in timed_results]
+        if trial_results is not None:
+            for pair, (result, _pair_time) in zip(pairs, timed_results):
+                trial_results.setdefault(pair, result)
+
+        throughput = num_processes / np.median(pair_times)
+        log.info(f'Tuning: {num_processes} processes x {num_threads} threads: {np.median(pair_times):.2f}sec per pair, '
+                 f'{throughput:.2f} pairs/s')
+        if throughput > best_throughput:
+            best_split = (num_processes, num_threads)
+            best_throughput = throughput
+        num_threads *= 2
+
+    return best_split
+
+
+def get_process_split(calculate_matrix_pair, trial_pairs, instrument, design=None, cache_dir=None,
+                      trial_results=None):
+    """
+    Get the number of worker processes and math threads per process for a multiprocessed pair-wise calculation.
+
+    The keys "num_processes" and "threads_per_process" in the [numerical] section of the configfile can be set to an
+    integer or to "auto". If only one of them is given, the other one is chosen so that all CPU cores are used. If
+    both are "auto" (default), the split is measured with tune_process_split(). With a "cache_dir", the tuned split is
+    written to the file "process_split.txt" in it and read from there by later calculations in the same folder, like
+    resumed runs and updates, as long as they run on the same number of CPU cores.
+    :param calculate_matrix_pair: partial function that calculates a single pair, see e.g. _luvoir_matrix_one_pair()
+    :param trial_pairs: list of segment pair tuples that can be used for tuning
+    :param instrument: string, 'LUVOIR', 'HiCAT', 'JWST' or 'RST'
+    :param design: str, optional, LUVOIR coronagraph design - 'small', 'medium' or 'large'
+    :param cache_dir: str or None, folder to keep the tuned split in, usually the result folder of the run
+    :param trial_results: dict or None, gets the results of the pairs calculated while tuning, see tune_process_split()
+    :return: tuple of (number of processes, number of threads per process)
+    """
+    num_cpu = multiprocessing.cpu_count()
+    num_processes = CONFIG_PASTIS.get('numerical', 'num_processes', fallback='auto')
+    num_threads = CONFIG_PASTIS.get('numerical', 'threads_per_process', fallback='auto')
+
+    if num_processes != 'auto' and num_threads != 'auto':
+        num_processes, num_threads = int(num_processes), int(num_threads)
+        source = 'configfile'
+    elif num_processes != 'auto':
+        num_processes = int(num_processes)
+        num_threads = max(num_cpu // num_processes, 1)
+        source = 'configfile'
+    elif num_threads != 'auto':
+        num_threads = int(num_threads)
+        num_processes = max(num_cpu // num_threads, 1)
+        source = 'configfile'
+    elif len(trial_pairs) == 0:
+        num_processes, num_threads = num_cpu, 1
+        source = 'default, nothing to tune on'
+    elif cache_dir is not None and read_process_split(cache_dir) is not None:
+        num_processes, num_threads = read_process_split(cache_dir)
+        source = f'earlier tuning in {cache_dir}'
+    else:
+        num_processes, num_threads = tune_process_split(calculate_matrix_pair, trial_pairs, instrument, design,
+                                                        trial_results)
+        source = 'tuner'
+        if cache_dir is not None:
+            with open(os.path.join(cache_dir, PROCESS_SPLIT_NAME), 'w') as split_file:
+                split_file.write(f'{num_processes} {num_threads} {num_cpu}\n')
+
+    log.info(f'Multiprocess PASTIS matrix for {instrument} will use {num_processes} processes '
+             f'(with {num_threads} threads per process), chosen by {source}')
+    return num_processes, num_threads
+
+
+def read_process_split(cache_dir):
+    """
+    Read the split of the CPU cores that get_process_split() tuned for a folder.
+    :param cache_dir: str, folder that the split was tuned for
+    :return: tuple of (number of processes, number of threads per process), or None if it has not been tuned yet, or
+             on a different number of CPU cores
+    """
+    try:
+        with open(os.path.join(cache_dir, PROCESS_SPLIT_NAME)) as split_file:
+            num_processes, num_threads, num_cpu = (int(value) for value in split_file.read().split())
+    except (OSError, ValueError):
+        return None
+    if num_cpu != multiprocessing.cpu_count():
+        return None
+    return num_processes, num_threads
+
+
+def save_pair_psf(psf, segment_pair, filename_psf, resDir, savepsfs):
+    """
+    Save the PSF of one aberrated segment pair, either as its own fits file or into the PSF cube of the run.
+    :param psf: Field or array, normalized PSF of the pair
+    :param segment_pair: tuple, pair of aberrated segments, 0-indexed
+    :param filename_psf: str, file name (without extension) to use when saving to an individual fits file
+    :param resDir: str, directory for matrix calculations
+    :param savepsfs: bool or str, 'cube' to write into the preallocated cube "psfs/psf_cube.npy" at the position of
+                     the pair, 'shared' to write into the shared memory block of that cube at the position of the pair,
+                     'dh' to write only the dark hole pixels into the cube "psfs/dh_pixel_cube.npy", anything else that
+                     is True to write an individual fits file
+    """
+    frame = psf.shaped if hasattr(psf, 'shaped') else psf
+    cube_path = os.path.join(resDir, 'psfs', PSF_CUBE_NAME)
+    if savepsfs == 'cube':
+        nb_seg = util.nseg_from_measurements(util.open_cube_for_writing(cube_path).shape[0])
+        util.write_cube_frame(cube_path, util.pair_index(segment_pair, nb_seg), frame)
+    elif savepsfs == 'shared':
+        cube = util.attach_shared_array(util.shared_array_name(cube_path))
+        cube[util.pair_index(segment_pair, util.nseg_from_measurements(cube.shape[0]))] = frame
+    elif savepsfs == 'dh':
+        cube_path = os.path.join(resDir, 'psfs', DH_PIXEL_CUBE_NAME)
+        if cube_path not in _DH_PIXEL_MASKS:
+            _DH_PIXEL_MASKS[cube_path] = np.load(os.path.splitext(cube_path)[0] + '_mask.npy')
+        nb_seg = util.nseg_from_measurements(util.open_cube_for_writing(cube_path).shape[0])
+        dh_pixels = np.asarray(frame)[_DH_PIXEL_MASKS[cube_path]]
+        util.write_cube_frame(cube_path, util.pair_index(segment_pair, nb_seg), dh_pixels)
+    else:
+        hcipy.write_fits(psf, os.path.join(resDir, 'psfs', filename_psf + '.fits'))
+
+
+def save_pair_opd(opd, segment_pair, resDir):
+    """
+    Store the pupil surface map of one aberrated segment pair in the preallocated OPD cube of the run.
+    :param opd: array, surface map of the pair, in the same format (full map or aperture pixels only) as the cube frames
+    :param segment_pair: tuple, pair of aberrated segments, 0-indexed
+    :param resDir: str, directory for matrix calculations
+    """
+    cube_path = os.path.join(resDir, 'OTE_images', OPD_CUBE_NAME)
+    nb_seg = util.nseg_from_measurements(util.open_cube_for_writing(cube_path).shape[0])
+    util.write_cube_frame(cube_path, util.pair_index(segment_pair, nb_seg), opd)
 
 
 def _jwst_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_pair):
@@ -339,7 +1291,7 @@ def _jwst_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_pa
     :param norm: float, direct PSF normalization factor (peak pixel of direct PSF)
     :param wfe_aber: calibration aberration per segment in m
     :param resDir: str, directory for matrix calculations
-    :param savepsfs: bool, if True, all PSFs will be saved to disk individually, as fits files
+    :param savepsfs: bool or str, if True, all PSFs will be saved to disk individually, as fits files; if 'cube', into the PSF cube
     :param saveopds: bool, if True, all pupil surface maps of aberrated segment pairs will be saved to disk as PDF
     :param segment_pair: tuple, pair of segments to aberrate, 0-indexed. If same segment gets passed in both tuple
                          entries, the segment will be aberrated only once.
@@ -348,9 +1300,8 @@ def _jwst_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_pa
     :return: contrast as float, and segment pair as tuple
     """
 
-    # Set up JWST simulator in coronagraphic state
-    jwst_instrument, jwst_ote = webbpsf_imaging.set_up_nircam()
-    jwst_instrument.image_mask = CONFIG_PASTIS.get('JWST', 'focal_plane_mask')
+    # Get JWST simulator in coronagraphic state
+    jwst_instrument, jwst_ote = get_cached_simulator('JWST')
 
     # Put aberration on correct segments. If i=j, apply only once!
     log.info(f'PAIR: {segment_pair[0]}-{segment_pair[1]}')
@@ -372,7 +1323,7 @@ def _jwst_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_pa
     # Save PSF image to disk
     if savepsfs:
         filename_psf = f'psf_piston_Noll1_segs_{segment_pair[0]}-{segment_pair[1]}'
-        hcipy.write_fits(psf, os.path.join(resDir, 'psfs', filename_psf + '.fits'))
+        save_pair_psf(psf, segment_pair, filename_psf, resDir, savepsfs)
 
     # Plot segmented mirror WFE and save to disk
     if saveopds:
@@ -400,18 +1351,16 @@ def _luvoir_matrix_one_pair(design, norm, wfe_aber, resDir, savepsfs, saveopds,
     :param norm: float, direct PSF normalization factor (peak pixel of direct PSF)
     :param wfe_aber: float, calibration aberration per segment in m
     :param resDir: str, directory for matrix calculations
-    :param savepsfs: bool, if True, all PSFs will be saved to disk individually, as fits files
-    :param saveopds: bool, if True, all pupil surface maps of aberrated segment pairs will be saved to disk as PDF
+    :param savepsfs: bool or str, if True, all PSFs will be saved to disk individually, as fits files; if 'cube', into the PSF cube
+    :param saveopds: bool, if True, all pupil surface maps of aberrated segment pairs will be stored in the OPD cube
     :param segment_pair: tuple, pair of segments to aberrate, 0-indexed. If same segment gets passed in both tuple
                          entries, the segment will be aberrated only once.
                          Note how LUVOIR segments start numbering at 1, with 0 being the center segment that doesn't exist.
     :return: contrast as float, and segment pair as tuple
     """
 
-    # Instantiate LUVOIR object
-    sampling = CONFIG_PASTIS.getfloat('LUVOIR', 'sampling')
-    optics_input = os.path.join(util.find_repo_location(), CONFIG_PASTIS.get('LUVOIR', 'optics_path_in_repo'))
-    luv = LuvoirAPLC(optics_input, design, sampling)
+    # Get LUVOIR object
+    luv = get_cached_simulator('LUVOIR', design)
 
     log.info(f'PAIR: {segment_pair[0]+1}-{segment_pair[1]+1}')
 
@@ -429,14 +1378,11 @@ def _luvoir_matrix_one_pair(design, norm, wfe_aber, resDir, savepsfs, saveopds,
     # Save PSF image to disk
     if savepsfs:
         filename_psf = f'psf_segs_{segment_pair[0]+1}-{segment_pair[1]+1}'
-        hcipy.write_fits(psf, os.path.join(resDir, 'psfs', filename_psf + '.fits'))
+        save_pair_psf(psf, segment_pair, filename_psf, resDir, savepsfs)
 
-    # Plot segmented mirror WFE and save to disk
+    # Store segmented mirror WFE inside the aperture, it can be rendered later with MatrixIntensityLuvoirA.render_opds()
     if saveopds:
-        opd_name = f'opd_segs_{segment_pair[0]+1}-{segment_pair[1]+1}'
-        plt.clf()
-        hcipy.imshow_field(inter['seg_mirror'], grid=luv.aperture.grid, mask=luv.aperture, cmap='RdBu')
-        plt.savefig(os.path.join(resDir, 'OTE_images', opd_name + '.pdf'))
+        save_pair_opd(inter['seg_mirror'][luv.aperture != 0], segment_pair, resDir)
 
     log.info('Calculating mean contrast in dark hole')
     dh_intensity = psf * luv.dh_mask
@@ -452,7 +1398,7 @@ def _hicat_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_p
     :param norm: float, direct PSF normalization factor (peak pixel of direct PSF)
     :param wfe_aber: calibration aberration per segment in m
     :param resDir: str, directory for matrix calculations
-    :param savepsfs: bool, if True, all PSFs will be saved to disk individually, as fits files
+    :param savepsfs: bool or str, if True, all PSFs will be saved to disk individually, as fits files; if 'cube', into the PSF cube
     :param saveopds: bool, if True, all pupil surface maps of aberrated segment pairs will be saved to disk as PDF
     :param segment_pair: tuple, pair of segments to aberrate, 0-indexed. If same segment gets passed in both tuple
                          entries, the segment will be aberrated only once.
@@ -460,8 +1406,8 @@ def _hicat_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_p
     :return: contrast as float, and segment pair as tuple
     """
 
-    # Set up HiCAT simulator in correct state
-    hicat_sim = set_up_hicat(apply_continuous_dm_maps=True)
+    # Get HiCAT simulator in correct state
+    hicat_sim = get_cached_simulator('HiCAT')
     hicat_sim.include_fpm = True
 
     # Put aberration on correct segments. If i=j, apply only once!
@@ -478,7 +1424,7 @@ def _hicat_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, segment_p
     # Save PSF image to disk
     if savepsfs:
         filename_psf = f'psf_piston_Noll1_segs_{segment_pair[0]}-{segment_pair[1]}'
-        hcipy.write_fits(psf, os.path.join(resDir, 'psfs', filename_psf + '.fits'))
+        save_pair_psf(psf, segment_pair, filename_psf, resDir, savepsfs)
 
     # Plot segmented mirror WFE and save to disk
     if saveopds:
@@ -503,14 +1449,14 @@ def _rst_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, actuator_pa
     :param norm: float, direct PSF normalization factor (peak pixel of direct PSF)
     :param wfe_aber: calibration aberration per segment in m
     :param resDir: str, directory for matrix calculations
-    :param savepsfs: bool, if True, all PSFs will be saved to disk individually, as fits files
+    :param savepsfs: bool or str, if True, all PSFs will be saved to disk individually, as fits files; if 'cube', into the PSF cube
     :param saveopds: bool, if True, all pupil surface maps of aberrated segment pairs will be saved to disk as PDF
     :param actuator_pair: tuple, pair of actuators to aberrate. If same segment gets passed in both tuple entries, the actuator will be aberrated only once
     :return: contrast as float, and segment pair as tuple
     """
 
-    # Set up RST simulator in coronagraphic state
-    rst_cgi = webbpsf_imaging.set_up_cgi()
+    # Get RST simulator in coronagraphic state
+    rst_cgi = get_cached_simulator('RST')
 
     # Put aberration on correct segments. If i=j, apply only once!
     log.info(f'PAIR: {actuator_pair[0]}-{actuator_pair[1]}')
@@ -533,7 +1479,7 @@ def _rst_matrix_one_pair(norm, wfe_aber, resDir, savepsfs, saveopds, actuator_pa
     # Save PSF image to disk
     if savepsfs:
         filename_psf = f'psf_actuator_{actuator_pair[0]}-{actuator_pair[1]}'
-        hcipy.write_fits(psf, os.path.join(resDir, 'psfs', filename_psf + '.fits'))
+        save_pair_psf(psf, actuator_pair, filename_psf, resDir, savepsfs)
 
     # Plot deformable mirror WFE and save to disk
     if saveopds:
@@ -616,6 +1562,8 @@ def calculate_semi_analytic_pastis_from_contrast(contrast_matrix, seglist, coro_
 
     # Create future (half filled) PASTIS matrix
     matrix_pastis_half = np.zeros_like(contrast_matrix)
+    # Indices of all off-axis elements in the upper matrix triangle, i.e. of all non-repeating pairs with i < j
+    seg_i, seg_j = np.triu_indices(contrast_matrix.shape[0], k=1)
 
     # Assuming constant coronagraph floor across all pair-aberrated measurements
     if isinstance(coro_floor, float):
@@ -626,13 +1574,9 @@ def calculate_semi_analytic_pastis_from_contrast(contrast_matrix, seglist, coro_
         log.info('On-axis elements of PASTIS matrix calculated')
 
         # Calculate the off-axis elements in the (half) PASTIS matrix
-        for pair in util.segment_pairs_non_repeating(contrast_matrix.shape[0]):    # this util function returns a generator
-            if pair[0] != pair[1]:    # exclude diagonal elements
-                matrix_off_val = (contrast_matrix[pair[0], pair[1]] + coro_floor - contrast_matrix[pair[0], pair[0]] - contrast_matrix[pair[1], pair[1]]) / 2.
-                matrix_pastis_half[pair[0], pair[1]] = matrix_off_val
-                log.info(f'Off-axis for i{seglist[pair[0]]}-j{seglist[pair[1]]}: {matrix_off_val}')
+        matrix_pastis_half[seg_i, seg_j] = (contrast_matrix[seg_i, seg_j] + coro_floor - contrast_matrix[seg_i, seg_i] - contrast_matrix[seg_j, seg_j]) / 2.
 
-    # Assuming drifting coronagraph floor across all pair-aberrated measurements  #TODO: this is untested
+    # Assuming drifting coronagraph floor across all pair-aberrated measurements
     elif isinstance(coro_floor, np.ndarray):
         log.info('coro_floor is drifting --> np.ndarray')
 
@@ -644,18 +1588,18 @@ def calculate_semi_analytic_pastis_from_contrast(contrast_matrix, seglist, coro_
         np.fill_diagonal(matrix_pastis_half, np.diag(contrast_matrix) - np.diag(coro_floor))
         log.info('On-axis elements of PASTIS matrix calculated')
 
-        for pair in util.segment_pairs_non_repeating(contrast_matrix.shape[0]):    # this util function returns a generator
-
-            # Then calculate the off-axis elements
-            if pair[0] != pair[1]:    # exclude diagonal elements
-                matrix_off_val = (contrast_matrix[pair[0], pair[1]] - coro_floor[pair[0], pair[1]] - matrix_pastis_half[pair[0], pair[0]] - matrix_pastis_half[pair[1], pair[1]]) / 2.
-                matrix_pastis_half[pair[0], pair[1]] = matrix_off_val
-                log.info(f'Off-axis for i{seglist[pair[0]]}-j{seglist[pair[1]]}: {matrix_off_val}')
+        # Then calculate the off-axis elements
+        matrix_pastis_half[seg_i, seg_j] = (contrast_matrix[seg_i, seg_j] - coro_floor[seg_i, seg_j] - matrix_pastis_half[seg_i, seg_i] - matrix_pastis_half[seg_j, seg_j]) / 2.
 
     else:
         raise TypeError('"coro_floor" needs to be either a float, if working with a constant coronagraph floor, or an '
                         'ndarray, if working with a drifting coronagraph floor.')
 
+    if seg_i.size > 0:
+        off_axis = matrix_pastis_half[seg_i, seg_j]
+        log.info(f'{seg_i.size} off-axis elements of PASTIS matrix calculated, ranging from {off_axis.min()} to '
+                 f'{off_axis.max()} (segments {seglist[0]} to {seglist[-1]})')
+
     return matrix_pastis_half
 
 
@@ -720,27 +1664,6 @@ def num_matrix_multiprocess(instrument, design=None, initial_path='', savepsfs=T
     contrast_floor, norm = calculate_unaberrated_contrast_and_normalization(instrument, design, return_coro_simulator=False,
                                                                             save_coro_floor=True, save_psfs=False, outpath=overall_dir)
 
-    # Figure out how many processes is optimal and create a Pool.
-    # Assume we're the only one on the machine so we can hog all the resources.
-    # We expect numpy to use multithreaded math via the Intel MKL library, so
-    # we check how many threads MKL will use, and create enough processes so
-    # as to use 100% of the CPU cores.
-    # You might think we should divide number of cores by 2 to get physical cores
-    # to account for hyperthreading, however empirical testing on telserv3 shows that
-    # it is slightly more performant on telserv3 to use all logical cores
-    num_cpu = multiprocessing.cpu_count()
-    # try:
-    #     import mkl
-    #     num_core_per_process = mkl.get_max_threads()
-    # except ImportError:
-    #     # typically this is 4, so use that as default
-    #     log.info("Couldn't import MKL; guessing default value of 4 cores per process")
-    #     num_core_per_process = 4
-
-    num_core_per_process = 1   # NOTE: this was changed by Scott Will in HiCAT and makes more sense, somehow
-    num_processes = int(num_cpu // num_core_per_process)
-    log.info(f"Multiprocess PASTIS matrix for {instrument} will use {num_processes} processes (with {num_core_per_process} threads per process)")
-
     # Set up a function with all arguments fixed except for the last one, which is the segment pair tuple
     if instrument == 'LUVOIR':
         calculate_matrix_pair = functools.partial(_luvoir_matrix_one_pair, design, norm, wfe_aber, resDir,
@@ -758,10 +1681,19 @@ def num_matrix_multiprocess(instrument, design=None, initial_path='', savepsfs=T
     if instrument == 'RST':
         calculate_matrix_pair = functools.partial(_rst_matrix_one_pair, norm, wfe_aber, resDir, savepsfs, saveopds)
 
-    # Iterate over all segment pairs via a multiprocess pool
-    mypool = multiprocessing.Pool(num_processes)
+    # Figure out how many processes and threads per process are optimal, unless they are set in the configfile
+    simulator_design = design if instrument == 'LUVOIR' else None
+    all_pairs = list(util.segment_pairs_non_repeating(nb_seg))
+    trial_results = {}
+    num_processes, num_threads = get_process_split(calculate_matrix_pair, all_pairs[:nb_seg], instrument,
+                                                   simulator_design, cache_dir=resDir, trial_results=trial_results)
+
+    # Iterate over all segment pairs via a multiprocess pool, each worker sets up its simulator only once; the pairs
+    # calculated while tuning are kept
+    mypool = create_pair_pool(num_processes, num_threads, instrument, simulator_design)
     t_start = time.time()
-    results = mypool.map(calculate_matrix_pair, util.segment_pairs_non_repeating(nb_seg))    # this util function returns a generator
+    results = list(trial_results.values()) + mypool.map(calculate_matrix_pair,
+                                                        [pair for pair in all_pairs if pair not in trial_results])
     t_stop = time.time()
 
     log.info(f"Multiprocess calculation complete in {t_stop-t_start}sec = {(t_stop-t_start)/60}min")
@@ -802,10 +1734,11 @@ class MatrixIntensityLuvoirA(PastisMatrixIntensities):
     instrument = 'LUVOIR'
     """ Calculate a PASTIS matrix for LUVOIR-A, using intensity images. """
 
-    def __init__(self, design='small', initial_path='', savepsfs=True, saveopds=True):
+    def __init__(self, design='small', initial_path='', savepsfs=True, saveopds=True, resume_dir=None):
         nb_seg = CONFIG_PASTIS.getint(self.instrument, 'nb_subapertures')
         seglist = util.get_segment_list(self.instrument)
-        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds)
+        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds,
+                         resume_dir=resume_dir)
         self.design = design
 
     def setup_one_pair_function(self):
@@ -814,53 +1747,97 @@ class MatrixIntensityLuvoirA(PastisMatrixIntensities):
         self.calculate_matrix_pair = functools.partial(_luvoir_matrix_one_pair, self.design, self.norm, self.wfe_aber,
                                                        self.resDir, self.savepsfs, self.saveopds)
 
+    def segment_positions(self):
+        """ Segment centers in m, from the simulator that was set up by calculate_ref_image(). """
+        return self.coro_simulator.seg_pos.x, self.coro_simulator.seg_pos.y
+
+    def symmetry_fields(self):
+        """ Pupil- and focal-plane optics of the simulator that was set up by calculate_ref_image(). """
+        return {'aperture': self.coro_simulator.aperture,
+                'apodizer': self.coro_simulator.apodizer,
+                'lyot_stop': self.coro_simulator.lyotstop,
+                'focal_plane_mask': self.coro_simulator.fpm,
+                'dark_hole_mask': self.coro_simulator.dh_mask}
+
+    def create_opd_cube(self):
+        """ Preallocate the cube for the segmented mirror surface maps, holding only the pixels inside the aperture. """
+        aperture = self.coro_simulator.aperture.shaped != 0
+        cube_path = os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME)
+        util.create_frame_cube(cube_path, list(util.segment_pairs_non_repeating(self.nb_seg)),
+                               (np.count_nonzero(aperture),), dtype=np.float32)
+        np.save(os.path.splitext(cube_path)[0] + '_aperture.npy', aperture)
+
+    def render_opds(self, pairs=None, num_processes=None, file_format='pdf'):
+        """ Render the stored segmented mirror surface maps to image files in the "OTE_images" folder.
+
+        Parameters:
+        ----------
+        pairs : list of tuples or None
+            Segment pairs (0-indexed) to render; renders all pairs if None.
+        num_processes : int or None
+            Number of processes to render with; uses all CPU cores if None.
+        file_format : str
+            Image file extension, e.g. 'pdf' or 'png'.
+        """
+        frame_numbers = None if pairs is None else [util.pair_index(pair, self.nb_seg) for pair in pairs]
+        ppl.render_opd_cube(os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME),
+                            os.path.join(self.resDir, 'OTE_images'), frame_numbers=frame_numbers,
+                            name_prefix='opd_segs', label_offset=1, num_processes=num_processes,
+                            file_format=file_format)
+
     def calculate_ref_image(self, save_coro_floor=True, save_psfs=True):
         """ Calculate the coronagraph floor, normalization factor from direct image, and get the simulator object. """
 
-        self.contrast_floor, self.norm, self.coro_simulator = calculate_unaberrated_contrast_and_normalization('LUVOIR',
-                                                                                                               self.design,
-                                                                                                               return_coro_simulator=True,
-                                                                                                               save_coro_floor=save_coro_floor,
-                                                                                                               save_psfs=save_psfs,
-                                                                                                               outpath=self.overall_dir)
+        (self.contrast_floor, self.norm, self.coro_simulator,
+         self.reference_images) = calculate_unaberrated_contrast_and_normalization('LUVOIR',
+                                                                                   self.design,
+                                                                                   return_coro_simulator=True,
+                                                                                   save_coro_floor=save_coro_floor,
+                                                                                   save_psfs=save_psfs,
+                                                                                   outpath=self.overall_dir,
+                                                                                   return_reference_images=True)
 
 
 class MatrixIntensityHicat(PastisMatrixIntensities):
     instrument = 'HiCAT'
     """ Calculate a PASTIS matrix for HiCAT, using intensity images. """
 
-    def __init__(self, initial_path='', savepsfs=True, saveopds=True):
+    def __init__(self, initial_path='', savepsfs=True, saveopds=True, resume_dir=None):
         nb_seg = CONFIG_PASTIS.getint(self.instrument, 'nb_subapertures')
         seglist = util.get_segment_list(self.instrument)
-        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds)
+        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds,
+                         resume_dir=resume_dir)
 
     def setup_one_pair_function(self):
         """ Create the partial function that returns the PSF of a single aberrated segment pair. """
 
         # Copy used BostonDM maps to matrix folder
         shutil.copytree(CONFIG_PASTIS.get('HiCAT', 'dm_maps_path'),
-                        os.path.join(self.resDir, 'hicat_boston_dm_commands'))
+                        os.path.join(self.resDir, 'hicat_boston_dm_commands'), dirs_exist_ok=True)
         self.calculate_matrix_pair = functools.partial(_hicat_matrix_one_pair, self.norm, self.wfe_aber, self.resDir,
                                                        self.savepsfs, self.saveopds)
 
     def calculate_ref_image(self, save_coro_floor=True, save_psfs=True):
         """ Calculate the coronagraph floor, normalization factor from direct image, and get the simulator object. """
 
-        self.contrast_floor, self.norm, self.coro_simulator = calculate_unaberrated_contrast_and_normalization('HiCAT',
-                                                                                                               return_coro_simulator=True,
-                                                                                                               save_coro_floor=save_coro_floor,
-                                                                                                               save_psfs=save_psfs,
-                                                                                                               outpath=self.overall_dir)
+        (self.contrast_floor, self.norm, self.coro_simulator,
+         self.reference_images) = calculate_unaberrated_contrast_and_normalization('HiCAT',
+                                                                                   return_coro_simulator=True,
+                                                                                   save_coro_floor=save_coro_floor,
+                                                                                   save_psfs=save_psfs,
+                                                                                   outpath=self.overall_dir,
+                                                                                   return_reference_images=True)
 
 
 class MatrixIntensityJWST(PastisMatrixIntensities):
     instrument = 'JWST'
     """ Calculate a PASTIS matrix for JWST, using intensity images. """
 
-    def __init__(self, initial_path='', savepsfs=True, saveopds=True):
+    def __init__(self, initial_path='', savepsfs=True, saveopds=True, resume_dir=None):
         nb_seg = CONFIG_PASTIS.getint(self.instrument, 'nb_subapertures')
         seglist = util.get_segment_list(self.instrument)
-        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds)
+        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds,
+                         resume_dir=resume_dir)
 
     def setup_one_pair_function(self):
         """ Create the partial function that returns the PSF of a single aberrated segment pair. """
@@ -871,21 +1848,24 @@ class MatrixIntensityJWST(PastisMatrixIntensities):
     def calculate_ref_image(self, save_coro_floor=True, save_psfs=True):
         """ Calculate the coronagraph floor, normalization factor from direct image, and get the simulator object. """
 
-        self.contrast_floor, self.norm, self.coro_simulator = calculate_unaberrated_contrast_and_normalization('JWST',
-                                                                                                               return_coro_simulator=True,
-                                                                                                               save_coro_floor=save_coro_floor,
-                                                                                                               save_psfs=save_psfs,
-                                                                                                               outpath=self.overall_dir)
+        (self.contrast_floor, self.norm, self.coro_simulator,
+         self.reference_images) = calculate_unaberrated_contrast_and_normalization('JWST',
+                                                                                   return_coro_simulator=True,
+                                                                                   save_coro_floor=save_coro_floor,
+                                                                                   save_psfs=save_psfs,
+                                                                                   outpath=self.overall_dir,
+                                                                                   return_reference_images=True)
 
 
 class MatrixIntensityRST(PastisMatrixIntensities):
     instrument = 'RST'
     """ Calculate a PASTIS matrix for the pupil-plane continuous DM on RST/CGI, using intensity images. """
 
-    def __init__(self, initial_path='', savepsfs=True, saveopds=True):
+    def __init__(self, initial_path='', savepsfs=True, saveopds=True, resume_dir=None):
         nb_seg = CONFIG_PASTIS.getint(self.instrument, 'nb_subapertures')
         seglist = util.get_segment_list(self.instrument)
-        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds)
+        super().__init__(nb_seg=nb_seg, seglist=seglist, initial_path=initial_path, savepsfs=savepsfs, saveopds=saveopds,
+                         resume_dir=resume_dir)
 
     def setup_one_pair_function(self):
         """ Create the partial function that returns the PSF of a single aberrated actuator pair. """
@@ -896,11 +1876,13 @@ class MatrixIntensityRST(PastisMatrixIntensities):
     def calculate_ref_image(self, save_coro_floor=False, save_psfs=False):
         """ Calculate the coronagraph floor, normalization factor from direct image, and get the simulator object. """
 
-        self.contrast_floor, self.norm, self.coro_simulator = calculate_unaberrated_contrast_and_normalization('RST',
-                                                                                                               return_coro_simulator=True,
-                                                                                                               save_coro_floor=save_coro_floor,
-                                                                                                               save_psfs=save_psfs,
-                                                                                                               outpath=self.overall_dir)
+        (self.contrast_floor, self.norm, self.coro_simulator,
+         self.reference_images) = calculate_unaberrated_contrast_and_normalization('RST',
+                                                                                   return_coro_simulator=True,
+                                                                                   save_coro_floor=save_coro_floor,
+                                                                                   save_psfs=save_psfs,
+                                                                                   outpath=self.overall_dir,
+                                                                                   return_reference_images=True)
 
 
 if __name__ == '__main__':
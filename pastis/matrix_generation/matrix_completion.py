@@ -0,0 +1,83 @@
+"""
+Fill in a PASTIS matrix of which only some elements have been measured.
+
+A PASTIS matrix is symmetric and positive semi-definite, and its eigenvalues usually drop quickly, so that a low-rank
+PSD matrix that agrees with the measured elements is a good estimate of the missing ones. The completion alternates
+between projecting onto the PSD matrices of a given rank, and resetting the measured elements to their measured values.
+"""
+
+import logging
+import numpy as np
+
+log = logging.getLogger()
+
+
+def low_rank_psd_projection(matrix, rank):
+    """
+    Closest positive semi-definite matrix of at most the given rank to a symmetric matrix.
+    :param matrix: ndarray, symmetric square matrix
+    :param rank: int, largest rank of the result
+    :return: ndarray, projected matrix
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(matrix)
+    eigenvalues = np.clip(eigenvalues[-rank:], 0, None)
+    eigenvectors = eigenvectors[:, -rank:]
+    return (eigenvectors * eigenvalues) @ eigenvectors.T
+
+
+def complete_psd_matrix(matrix, known, rank, max_iterations=1000, rtol=1e-10):
+    """
+    Fill in the unknown elements of a symmetric matrix with those of a low-rank PSD matrix that agrees with the known ones.
+    :param matrix: ndarray, symmetric square matrix; only the elements where "known" is True are used
+    :param known: bool ndarray of the same shape, symmetric, which elements are measured
+    :param rank: int, rank of the PSD matrix to fit
+    :param max_iterations: int, maximum number of alternating projections
+    :param rtol: float, stop once the matrix changes by less than this, relative to its norm, in one iteration
+    :return: ndarray, low-rank PSD estimate of the full matrix
+    """
+    estimate = np.where(known, matrix, 0)
+    for iteration in range(max_iterations):
+        low_rank = low_rank_psd_projection(estimate, rank)
+        new_estimate = np.where(known, matrix, low_rank)
+        change = np.linalg.norm(new_estimate - estimate)
+        estimate = new_estimate
+        if change <= rtol * np.linalg.norm(estimate):
+            break
+    log.info(f'Rank {rank} matrix completion stopped after {iteration + 1} iterations')
+    return low_rank
+
+
+def relative_rms_error(estimate, reference):
+    """ RMS of the difference between two arrays, relative to the RMS of the reference. """
+    return np.sqrt(np.mean(np.square(estimate - reference)) / np.mean(np.square(reference)))
+
+
+def choose_completion_rank(matrix, known, rng, validation_fraction=0.1, candidate_ranks=None):
+    """
+    Pick the completion rank that best predicts a random part of the known off-diagonal elements from the others.
+    :param matrix: ndarray, symmetric square matrix; only the elements where "known" is True are used
+    :param known: bool ndarray of the same shape, symmetric, which elements are measured
+    :param rng: numpy.random.Generator, to pick the validation elements
+    :param validation_fraction: float, fraction of the known off-diagonal element pairs to leave out for validation
+    :param candidate_ranks: list of int, ranks to try; powers of two up to the matrix size if None
+    :return: int, best rank
+    """
+    size = matrix.shape[0]
+    if candidate_ranks is None:
+        candidate_ranks = [2 ** power for power in range(int(np.log2(size)) + 1)] + [size]
+
+    seg_i, seg_j = np.nonzero(np.triu(known, k=1))
+    if seg_i.size < 2:
+        return candidate_ranks[0]
+    validation = rng.choice(seg_i.size, size=max(1, int(validation_fraction * seg_i.size)), replace=False)
+    training = known.copy()
+    training[seg_i[validation], seg_j[validation]] = False
+    training[seg_j[validation], seg_i[validation]] = False
+
+    errors = []
+    for rank in sorted(set(candidate_ranks)):
+        estimate = complete_psd_matrix(matrix, training, rank)
+        errors.append((relative_rms_error(estimate[seg_i[validation], seg_j[validation]],
+                                          matrix[seg_i[validation], seg_j[validation]]), rank))
+        log.info(f'Matrix completion with rank {rank}: relative validation error {errors[-1][0]}')
+    return min(errors)[1]
@@ -1,6 +1,7 @@
 import os
 import time
 import functools
+import itertools
 import logging
 import hcipy
 import matplotlib
@@ -8,10 +9,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from pastis.config import CONFIG_PASTIS
+from pastis.simulators.generic_segmented_telescopes import dm_surfaces
 from pastis.simulators.luvoir_imaging import LuvoirA_APLC
 from pastis.simulators.scda_telescopes import HexRingAPLC
 import pastis.simulators.webbpsf_imaging as webbpsf_imaging
-from pastis.matrix_generation.matrix_building_numerical import PastisMatrix
+from pastis.matrix_generation.matrix_building_numerical import (PastisMatrix, OPD_CUBE_NAME, create_worker_pool,
+                                                                get_process_split, log_progress, pool_preload_modules,
+                                                                set_math_threads)
+from pastis.matrix_generation.task_queue import FileTaskQueue, wait_for_queue
 import pastis.plotting as ppl
 import pastis.util as util
 
@@ -23,9 +28,16 @@ matplotlib.rc('pdf', fonttype=42)
 class PastisMatrixEfields(PastisMatrix):
     instrument = None
     """ Main class for PASTIS matrix calculations from individually 'poked' modes. """
+    # Attributes that are not sent to task queue workers, see __getstate__()
+    _worker_excluded_attributes = ['calculate_one_mode', 'calculate_mode_batch', 'efields_per_plane',
+                                   'efields_per_mode', 'efields_per_mode_wfs', 'streamed_matrix']
+    # File name prefix of rendered pupil surface maps, see render_opds()
+    opd_name_prefix = 'opd_mode'
+    # File name prefix of the saved science plane E-fields, see read_efield()
+    efield_name_prefix = 'focal'
 
     def __init__(self, nb_seg, seglist, calc_science, calc_wfs,
-                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True):
+                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True, resume_dir=None):
         """
         Parameters:
         ----------
@@ -39,68 +51,478 @@ class PastisMatrixEfields(PastisMatrix):
             Whether to calculate the Efields in the out-of-band Zernike WFS plane.
         initial_path: string
             Path to top-level directory where result folder should be saved to.
-        saveefields: bool
-            Whether to save E-fields both at focal and wfs plane as fits file to disk or not
+        saveefields: bool or str
+            Whether to save E-fields both at focal and wfs plane to disk or not. True writes fits files of the real and
+            imaginary part of each mode, 'cube' writes all modes of a plane into the memory-mappable complex cube
+            "efield_cube.npy" in the "efields" and "efields_wfs" folders, see create_efield_cubes(), which also makes
+            an interrupted calc() resumable.
         saveopds : bool
             Whether to save images of pair-wise aberrated pupils to disk or not
         norm_one_photon : bool
             Whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+        resume_dir : string or None
+            Path to the result folder of a finished run, to update it with update_segments(), or of an interrupted run
+            with saveefields='cube', to resume it with calc(). If None (default), start a new run.
         """
-        super().__init__(nb_seg=nb_seg, seglist=seglist, save_path=initial_path)
+        super().__init__(nb_seg=nb_seg, seglist=seglist, save_path=initial_path, resume_dir=resume_dir)
         self.calc_science = calc_science
         self.calc_wfs = calc_wfs
 
         self.save_efields = saveefields
         self.saveopds = saveopds
         self.calculate_one_mode = None
+        self.calculate_mode_batch = None
+        self.efields_per_plane = {}
         self.efields_per_mode = []
         self.efields_per_mode_wfs = []
+        self.streamed_matrix = None
         self.norm_one_photon = norm_one_photon
 
         os.makedirs(os.path.join(self.resDir, 'efields'), exist_ok=True)
         os.makedirs(os.path.join(self.resDir, 'efields_wfs'), exist_ok=True)
 
-    def calc(self):
-        """ Main method that calculates the PASTIS matrix """
+    def calc(self, distributed=False, streaming=False, dh_zones=None):
+        """ Main method that calculates the PASTIS matrix
+
+        :param distributed: bool, if True, distribute the modes through a task queue in the result folder to workers
+                            started on any number of machines, see calculate_efields()
+        :param streaming: bool, if True, fill the PASTIS matrix while the E-fields of the modes arrive, keeping only
+                          their dark hole pixels instead of the full science plane E-fields, see calculate_efields()
+        :param dh_zones: dict or None, masks of parts of the dark hole keyed by name, to calculate a PASTIS matrix for
+                         each of them from the same E-fields, see calculate_zone_matrices()
+        """
 
         start_time = time.time()
 
         self.calculate_ref_efield()
-        self.calculate_ref_efield_wfs()
+        if self.save_efields and self.calc_science:
+            self.save_reference_efield()
+        if self.calc_wfs:
+            self.calculate_ref_efield_wfs()
         self.setup_deformable_mirror()
         self.setup_single_mode_function()
-        self.calculate_efields()
+        self.calculate_efields(distributed=distributed, streaming=streaming and self.calc_science)
         if self.calc_science:
             self.calculate_pastis_matrix_from_efields()
+            if dh_zones:
+                self.calculate_zone_matrices(dh_zones)
 
         end_time = time.time()
         log.info(
             f'Runtime for {self.__class__.__name__}.calc(): {end_time - start_time}sec = {(end_time - start_time) / 60}min')
         log.info(f'Data saved to {self.resDir}')
 
-    def calculate_efields(self):
-        """ Poke each mode individually and calculate the resulting focal plane E-field. """
+    def update_segments(self, segments, distributed=False):
+        """ Recalculate only the modes on some segments, after their model changed, on top of a finished run.
+
+        This object needs to have been created with the result folder of a finished run as "resume_dir", which must have
+        saved its science plane E-fields. The reference E-field is calculated again with the current model, and all
+        modes on the given segments are recalculated; the E-fields of all other modes are read from the original run,
+        and are moved onto the new reference E-field, which leaves their PASTIS matrix elements unchanged. The result is
+        written as a new matrix version next to the original one, e.g. "pastis_matrix_v2.fits", and the updated
+        segments are recorded in "matrix_versions.txt".
+        Each update starts from the original run; to combine several changes, pass all of their segments at once. Only
+        the science plane is calculated, and no E-fields or OPDs are saved, so that those of the original run stay
+        untouched.
+        :param segments: iterable of int, matrix indices of the segments whose model changed, 0-indexed
+        :param distributed: bool, whether to use the file system task queue instead of calculating the modes here
+        """
+        segments = {int(segment) for segment in segments}
+        self.matrix_version = self.next_matrix_version()
+        self.calc_science = True
+        self.calc_wfs = False
+        self.save_efields = False
+        self.saveopds = False
+
+        self.calculate_ref_efield()
+        self.setup_deformable_mirror()
+        self.setup_single_mode_function()
+        modes = self.modes_of_segments(segments)
+        log.info(f'Updating segments {sorted(segments)} ({len(modes)} modes) as matrix version {self.matrix_version}')
+
+        efield_shape = np.shape(self.efield_ref)
+        original_efield_ref = self.read_efield('ref').reshape(efield_shape)
+        original_efields = np.array([self.read_efield(mode_no).reshape(efield_shape)
+                                     for mode_no in range(self.number_all_modes)])
+        self.calculate_efields(distributed=distributed, modes=modes)
+
+        updated_efields = original_efields - original_efield_ref + self.efield_ref
+        updated_efields[modes] = self.efields_per_mode
+        self.efields_per_mode = updated_efields
+        self.calculate_pastis_matrix_from_efields()
+        self.record_matrix_version(segments)
+
+    def modes_of_segments(self, segments):
+        """ Return the sorted list of mode indices that act on the given segments (0-indexed). """
+        raise NotImplementedError()
+
+    def save_reference_efield(self):
+        """ Save the reference science plane E-field next to the single-mode E-fields, to be read by read_efield(). """
+        for part, values in [('real', self.efield_ref.real), ('imag', self.efield_ref.imag)]:
+            hcipy.write_fits(values, os.path.join(self.resDir, 'efields', f'{self.efield_name_prefix}_{part}_ref.fits'))
 
-        for i in range(self.number_all_modes):
-            efields = self.calculate_one_mode(i)
-            if self.calc_science:
-                self.efields_per_mode.append(efields['efield_science_plane'])
+    def read_efield(self, mode_no):
+        """ Read a saved science plane E-field.
+
+        :param mode_no: int, mode index, or 'ref' for the reference E-field
+        :return: complex ndarray, in the shape it was saved in
+        """
+        cube_path = os.path.join(self.resDir, 'efields', EFIELD_CUBE_NAME)
+        if mode_no != 'ref' and os.path.isfile(cube_path):
+            return np.array(util.read_frame_cube(cube_path)[0][mode_no])
+
+        label = 'ref' if mode_no == 'ref' else f'mode{mode_no}'
+        real = hcipy.read_fits(os.path.join(self.resDir, 'efields', f'{self.efield_name_prefix}_real_{label}.fits'))
+        imag = hcipy.read_fits(os.path.join(self.resDir, 'efields', f'{self.efield_name_prefix}_imag_{label}.fits'))
+        return real + 1j * imag
+
+    def calculate_efields(self, distributed=False, modes=None, streaming=False):
+        """ Poke each mode individually and calculate the resulting focal plane E-field.
+
+        The modes are distributed over a multiprocessing pool on this machine, with the number of processes and threads
+        per process set by "num_processes" and "threads_per_process" in the configfile, where "auto" uses one process
+        per CPU core; with a single process, the modes are calculated here. The pool workers write their E-fields
+        straight into shared memory, see _calculate_modes_in_pool(). With saveefields='cube', they are written into the
+        E-field cubes on disk instead, and only the modes that are not done yet get calculated, see
+        _calculate_modes_into_cubes().
+        If "distributed" is True, the modes are put into the directory "task_queue" in the result folder and this
+        method waits until they are all done; the work is done by workers that need to be started separately, on any
+        machine that sees the result folder, with:
+            python pastis/launchers/run_queue_worker.py <resDir>/task_queue
+        Each pool or queue worker sets up its own copy of the simulator with self.setup_worker().
+        With "streaming", the science plane E-fields are not kept: the PASTIS matrix is filled from their dark hole
+        pixels while they arrive, see _stream_modes().
+        :param distributed: bool, whether to use the file system task queue instead of calculating the modes here
+        :param modes: list of int, modes to calculate, in the order their E-fields get stored; all modes if None
+        :param streaming: bool, whether to fill the PASTIS matrix while the modes get calculated
+        """
+        if modes is None:
+            modes = list(range(self.number_all_modes))
+        if streaming and (distributed or self.save_efields == 'cube'):
+            raise ValueError('Streaming the PASTIS matrix is only possible for modes calculated on this machine, '
+                             'without E-field cubes, whose matrix is calculated from the cubes on disk instead.')
+        self.streamed_matrix = None
+
+        # Preallocate the cube that the pupil surface maps of all modes get stored in, unless a run with E-field cubes
+        # gets resumed, which keeps the pupil surface maps of the modes that are done already
+        resuming = (self.save_efields == 'cube'
+                    and os.path.isfile(os.path.join(self.resDir, 'efields', EFIELD_PROGRESS_NAME))
+                    and os.path.isfile(os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME)))
+        if self.saveopds and not resuming:
+            self.create_opd_cube()
+
+        if self.save_efields == 'cube':
+            self._calculate_modes_into_cubes(modes, distributed)
+            return
+        if streaming:
+            self._stream_modes(modes)
+            return
+
+        if distributed:
+            all_efields = self._calculate_modes_in_task_queue(modes)
+        else:
+            num_processes, num_threads = get_process_split(None, [], self.instrument)
+            if num_processes > 1 and len(modes) > 1:
+                self._calculate_modes_in_pool(modes, min(num_processes, len(modes)), num_threads)
+                return
+            all_efields = self._calculate_modes_here(modes)
+
+        # Each E-field goes straight to its place in a preallocated array, instead of being copied once more at the end
+        self.efields_per_plane = {plane: np.array([]) for plane in self.plane_references()}
+        for index, efields in enumerate(all_efields):
+            for plane, plane_efields in self.efields_per_plane.items():
+                self.efields_per_plane[plane] = store_efield(plane_efields, index, len(modes), efields[plane])
+        self.efields_per_mode = self.efields_per_plane.get('efield_science_plane', np.array([]))
+        self.efields_per_mode_wfs = self.efields_per_plane.get('efield_wfs_plane', np.array([]))
+
+    def mode_dh_vectors(self, frames_per_tile=64):
+        """ Return the dark hole vectors of the science plane E-fields from the last calculate_efields(), in the order of
+        the modes, see dh_difference_vectors(). E-field cubes are read a few frames at a time.
+
+        :param frames_per_tile: int, number of E-fields to gather at once
+        """
+        if self.streamed_matrix is not None:
+            return self.streamed_matrix.ordered_dh_vectors()
+        in_dh = np.asarray(self.dh_mask).ravel() != 0
+        vectors = np.empty((len(self.efields_per_mode), 2 * np.count_nonzero(in_dh)))
+        for start in range(0, len(self.efields_per_mode), frames_per_tile):
+            vectors[start:start + frames_per_tile] = dh_difference_vectors(
+                self.efields_per_mode[start:start + frames_per_tile], self.efield_ref, in_dh)
+        return vectors
+
+    def create_efield_cubes(self):
+        """ Preallocate the E-field cubes and their progress bitmap, for saveefields='cube'.
+
+        For each calculated plane, the cube "efield_cube.npy" in the "efields" or "efields_wfs" folder holds one frame
+        per mode, in the shape of the reference E-field of the plane, with the mode number as frame number. The
+        single-mode function writes the E-fields of a mode into the cubes, and then marks the mode as done in the
+        bitmap "efields/efield_cube_progress.npy".
+        """
+        for plane, reference in self.plane_references().items():
+            util.create_frame_cube(os.path.join(self.efield_dir(plane), EFIELD_CUBE_NAME),
+                                   list(range(self.number_all_modes)), np.shape(reference),
+                                   dtype=np.asarray(reference).dtype)
+        progress = np.lib.format.open_memmap(os.path.join(self.resDir, 'efields', EFIELD_PROGRESS_NAME), mode='w+',
+                                             dtype=bool, shape=(self.number_all_modes,))
+        progress.flush()
+
+    def efield_dir(self, plane):
+        """ Return the folder that the E-fields of a plane are saved in, for a key of plane_references(). """
+        return os.path.join(self.resDir, EFIELD_DIRS[plane])
+
+    def plane_references(self):
+        """ Return the reference E-field of each calculated plane, keyed like the E-field dicts of the single modes. """
+        references = {}
+        if self.calc_science:
+            references['efield_science_plane'] = self.efield_ref
+        if self.calc_wfs:
+            references['efield_wfs_plane'] = getattr(self.efield_ref_wfs, 'electric_field', self.efield_ref_wfs)
+        return references
+
+    def _calculate_modes_into_cubes(self, modes, distributed):
+        """ Calculate the modes that are not marked as done in the progress bitmap of the E-field cubes, and open the
+        cubes as read-only memory maps in self.efields_per_mode and self.efields_per_mode_wfs.
+
+        The cubes are created first, unless they exist from an interrupted run already. The memory maps do not load the
+        cubes, frames are only read from disk when they are used.
+
+        :param modes: list of int, modes to calculate
+        :param distributed: bool, whether to use the file system task queue instead of calculating the modes here
+        """
+        progress_path = os.path.join(self.resDir, 'efields', EFIELD_PROGRESS_NAME)
+        if not os.path.isfile(progress_path):
+            self.create_efield_cubes()
+        done = np.load(progress_path)
+        missing_modes = [mode_no for mode_no in modes if not done[mode_no]]
+        log.info(f'{len(modes) - len(missing_modes)} modes read from the E-field cubes, '
+                 f'{len(missing_modes)} modes left to calculate')
+
+        if distributed and missing_modes:
+            for _mode_no in self._calculate_modes_in_task_queue(missing_modes, _calculate_one_mode_without_result):
+                pass
+        elif missing_modes:
+            num_processes, num_threads = get_process_split(None, [], self.instrument)
+            if num_processes > 1 and len(missing_modes) > 1:
+                self._run_in_mode_pool(_calculate_one_mode_without_result, missing_modes,
+                                       min(num_processes, len(missing_modes)), num_threads)
+            else:
+                for _efields in self._calculate_modes_here(missing_modes):
+                    pass
+
+        cubes = {plane: util.read_frame_cube(os.path.join(self.efield_dir(plane), EFIELD_CUBE_NAME))[0]
+                 for plane in self.plane_references()}
+        if list(modes) != list(range(self.number_all_modes)):
+            cubes = {plane: cube[modes] for plane, cube in cubes.items()}
+        self.efields_per_plane = cubes
+        self.efields_per_mode = cubes.get('efield_science_plane', np.array([]))
+        self.efields_per_mode_wfs = cubes.get('efield_wfs_plane', np.array([]))
+
+    def _stream_modes(self, modes):
+        """ Calculate modes and fill the PASTIS matrix from their dark hole pixels as they arrive, in self.streamed_matrix.
+
+        Only the dark hole vectors of the science plane E-fields are kept, see IncrementalPastisMatrix; with a pool,
+        the workers only send those back. Matrix assembly overlaps with the propagation of the next modes, and the
+        memory for the E-fields shrinks by the fraction of the focal plane outside of the dark hole.
+        WFS plane E-fields are still stored as full frames in self.efields_per_mode_wfs.
+        :param modes: list of int, modes to calculate, in the order of the matrix rows
+        """
+        self.streamed_matrix = IncrementalPastisMatrix(len(modes), self.efield_ref, self.norm, self.dh_mask)
+        self.efields_per_mode = np.array([])
+        self.efields_per_mode_wfs = np.array([])
+
+        def add_mode(index, dh_vector, efield_wfs):
+            self.streamed_matrix.add_mode(index, dh_vector)
             if self.calc_wfs:
-                self.efields_per_mode_wfs.append(efields['efield_wfs_plane'])
-        self.efields_per_mode = np.array(self.efields_per_mode)
-        self.efields_per_mode_wfs = np.array(self.efields_per_mode_wfs)
+                self.efields_per_mode_wfs = store_efield(self.efields_per_mode_wfs, index, len(modes), efield_wfs)
+
+        num_processes, num_threads = get_process_split(None, [], self.instrument)
+        if num_processes > 1 and len(modes) > 1:
+            self._run_in_mode_pool(_calculate_one_mode_dh_vector, list(enumerate(modes)),
+                                   min(num_processes, len(modes)), num_threads,
+                                   result_callback=lambda result: add_mode(*result))
+        else:
+            for index, efields in enumerate(self._calculate_modes_here(modes)):
+                dh_vector = self.streamed_matrix.dh_vector(efields['efield_science_plane'])
+                add_mode(index, dh_vector, efields.get('efield_wfs_plane') if self.calc_wfs else None)
+
+    def _calculate_modes_here(self, modes):
+        """ Calculate modes in this process and return an iterator over their E-field dicts, in the order of "modes".
+
+        If the subclass sets up self.calculate_mode_batch, the modes are propagated in stacks with it, otherwise one at
+        a time with self.calculate_one_mode.
+        :param modes: list of int, modes to calculate
+        """
+        if self.calculate_mode_batch is not None:
+            return self.calculate_mode_batch(modes)
+        return (self.calculate_one_mode(mode_no) for mode_no in modes)
+
+    def _calculate_modes_in_pool(self, modes, num_processes, num_threads):
+        """ Calculate modes with a multiprocessing pool, and store their E-fields in the order of "modes".
+
+        The E-field arrays are allocated in shared memory, with the shape of the reference E-fields, and each worker
+        writes the E-fields of its modes into them at the position of the mode; only the mode numbers are sent back.
+        The arrays are kept as self.efields_per_mode and self.efields_per_mode_wfs afterwards, without being copied, and
+        in self.efields_per_plane, keyed by plane.
+
+        :param modes: list of int, modes to calculate
+        :param num_processes: int, number of worker processes
+        :param num_threads: int, number of BLAS/FFT threads in each worker process
+        """
+        references = self.plane_references()
+        array_names = {plane: util.shared_array_name(os.path.join(self.resDir, plane)) for plane in references}
+        for plane, reference in references.items():
+            util.create_shared_array(array_names[plane], (len(modes),) + np.shape(reference),
+                                     dtype=np.asarray(reference).dtype)
+
+        calculate_mode = functools.partial(_calculate_one_mode_into_shared_arrays, array_names)
+        try:
+            self._run_in_mode_pool(calculate_mode, list(enumerate(modes)), num_processes, num_threads)
+        except BaseException:
+            for name in array_names.values():
+                util.release_shared_array(name)
+            raise
+
+        arrays = {plane: util.detach_shared_array(name) for plane, name in array_names.items()}
+        self.efields_per_plane = arrays
+        self.efields_per_mode = arrays.get('efield_science_plane', np.array([]))
+        self.efields_per_mode_wfs = arrays.get('efield_wfs_plane', np.array([]))
+
+    def _run_in_mode_pool(self, mode_function, tasks, num_processes, num_threads, result_callback=None):
+        """ Run a pool function on all tasks in a multiprocessing pool, whose workers each set up their own simulator
+        with self.setup_worker().
+
+        :param mode_function: function of one task, e.g. _calculate_one_mode_without_result()
+        :param tasks: list of tasks, one per mode
+        :param num_processes: int, number of worker processes
+        :param num_threads: int, number of BLAS/FFT threads in each worker process
+        :param result_callback: function that gets called with each result of mode_function as it arrives, or None
+        """
+        preload_modules = pool_preload_modules(self.instrument) + ['pastis.matrix_generation.matrix_from_efields']
+        pool = create_worker_pool(num_processes, num_threads, preload_modules,
+                                  initializer=_init_efield_worker, initargs=(self, num_threads))
+        log.info(f'Calculating {len(tasks)} modes with {num_processes} processes '
+                 f'(with {num_threads} threads per process)')
+        t_start = time.time()
+        try:
+            for num_done, result in enumerate(pool.imap_unordered(mode_function, tasks), start=1):
+                if result_callback is not None:
+                    result_callback(result)
+                log_progress(num_done, len(tasks), t_start, unit='modes')
+            pool.close()
+            pool.join()
+        except BaseException:
+            pool.terminate()
+            raise
+
+    def _calculate_modes_in_task_queue(self, modes, mode_function=None):
+        """ Calculate modes through the file system task queue and return their results in the order of "modes".
+
+        :param modes: list of int, modes to calculate
+        :param mode_function: function of the mode number that the workers call; _calculate_one_mode_in_worker() if None,
+                              which returns the E-field dicts
+        """
+        if mode_function is None:
+            mode_function = _calculate_one_mode_in_worker
+
+        queue = FileTaskQueue(os.path.join(self.resDir, self.versioned_name('task_queue')))
+        queue.submit(mode_function, list(modes),
+                     initializer=_init_efield_worker, initargs=(self,))
+        log.info(f'Waiting for workers, start them with: python pastis/launchers/run_queue_worker.py {queue.queue_dir}')
+
+        t_start = time.time()
+        wait_for_queue(queue, progress_function=lambda num_done, num_total: log_progress(num_done, num_total, t_start,
+                                                                                         num_reports=num_total,
+                                                                                         unit='modes'))
+        return queue.results()
+
+    def __getstate__(self):
+        """ Leave out the simulator and the collected E-fields when the object gets pickled to be sent to a worker;
+        the worker creates its own simulator in setup_worker(). """
+        state = self.__dict__.copy()
+        for attribute in self._worker_excluded_attributes:
+            state.pop(attribute, None)
+        return state
+
+    def setup_worker(self):
+        """ Recreate the simulator and self.calculate_one_mode in a worker process, on a copy of this object that was
+        unpickled there. """
+        raise NotImplementedError()
+
+    def create_opd_cube(self):
+        """ Preallocate the cube that the single-mode function stores the pupil surface maps in, if saveopds is True. """
+        raise NotImplementedError()
+
+    def render_opds(self, modes=None, num_processes=None, file_format='pdf'):
+        """ Render the stored pupil surface maps of the modes to image files in the "OTE_images" folder.
+
+        :param modes: list of int, modes to render; renders all modes if None
+        :param num_processes: int, number of processes to render with; uses all CPU cores if None
+        :param file_format: str, image file extension, e.g. 'pdf' or 'png'
+        """
+        ppl.render_opd_cube(os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME),
+                            os.path.join(self.resDir, 'OTE_images'), frame_numbers=modes,
+                            name_prefix=self.opd_name_prefix, num_processes=num_processes, file_format=file_format)
 
     def calculate_pastis_matrix_from_efields(self):
         """ Use the individual-mode E-fields to calculate the PASTIS matrix from it. """
 
-        self.matrix_pastis = pastis_matrix_from_efields(self.efields_per_mode, self.efield_ref, self.norm, self.dh_mask, self.wfe_aber)
+        filename_matrix = self.versioned_name('pastis_matrix')
+        if self.streamed_matrix is not None:
+            # The matrix was filled while the modes were calculated
+            self.matrix_pastis = self.streamed_matrix.matrix / np.square(self.wfe_aber * 1e9)
+        elif self.save_efields == 'cube':
+            # The E-fields are memory maps of the cubes on disk, which are only read in tiles
+            self.matrix_pastis = pastis_matrix_from_efield_cube(self.efields_per_mode, self.efield_ref, self.norm,
+                                                                self.dh_mask, self.wfe_aber,
+                                                                os.path.join(self.resDir, filename_matrix + '.npy'))
+        else:
+            self.matrix_pastis = pastis_matrix_from_efields(self.efields_per_mode, self.efield_ref, self.norm, self.dh_mask, self.wfe_aber)
 
         # Save matrix to file
-        filename_matrix = f'pastis_matrix'
         hcipy.write_fits(self.matrix_pastis, os.path.join(self.resDir, filename_matrix + '.fits'))
-        ppl.plot_pastis_matrix(self.matrix_pastis, self.wvln * 1e9, out_dir=self.resDir, save=True)  # convert wavelength to nm
+        ppl.plot_pastis_matrix(self.matrix_pastis, self.wvln * 1e9, out_dir=self.resDir,
+                               fname_suffix=self.versioned_name('')[1:], save=True)  # convert wavelength to nm
         log.info(f'PASTIS matrix saved to: {os.path.join(self.resDir, filename_matrix + ".fits")}')
 
+    def calculate_zone_matrices(self, dh_zones):
+        """ Calculate a PASTIS matrix for each of several parts of the dark hole, from the E-fields of the last
+        calculate_efields(), without any further propagation.
+
+        Each zone is a mask of the shape of the reference E-field within the dark hole, like a radial annulus or one
+        half of the dark hole, and can be weighted like the dark hole mask. The matrix of a zone is the PASTIS matrix of
+        the mean contrast in that zone. It is written to "pastis_matrix_<name>.fits" in the result folder, together
+        with the zone mask "dh_zone_<name>_mask.npy", like save_dh_zone_matrices() does for intensity matrices, and
+        kept in self.zone_matrices, keyed by name.
+        :param dh_zones: dict, masks of the zones keyed by zone name
+        """
+        in_dh = np.asarray(self.dh_mask).ravel() != 0
+        dh_vectors = self.mode_dh_vectors()
+        self.zone_matrices = {}
+        for name, zone in dh_zones.items():
+            zone = np.asarray(zone).ravel()
+            if zone.size != in_dh.size:
+                raise ValueError(f'The zone "{name}" has {zone.size} pixels, but the E-fields have {in_dh.size}.')
+            if np.any((zone != 0) & ~in_dh):
+                raise ValueError(f'The zone "{name}" contains pixels outside of the dark hole, which were not kept.')
+            zone_dh = zone[in_dh]
+            if not np.any(zone_dh):
+                raise ValueError(f'The zone "{name}" does not contain any pixels.')
+
+            # The zone is a selection of the dark hole pixels, in the real and in the imaginary half of the vectors
+            columns = np.tile(zone_dh != 0, 2)
+            zone_vectors = dh_vectors[:, columns]
+            matrix_pastis = pastis_cross_matrix(zone_vectors, zone_vectors, self.norm, zone_dh, self.wfe_aber)
+            matrix_pastis = util.symmetrize(np.triu(matrix_pastis))
+            self.zone_matrices[name] = matrix_pastis
+
+            filename_matrix = self.versioned_name(f'pastis_matrix_{name}')
+            hcipy.write_fits(matrix_pastis, os.path.join(self.resDir, filename_matrix + '.fits'))
+            np.save(os.path.join(self.resDir, f'dh_zone_{name}_mask.npy'), zone)
+            ppl.plot_pastis_matrix(matrix_pastis, self.wvln * 1e9, out_dir=self.resDir,
+                                   fname_suffix=filename_matrix[len('pastis_matrix_'):], save=True)
+            log.info(f'PASTIS matrix of dark hole zone "{name}" saved to: '
+                     f'{os.path.join(self.resDir, filename_matrix + ".fits")}')
+
     def calculate_ref_efield(self):
         """ Create the attributes self.norm, self.dh_mask, self.coro_simulator and self.efield_ref. """
         raise NotImplementedError()
@@ -119,6 +541,22 @@ class PastisMatrixEfields(PastisMatrix):
         raise NotImplementedError()
 
 
+def store_efield(efields, index, num_modes, efield):
+    """
+    Write the E-field of one mode into the array of all E-fields, which is allocated when the first E-field arrives.
+    :param efields: ndarray, E-fields collected so far, in the order of the modes; an empty array before the first one
+    :param index: int, position of the mode in the array
+    :param num_modes: int, number of modes the array holds
+    :param efield: array, hcipy.Field or hcipy.Wavefront, E-field of the mode
+    :return: ndarray, the array of all E-fields
+    """
+    efield = getattr(efield, 'electric_field', efield)
+    if efields.size == 0:
+        efields = np.empty((num_modes,) + np.shape(efield), dtype=np.asarray(efield).dtype)
+    efields[index] = efield
+    return efields
+
+
 def pastis_matrix_from_efields(electric_fields, efield_ref, direct_norm, dh_mask, wfe_aber):
     """ Calculate the semi-analytical PASTIS matrix from the individual E-fields
     :param electric_fields: list, items of same type as "efield_ref", individually poked mode E-fields
@@ -148,30 +586,209 @@ def calculate_semi_analytic_pastis_from_efields(efields, efield_ref, direct_norm
     This function calculates the elements of the (half !) PASTIS matrix from the E-field responses of the individually
     poked modes, in which the reference E-field has not been subtracted yet. The calculation is only performed on the
     half-PASTIS matrix, so it will need to be symmetrized after this step.
-    :param efields: list, items of same type as "efield_ref", individually poked mode E-fields
-    :param efield_ref: same type as items in "efields", reference E-field of an unaberrated system
+    Element (i, j) is the dark hole mean of Re((E_i - E_ref) * conj(E_j - E_ref)) / direct_norm, like util.dh_mean()
+    applied to that image. All elements are calculated at once: the differences to the reference E-field are gathered
+    on the dark hole pixels only, with real and imaginary parts side by side, into one real matrix G of shape
+    (number of modes, 2 * number of dark hole pixels), and Re((E_i - E_ref) (E_j - E_ref)^H) summed over the dark hole
+    is then the single matrix product G G^T.
+    :param efields: array, individually poked mode E-fields, stacked along the first axis, each of the same shape as
+                    "efield_ref"
+    :param efield_ref: array or Field, reference E-field of an unaberrated system
     :param direct_norm: float, normalization factor - peak pixel of a direct PSF
     :param dh_mask: array, dark hole mask
     :return: half-PASTIS matrix, where one of its matrix triangles will be all zeros
     """
-
-    # Create empty matrix
     nb_modes = efields.shape[0]
-    matrix_pastis_half = np.zeros([nb_modes, nb_modes])
+    dh_mask = np.asarray(dh_mask).ravel()
+    in_dh = dh_mask != 0
+    weights = dh_mask[in_dh]
+    log.info(f'Calculating PASTIS matrix of {nb_modes} modes on {np.count_nonzero(in_dh)} dark hole pixels')
+
+    stacked = dh_difference_vectors(efields, efield_ref, in_dh)
+    weighted = stacked if np.all(weights == 1) else stacked * np.tile(weights, 2)
+    matrix_pastis = weighted @ stacked.T / (direct_norm * weights.size)
+
+    return np.triu(matrix_pastis)
+
+
+def dh_difference_vectors(efields, efield_ref, in_dh):
+    """
+    Gather the differences of E-fields to the reference E-field on the dark hole pixels, as real vectors.
+    :param efields: array, E-fields stacked along the first axis, each of the same shape as "efield_ref"
+    :param efield_ref: array or Field, reference E-field of an unaberrated system
+    :param in_dh: boolean array, the dark hole pixels of the flattened E-fields
+    :return: ndarray of shape (number of E-fields, 2 * number of dark hole pixels), with the real parts of the
+             differences followed by their imaginary parts
+    """
+    differences = np.asarray(efields).reshape(-1, in_dh.size)[:, in_dh] - np.asarray(efield_ref).ravel()[in_dh]
+    return np.concatenate([differences.real, differences.imag], axis=1)
+
+
+class IncrementalPastisMatrix:
+    """ Fill the semi-analytical (unnormalized) PASTIS matrix one mode at a time, from the dark hole pixels only.
+
+    Each mode is added as its vector of dark hole differences to the reference E-field, see dh_difference_vectors(),
+    which is dotted with the vectors of all modes added before to fill its row and column of the matrix. This gives
+    the same matrix as calculate_semi_analytic_pastis_from_efields(), symmetrized, but only the dark hole vectors are
+    kept and the modes can arrive in any order.
+
+    Parameters:
+    ----------
+    nb_modes : int
+        Number of modes, the size of the matrix
+    efield_ref : array or Field
+        Reference E-field of an unaberrated system
+    direct_norm : float
+        Normalization factor - peak pixel of a direct PSF
+    dh_mask : array
+        Dark hole mask, which can be weighted
+
+    Attributes:
+    ----------
+    matrix : ndarray
+        Matrix of the modes added so far, in contrast; divide by the squared calibration aberration in nm for the
+        PASTIS matrix
+    """
+    def __init__(self, nb_modes, efield_ref, direct_norm, dh_mask):
+        dh_mask = np.asarray(dh_mask).ravel()
+        self.in_dh = dh_mask != 0
+        self.efield_ref = efield_ref
+        self.weights = np.tile(dh_mask[self.in_dh], 2)
+        self.normalization = direct_norm * np.count_nonzero(self.in_dh)
+        self.matrix = np.zeros((nb_modes, nb_modes))
+
+        # The vectors are kept in the order they arrive in, so that the ones to dot with are a contiguous block
+        self.dh_vectors = np.empty((nb_modes, self.weights.size))
+        self.arrived_modes = np.empty(nb_modes, dtype=int)
+        self.num_arrived = 0
+
+    def dh_vector(self, efield):
+        """ Return the dark hole vector of one E-field, to be passed to add_mode(). """
+        return dh_difference_vectors(getattr(efield, 'electric_field', efield), self.efield_ref, self.in_dh)[0]
+
+    def ordered_dh_vectors(self):
+        """ Return the dark hole vectors of the modes added so far, in the order of their positions in the matrix. """
+        order = np.argsort(self.arrived_modes[:self.num_arrived])
+        return self.dh_vectors[:self.num_arrived][order]
+
+    def add_mode(self, index, dh_vector):
+        """
+        Add a mode and fill its row and column of the matrix.
+        :param index: int, position of the mode in the matrix
+        :param dh_vector: ndarray, dark hole vector of the mode, see dh_vector()
+        """
+        self.dh_vectors[self.num_arrived] = dh_vector
+        self.arrived_modes[self.num_arrived] = index
+        self.num_arrived += 1
 
-    for pair in util.segment_pairs_non_repeating(nb_modes):
-        intensity_im = np.real((efields[pair[0]] - efield_ref) * np.conj(efields[pair[1]] - efield_ref))
-        contrast = util.dh_mean(intensity_im / direct_norm, dh_mask)
-        matrix_pastis_half[pair[0], pair[1]] = contrast
-        log.info(f'Calculated contrast for pair {pair[0]}-{pair[1]}: {contrast}')
+        arrived = self.arrived_modes[:self.num_arrived]
+        row = self.dh_vectors[:self.num_arrived] @ (dh_vector * self.weights) / self.normalization
+        self.matrix[index, arrived] = row
+        self.matrix[arrived, index] = row
+
+
+def pastis_cross_matrix(dh_vectors_rows, dh_vectors_columns, direct_norm, dh_mask, wfe_aber):
+    """
+    Calculate the PASTIS matrix block that couples two sets of modes, e.g. those of two different DMs.
+
+    Element (i, j) is the dark hole mean of Re((E_i - E_ref) * conj(E_j - E_ref)) / direct_norm of mode i of the first
+    and mode j of the second set, normalized by the calibration aberration like the PASTIS matrix. Both sets need to
+    have been calculated with the same reference E-field and dark hole.
+    :param dh_vectors_rows: ndarray, dark hole vectors of the modes of the rows, see dh_difference_vectors()
+    :param dh_vectors_columns: ndarray, dark hole vectors of the modes of the columns
+    :param direct_norm: float, normalization factor - peak pixel of a direct PSF
+    :param dh_mask: array, dark hole mask, which can be weighted
+    :param wfe_aber: float, calibration aberration in meters
+    :return: ndarray of shape (number of row modes, number of column modes), in contrast per nm^2
+    """
+    dh_mask = np.asarray(dh_mask).ravel()
+    weights = np.tile(dh_mask[dh_mask != 0], 2)
+    block = dh_vectors_rows @ (dh_vectors_columns * weights).T
+    return block / (float(direct_norm) * np.count_nonzero(dh_mask) * np.square(wfe_aber * 1e9))
+
+
+def pastis_matrix_from_efield_cube(efields, efield_ref, direct_norm, dh_mask, wfe_aber, matrix_path,
+                                   memory_budget=None):
+    """
+    Calculate the semi-analytical PASTIS matrix block by block, for E-field stacks that do not fit into memory.
+
+    The result is the same as from pastis_matrix_from_efields(), but the E-fields are only read in tiles of modes, e.g.
+    from the memory-mapped cube of a run with saveefields='cube', and the matrix is written into a memory-mapped .npy
+    file. First, the matrix G of calculate_semi_analytic_pastis_from_efields(), with the dark hole differences to the
+    reference E-field of all modes, is gathered into a temporary memory map next to the matrix file, which is much
+    smaller than the E-fields and can be read contiguously. Then each block of G G^T is calculated from two tiles of G
+    and written to both sides of the diagonal.
+    :param efields: array or memmap, individually poked mode E-fields, stacked along the first axis, each of the same
+                    shape as "efield_ref"
+    :param efield_ref: array or Field, reference E-field of an unaberrated system
+    :param direct_norm: float, normalization factor - peak pixel of a direct PSF
+    :param dh_mask: array, dark hole mask
+    :param wfe_aber: float, calibration aberration in meters
+    :param matrix_path: str, path of the .npy file to write the PASTIS matrix to
+    :param memory_budget: float, memory in bytes for the tiles that are held at once; "matrix_memory_gb" from the
+                          configfile if None
+    :return: full, normalized PASTIS matrix, as read-only memmap of "matrix_path"
+    """
+    if memory_budget is None:
+        memory_budget = CONFIG_PASTIS.getfloat('numerical', 'matrix_memory_gb', fallback=4) * 1e9
+    nb_modes = efields.shape[0]
+    dh_mask = np.asarray(dh_mask).ravel()
+    in_dh = dh_mask != 0
+    weights = np.tile(dh_mask[in_dh], 2)
+
+    # Gather the dark hole differences of all modes, reading a few E-fields at a time
+    frames_per_tile = max(1, int(memory_budget // (3 * np.dtype(complex).itemsize * dh_mask.size)))
+    differences_path = os.path.splitext(matrix_path)[0] + '_dh_differences.npy'
+    differences = np.lib.format.open_memmap(differences_path, mode='w+', dtype=np.float64,
+                                            shape=(nb_modes, weights.size))
+    for start in range(0, nb_modes, frames_per_tile):
+        differences[start:start + frames_per_tile] = dh_difference_vectors(efields[start:start + frames_per_tile],
+                                                                           efield_ref, in_dh)
+    differences.flush()
+
+    # Two tiles of G and one block of the matrix are held at once
+    tile_size = gram_tile_size(weights.size, memory_budget)
+    log.info(f'Calculating PASTIS matrix of {nb_modes} modes on {np.count_nonzero(in_dh)} dark hole pixels, '
+             f'in blocks of {tile_size} modes')
+    normalization = direct_norm * in_dh.sum() * np.square(wfe_aber * 1e9)
+    matrix_pastis = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float64, shape=(nb_modes, nb_modes))
+    for row_start in range(0, nb_modes, tile_size):
+        rows = slice(row_start, row_start + tile_size)
+        weighted = np.asarray(differences[rows]) * weights
+        for col_start in range(row_start, nb_modes, tile_size):
+            cols = slice(col_start, col_start + tile_size)
+            block = weighted @ np.asarray(differences[cols]).T / normalization
+            if col_start == row_start:
+                block = util.symmetrize(np.triu(block))
+            matrix_pastis[rows, cols] = block
+            matrix_pastis[cols, rows] = block.T
+    matrix_pastis.flush()
+
+    del matrix_pastis, differences
+    os.remove(differences_path)
+    return np.load(matrix_path, mmap_mode='r')
+
+
+def gram_tile_size(nb_columns, memory_budget):
+    """
+    Number of modes per tile in pastis_matrix_from_efield_cube(), so that the tiles held at once fit a memory budget.
 
-    return matrix_pastis_half
+    Those are a tile of rows of G with its weighted copy, a tile of columns, and the resulting matrix block and its
+    transposed copy, which for a tile size b and G with c columns take 8 * (3 b c + 2 b^2) bytes.
+    :param nb_columns: int, number of columns of G, twice the number of dark hole pixels
+    :param memory_budget: float, memory in bytes
+    :return: int, at least 1
+    """
+    tile_size = (-3 * nb_columns + np.sqrt(9 * nb_columns ** 2 + memory_budget)) / 4
+    return max(1, int(tile_size))
 
 
 class MatrixEfieldInternalSimulator(PastisMatrixEfields):
     """ Calculate a PASTIS matrix for one of the package-internal simulators, using E-fields. """
+    _worker_excluded_attributes = PastisMatrixEfields._worker_excluded_attributes + ['simulator']
+
     def __init__(self, which_dm, dm_spec, nb_seg, seglist, calc_science, calc_wfs,
-                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True):
+                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True, resume_dir=None):
         """
         :param which_dm: string, which DM to calculate the matrix for - "seg_mirror", "harris_seg_mirror", "zernike_mirror"
         :param dm_spec: tuple or int, specification for the used DM -
@@ -186,18 +803,110 @@ class MatrixEfieldInternalSimulator(PastisMatrixEfields):
         :param saveefields: bool, whether to save E-fields as fits file to disk or not
         :param saveopds: bool, whether to save images of pair-wise aberrated pupils to disk or not
         :param norm_one_photon: bool, whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+        :param resume_dir: string or None, result folder of a finished run to update with update_segments()
         """
         super().__init__(nb_seg=nb_seg, seglist=seglist, calc_science=calc_science, calc_wfs=calc_wfs,
-                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, norm_one_photon=norm_one_photon)
+                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, norm_one_photon=norm_one_photon,
+                         resume_dir=resume_dir)
         self.which_dm = which_dm
         self.dm_spec = dm_spec
+        self.dh_focal_grid = CONFIG_PASTIS.getboolean('numerical', 'dh_focal_grid', fallback=False)
 
-        self.instantiate_simulator()
+        self.setup_simulator()
 
     def instantiate_simulator(self):
         """ Create a simulator object and save to self.simulator """
         raise NotImplementedError()
 
+    def setup_simulator(self):
+        """ Create the simulator, and let it propagate onto the dark hole only if "dh_focal_grid" is set. """
+        self.instantiate_simulator()
+        if self.dh_focal_grid:
+            self.simulator.use_dh_focal_grid()
+
+    def calc_dms(self, dms, distributed=False, streaming=False, cross_terms=False, dh_zones=None):
+        """ Calculate the PASTIS matrices of several DMs in one run, which share the reference E-fields.
+
+        The simulator, the reference E-fields, the direct PSF norm and the dark hole mask are only set up once. The DMs
+        are then poked in turn, each with its modes distributed like in calc(), while all other DMs stay flat. Each DM
+        writes its E-fields, OPDs and PASTIS matrix into its own folder "matrix_numerical/<label>", where the label is
+        the name of the DM, followed by its position in "dms" if the same kind of DM is listed more than once. The
+        matrices are kept in self.dm_matrices, keyed by label.
+        With "cross_terms", the blocks that couple the modes of each pair of DMs are calculated too, from the dark hole
+        vectors of their E-fields, see pastis_cross_matrix(). They are kept in self.cross_matrices, keyed by the pair of
+        labels, and saved as "matrix_numerical/pastis_matrix_<label1>_<label2>.fits"; together with the matrices of
+        the DMs on the diagonal, they make up the PASTIS matrix of the modes of all DMs.
+        :param dms: list of tuples (which_dm, dm_spec), DMs to calculate the matrices for, see __init__()
+        :param distributed: bool, whether to use the file system task queue, see calculate_efields()
+        :param streaming: bool, whether to fill the matrices while the modes get calculated, see calculate_efields()
+        :param cross_terms: bool, whether to calculate the cross blocks between the DMs
+        :param dh_zones: dict or None, masks of parts of the dark hole keyed by name, to calculate the matrices of each
+                         DM for, see calculate_zone_matrices()
+        """
+        start_time = time.time()
+        names = [which_dm for which_dm, _dm_spec in dms]
+        labels = [name if names.count(name) == 1 else f'{name}_{i}' for i, name in enumerate(names)]
+
+        self.calculate_ref_efield()
+        if self.calc_wfs:
+            self.calculate_ref_efield_wfs()
+
+        self.dm_matrices = {}
+        self.cross_matrices = {}
+        dh_vectors = {}
+        overall_res_dir = self.resDir
+        try:
+            for label, (which_dm, dm_spec) in zip(labels, dms):
+                log.info(f'Calculating the PASTIS matrix of DM "{label}"')
+                self.which_dm = which_dm
+                self.dm_spec = dm_spec
+                self.resDir = os.path.join(overall_res_dir, label)
+                for folder in ['efields', 'efields_wfs', 'OTE_images']:
+                    os.makedirs(os.path.join(self.resDir, folder), exist_ok=True)
+                if self.save_efields and self.calc_science:
+                    self.save_reference_efield()
+
+                # Flatten the DM of the previous iteration, which is still set to its last mode
+                self.simulator.flatten()
+                self.setup_deformable_mirror()
+                self.setup_single_mode_function()
+                self.calculate_efields(distributed=distributed, streaming=streaming and self.calc_science)
+                if self.calc_science:
+                    self.calculate_pastis_matrix_from_efields()
+                    self.dm_matrices[label] = self.matrix_pastis
+                    if dh_zones:
+                        self.calculate_zone_matrices(dh_zones)
+                    if cross_terms:
+                        dh_vectors[label] = self.mode_dh_vectors()
+        finally:
+            self.resDir = overall_res_dir
+            self.simulator.flatten()
+
+        for label_rows, label_columns in itertools.combinations(dh_vectors, 2):
+            cross_matrix = pastis_cross_matrix(dh_vectors[label_rows], dh_vectors[label_columns], self.norm,
+                                               self.dh_mask, self.wfe_aber)
+            self.cross_matrices[(label_rows, label_columns)] = cross_matrix
+            filename = f'pastis_matrix_{label_rows}_{label_columns}.fits'
+            hcipy.write_fits(cross_matrix, os.path.join(self.resDir, filename))
+            log.info(f'Cross PASTIS matrix saved to: {os.path.join(self.resDir, filename)}')
+
+        end_time = time.time()
+        log.info(f'Runtime for {self.__class__.__name__}.calc_dms(): {end_time - start_time}sec = '
+                 f'{(end_time - start_time) / 60}min')
+        log.info(f'Data saved to {self.resDir}')
+
+    def radial_dh_zones(self, edges):
+        """ Split the dark hole into radial annuli, to calculate their PASTIS matrices with calculate_zone_matrices().
+
+        :param edges: list of float, radii of the edges of the annuli in lambda/D, in increasing order; each annulus
+                      includes its inner edge
+        :return: dict of boolean masks on the focal grid of the E-fields, keyed by names like "annulus_4-6"
+        """
+        radius = self.simulator.focal_det.as_('polar').r / self.simulator.lam_over_d
+        dh_mask = np.asarray(self.simulator.dh_mask) != 0
+        return {f'annulus_{inner:g}-{outer:g}': dh_mask & (radius >= inner) & (radius < outer)
+                for inner, outer in zip(edges[:-1], edges[1:])}
+
     def calculate_ref_efield(self):
         """Calculate the reference E-field, DH mask, and direct PSF norm factor."""
         self.dh_mask = self.simulator.dh_mask
@@ -263,6 +972,35 @@ class MatrixEfieldInternalSimulator(PastisMatrixEfields):
         self.calculate_one_mode = functools.partial(_simulator_matrix_single_mode, self.which_dm, self.number_all_modes,
                                                     self.wfe_aber, self.simulator, self.calc_science, self.calc_wfs,
                                                     self.norm_one_photon, self.resDir, self.save_efields, self.saveopds)
+        self.calculate_mode_batch = functools.partial(_simulator_matrix_mode_batch, self.which_dm,
+                                                      self.number_all_modes, self.wfe_aber, self.simulator,
+                                                      self.calc_science, self.calc_wfs, self.norm_one_photon,
+                                                      self.resDir, self.save_efields, self.saveopds)
+
+    def modes_of_segments(self, segments):
+        """ Modes of the segmented mirrors are ordered by segment, with the same number of local modes on each. """
+        if self.which_dm == 'seg_mirror':
+            modes_per_segment = self.dm_spec
+        elif self.which_dm == 'harris_seg_mirror':
+            modes_per_segment = self.simulator.n_harris_modes
+        else:
+            raise ValueError(f'Modes of DM "{self.which_dm}" act on all segments, they cannot be updated per segment.')
+        return [segment * modes_per_segment + local_mode for segment in sorted(segments)
+                for local_mode in range(modes_per_segment)]
+
+    def setup_worker(self):
+        """ Create a new simulator with the same DM in a worker process, and the function to calculate single modes. """
+        self.setup_simulator()
+        self.setup_deformable_mirror()
+        self.setup_single_mode_function()
+
+    def create_opd_cube(self):
+        """ Preallocate the cube for the DM phase maps of all modes, holding only the pixels inside the aperture. """
+        aperture = self.simulator.aperture.shaped != 0
+        cube_path = os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME)
+        util.create_frame_cube(cube_path, list(range(self.number_all_modes)), (np.count_nonzero(aperture),),
+                               dtype=np.float32)
+        np.save(os.path.splitext(cube_path)[0] + '_aperture.npy', aperture)
 
 
 class MatrixEfieldLuvoirA(MatrixEfieldInternalSimulator):
@@ -270,7 +1008,7 @@ class MatrixEfieldLuvoirA(MatrixEfieldInternalSimulator):
     instrument = 'LUVOIR'
 
     def __init__(self, which_dm, dm_spec, design='small', calc_science=True, calc_wfs=False,
-                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True):
+                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True, resume_dir=None):
         """
         :param which_dm: string, which DM to calculate the matrix for - "seg_mirror", "harris_seg_mirror", "zernike_mirror"
         :param dm_spec: tuple or int, specification for the used DM -
@@ -284,12 +1022,14 @@ class MatrixEfieldLuvoirA(MatrixEfieldInternalSimulator):
         :param saveefields: bool, whether to save E-fields as fits file to disk or not
         :param saveopds: bool, whether to save images of pair-wise aberrated pupils to disk or not
         :param norm_one_photon: bool, whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+        :param resume_dir: string or None, result folder of a finished run to update with update_segments()
         """
         nb_seg = CONFIG_PASTIS.getint(self.instrument, 'nb_subapertures')
         seglist = util.get_segment_list(self.instrument)
         self.design = design
         super().__init__(which_dm=which_dm, dm_spec=dm_spec, nb_seg=nb_seg, seglist=seglist, calc_science=calc_science, calc_wfs=calc_wfs,
-                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, norm_one_photon=norm_one_photon)
+                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, norm_one_photon=norm_one_photon,
+                         resume_dir=resume_dir)
 
     def instantiate_simulator(self):
         optics_input = os.path.join(util.find_repo_location(), CONFIG_PASTIS.get('LUVOIR', 'optics_path_in_repo'))
@@ -297,12 +1037,253 @@ class MatrixEfieldLuvoirA(MatrixEfieldInternalSimulator):
         self.simulator = LuvoirA_APLC(optics_input, self.design, sampling)
 
 
+class MatrixEfieldLuvoirADesigns(MatrixEfieldLuvoirA):
+    """ Calculate the PASTIS matrices of several LUVOIR-A APLC designs in one run, using E-fields.
+
+    The designs share the aperture and the segmented mirror, and only differ in their apodizer, FPM and Lyot stop. The
+    E-fields after the entrance pupil DMs are therefore only calculated once per mode, on the simulator of the first
+    design, and then propagated through the apodizer, coronagraph and focal plane of each design in the same task.
+    Each design writes its reference PSF, science plane E-fields and PASTIS matrix into its own folder
+    "matrix_numerical/<design>"; the pupil surface maps and WFS plane E-fields do not depend on the design and are
+    stored once, in "matrix_numerical".
+    """
+    _worker_excluded_attributes = MatrixEfieldLuvoirA._worker_excluded_attributes + ['design_simulators',
+                                                                                     'design_streamed_matrices']
+
+    def __init__(self, which_dm, dm_spec, designs=('small', 'medium', 'large'), calc_wfs=False,
+                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True, resume_dir=None):
+        """
+        :param which_dm: string, which DM to calculate the matrices for - "seg_mirror", "harris_seg_mirror", "zernike_mirror"
+        :param dm_spec: tuple or int, specification for the used DM, see MatrixEfieldLuvoirA
+        :param designs: list of str, coronagraph designs to calculate the matrices for - 'small', 'medium' or 'large'
+        :param calc_wfs: bool, whether to calculate the Efields in the out-of-band Zernike WFS plane.
+        :param initial_path: string, path to top-level directory where result folder should be saved to.
+        :param saveefields: bool or str, whether to save E-fields as fits files to disk, or 'cube' for E-field cubes
+        :param saveopds: bool, whether to save images of pair-wise aberrated pupils to disk or not
+        :param norm_one_photon: bool, whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+        :param resume_dir: string or None, result folder of an interrupted run with saveefields='cube' to resume, or of
+                           a finished run to update with update_segments()
+        """
+        self.designs = list(designs)
+        super().__init__(which_dm=which_dm, dm_spec=dm_spec, design=self.designs[0], calc_science=True,
+                         calc_wfs=calc_wfs, initial_path=initial_path, saveefields=saveefields, saveopds=saveopds,
+                         norm_one_photon=norm_one_photon, resume_dir=resume_dir)
+        self.run_dirs = (self.overall_dir, self.resDir)
+        self.design_references = {}
+        self.design_matrices = {}
+        self.design_zone_matrices = {}
+        self.design_streamed_matrices = {}
+        for design in self.designs:
+            os.makedirs(os.path.join(self.resDir, design, 'efields'), exist_ok=True)
+
+    def instantiate_simulator(self):
+        """ Create the simulator of each design; the one of the first design also propagates the entrance pupil. """
+        self.design_simulators = {design: self.create_design_simulator(design) for design in self.designs}
+        self.simulator = self.design_simulators[self.designs[0]]
+
+    def create_design_simulator(self, design):
+        """ Create the simulator of one coronagraph design. """
+        optics_input = os.path.join(util.find_repo_location(), CONFIG_PASTIS.get('LUVOIR', 'optics_path_in_repo'))
+        sampling = CONFIG_PASTIS.getfloat('LUVOIR', 'sampling')
+        return LuvoirA_APLC(optics_input, design, sampling)
+
+    def setup_simulator(self):
+        """ Create the simulators of all designs, and let them propagate onto their dark holes only if "dh_focal_grid"
+        is set. """
+        self.instantiate_simulator()
+        if self.dh_focal_grid:
+            for simulator in self.design_simulators.values():
+                simulator.use_dh_focal_grid()
+
+    def use_design(self, design):
+        """ Point the simulator, the result folders and the science plane attributes to one design, or with None back to
+        the simulator of the first design and the folders of the whole run. """
+        overall_dir, res_dir = self.run_dirs
+        if design is None:
+            self.simulator = self.design_simulators[self.designs[0]]
+            self.overall_dir, self.resDir = overall_dir, res_dir
+            self.streamed_matrix = None
+            return
+
+        self.simulator = self.design_simulators[design]
+        self.overall_dir = self.resDir = os.path.join(res_dir, design)
+        self.streamed_matrix = self.design_streamed_matrices.get(design)
+        if design in self.design_references:
+            references = self.design_references[design]
+            self.efield_ref, self.norm, self.dh_mask = references['efield_ref'], references['norm'], references['dh_mask']
+        self.efields_per_mode = self.efields_per_plane.get(design_plane(design), np.array([]))
+
+    def calc(self, distributed=False, streaming=False, dh_zones=None):
+        """ Calculate the PASTIS matrices of all designs, which are kept in self.design_matrices, keyed by design.
+
+        :param distributed: bool, if True, distribute the modes through a task queue in the result folder to workers
+                            started on any number of machines, see calculate_efields()
+        :param streaming: bool, if True, fill the PASTIS matrix of each design while the E-fields of the modes arrive,
+                          see _stream_modes()
+        :param dh_zones: dict or None, masks of parts of the dark hole of each design, as a dict of zone masks keyed by
+                         zone name, keyed by design, see calculate_zone_matrices(); the zone matrices of each design are
+                         kept in self.design_zone_matrices, keyed by design. Designs can be left out.
+        """
+        if dh_zones:
+            unknown_designs = set(dh_zones) - set(self.designs)
+            if unknown_designs:
+                raise ValueError(f'The dark hole zones need to be keyed by design, one of {self.designs}, but got '
+                                 f'{sorted(unknown_designs)}.')
+        start_time = time.time()
+
+        try:
+            self.calculate_design_references()
+            if self.save_efields:
+                for design in self.designs:
+                    self.use_design(design)
+                    self.save_reference_efield()
+
+            self.use_design(None)
+            if self.calc_wfs:
+                self.calculate_ref_efield_wfs()
+            self.setup_deformable_mirror()
+            self.setup_single_mode_function()
+            self.design_streamed_matrices = {}
+            self.calculate_efields(distributed=distributed, streaming=streaming)
+
+            self.design_zone_matrices = {}
+            for design in self.designs:
+                self.use_design(design)
+                self.calculate_pastis_matrix_from_efields()
+                self.design_matrices[design] = self.matrix_pastis
+                if dh_zones and design in dh_zones:
+                    self.calculate_zone_matrices(dh_zones[design])
+                    self.design_zone_matrices[design] = self.zone_matrices
+        finally:
+            self.use_design(None)
+
+        end_time = time.time()
+        log.info(
+            f'Runtime for {self.__class__.__name__}.calc(): {end_time - start_time}sec = {(end_time - start_time) / 60}min')
+        log.info(f'Data saved to {self.resDir}')
+
+    def update_segments(self, segments, distributed=False):
+        """ Recalculate only the modes on some segments of all designs, after their model changed, on top of a finished
+        run, like PastisMatrixEfields.update_segments().
+
+        The modes on the segments are propagated once, through all designs, and each design writes the new matrix
+        version into its own folder, with the same version number for all designs, which is recorded in the
+        "matrix_versions.txt" of each design.
+        :param segments: iterable of int, matrix indices of the segments whose model changed, 0-indexed
+        :param distributed: bool, whether to use the file system task queue instead of calculating the modes here
+        """
+        segments = {int(segment) for segment in segments}
+        versions = []
+        for design in self.designs:
+            self.use_design(design)
+            versions.append(self.next_matrix_version())
+        self.use_design(None)
+        self.matrix_version = max(versions)
+        self.calc_wfs = False
+        self.save_efields = False
+        self.saveopds = False
+
+        try:
+            self.calculate_design_references()
+            self.use_design(None)
+            self.setup_deformable_mirror()
+            self.setup_single_mode_function()
+            modes = self.modes_of_segments(segments)
+            log.info(f'Updating segments {sorted(segments)} ({len(modes)} modes) of designs {self.designs} as matrix '
+                     f'version {self.matrix_version}')
+            self.design_streamed_matrices = {}
+            self.calculate_efields(distributed=distributed, modes=modes)
+
+            for design in self.designs:
+                self.use_design(design)
+                efield_shape = np.shape(self.efield_ref)
+                original_efield_ref = self.read_efield('ref').reshape(efield_shape)
+                updated_efields = np.array([self.read_efield(mode_no).reshape(efield_shape)
+                                            for mode_no in range(self.number_all_modes)])
+                updated_efields += self.efield_ref - original_efield_ref
+                updated_efields[modes] = self.efields_per_mode
+                self.efields_per_mode = updated_efields
+                self.calculate_pastis_matrix_from_efields()
+                self.design_matrices[design] = self.matrix_pastis
+                self.record_matrix_version(segments)
+        finally:
+            self.use_design(None)
+
+    def calc_dms(self, dms, distributed=False, streaming=False, cross_terms=False, dh_zones=None):
+        """ Several DMs are not supported together with several designs. """
+        raise ValueError('Several DMs cannot be calculated together with several designs, use calc_dms() of '
+                         'MatrixEfieldLuvoirA for each design instead.')
+
+    def calculate_design_references(self):
+        """ Calculate the reference E-field, direct PSF norm and dark hole mask of each design, into
+        self.design_references. """
+        for design in self.designs:
+            self.use_design(design)
+            self.calculate_ref_efield()
+            self.design_references[design] = {'efield_ref': self.efield_ref, 'norm': self.norm,
+                                              'dh_mask': self.dh_mask}
+
+    def _stream_modes(self, modes):
+        """ Calculate modes and fill the PASTIS matrix of each design from their dark hole pixels as they arrive, like
+        PastisMatrixEfields._stream_modes(), into self.design_streamed_matrices, keyed by design.
+
+        :param modes: list of int, modes to calculate, in the order of the matrix rows
+        """
+        self.design_streamed_matrices = {design: IncrementalPastisMatrix(len(modes), references['efield_ref'],
+                                                                         references['norm'], references['dh_mask'])
+                                         for design, references in self.design_references.items()}
+        self.efields_per_plane = {}
+        self.efields_per_mode_wfs = np.array([])
+
+        def add_mode(index, dh_vectors, efield_wfs):
+            for design, dh_vector in dh_vectors.items():
+                self.design_streamed_matrices[design].add_mode(index, dh_vector)
+            if self.calc_wfs:
+                self.efields_per_mode_wfs = store_efield(self.efields_per_mode_wfs, index, len(modes), efield_wfs)
+
+        num_processes, num_threads = get_process_split(None, [], self.instrument)
+        if num_processes > 1 and len(modes) > 1:
+            self._run_in_mode_pool(_calculate_one_mode_design_dh_vectors, list(enumerate(modes)),
+                                   min(num_processes, len(modes)), num_threads,
+                                   result_callback=lambda result: add_mode(*result))
+        else:
+            for index, efields in enumerate(self._calculate_modes_here(modes)):
+                dh_vectors = {design: streamed_matrix.dh_vector(efields[design_plane(design)])
+                              for design, streamed_matrix in self.design_streamed_matrices.items()}
+                add_mode(index, dh_vectors, efields.get('efield_wfs_plane') if self.calc_wfs else None)
+
+    def plane_references(self):
+        """ Return the reference E-field of each calculated plane; the science plane of each design is keyed by
+        design_plane(). """
+        references = {design_plane(design): design_references['efield_ref']
+                      for design, design_references in self.design_references.items()}
+        if self.calc_wfs:
+            references['efield_wfs_plane'] = getattr(self.efield_ref_wfs, 'electric_field', self.efield_ref_wfs)
+        return references
+
+    def efield_dir(self, plane):
+        """ The science plane E-fields of each design are saved in the "efields" folder of the design. """
+        for design in self.designs:
+            if plane == design_plane(design):
+                return os.path.join(self.run_dirs[1], design, 'efields')
+        return super().efield_dir(plane)
+
+    def setup_single_mode_function(self):
+        """ Create the partial functions that return the E-fields of all designs for single modes and stacks of modes. """
+        self.calculate_mode_batch = functools.partial(_simulator_matrix_mode_batch, self.which_dm,
+                                                      self.number_all_modes, self.wfe_aber, self.simulator,
+                                                      self.calc_science, self.calc_wfs, self.norm_one_photon,
+                                                      self.resDir, self.save_efields, self.saveopds,
+                                                      design_simulators=self.design_simulators)
+        self.calculate_one_mode = functools.partial(_single_mode_from_batch, self.calculate_mode_batch)
+
+
 class MatrixEfieldHex(MatrixEfieldInternalSimulator):
     """ Calculate a PASTIS matrix for a SCDA Hex aperture with 1-5 segment rings, using E-fields. """
     instrument = 'HexRingTelescope'
 
     def __init__(self, which_dm, dm_spec, num_rings=1, calc_science=True, calc_wfs=False,
-                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True):
+                 initial_path='', saveefields=True, saveopds=True, norm_one_photon=True, resume_dir=None):
         """
         :param which_dm: string, which DM to calculate the matrix for - "seg_mirror", "harris_seg_mirror", "zernike_mirror"
         :param dm_spec: tuple or int, specification for the used DM -
@@ -316,12 +1297,14 @@ class MatrixEfieldHex(MatrixEfieldInternalSimulator):
         :param saveefields: bool, whether to save E-fields as fits file to disk or not
         :param saveopds: bool, whether to save images of pair-wise aberrated pupils to disk or not
         :param norm_one_photon: bool, whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+        :param resume_dir: string or None, result folder of a finished run to update with update_segments()
         """
         nb_seg = 3 * num_rings * (num_rings + 1) + 1
         seglist = np.arange(nb_seg) + 1
         self.num_rings = num_rings
         super().__init__(which_dm=which_dm, dm_spec=dm_spec, nb_seg=nb_seg, seglist=seglist, calc_science=calc_science, calc_wfs=calc_wfs,
-                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, norm_one_photon=norm_one_photon)
+                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, norm_one_photon=norm_one_photon,
+                         resume_dir=resume_dir)
 
     def instantiate_simulator(self):
         optics_input = os.path.join(util.find_repo_location(), 'data', 'SCDA')
@@ -334,12 +1317,15 @@ class MatrixEfieldRST(PastisMatrixEfields):
     Class to calculate the PASTIS matrix from E-fields of RST CGI.
     """
     instrument = 'RST'
+    _worker_excluded_attributes = PastisMatrixEfields._worker_excluded_attributes + ['rst_cgi']
+    opd_name_prefix = 'opd_actuator'
+    efield_name_prefix = 'efield'
 
-    def __init__(self, initial_path='', saveefields=True, saveopds=True):
+    def __init__(self, initial_path='', saveefields=True, saveopds=True, resume_dir=None):
         nb_seg = CONFIG_PASTIS.getint(self.instrument, 'nb_subapertures')
         seglist = util.get_segment_list(self.instrument)
         super().__init__(nb_seg=nb_seg, seglist=seglist, calc_science=True, calc_wfs=False,
-                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds)
+                         initial_path=initial_path, saveefields=saveefields, saveopds=saveopds, resume_dir=resume_dir)
 
     def calculate_ref_efield(self):
         iwa = CONFIG_PASTIS.getfloat('RST', 'IWA')
@@ -368,6 +1354,129 @@ class MatrixEfieldRST(PastisMatrixEfields):
         self.calculate_one_mode = functools.partial(_rst_matrix_single_mode, self.wfe_aber,
                                                     self.rst_cgi, self.resDir, self.save_efields, self.saveopds)
 
+    def modes_of_segments(self, segments):
+        """ Each mode is one DM actuator, which plays the role of a segment. """
+        return sorted(segments)
+
+    def setup_worker(self):
+        """ Create a new CGI simulator in a worker process, and the function to calculate single actuators. """
+        self.rst_cgi = webbpsf_imaging.set_up_cgi()
+        self.setup_single_mode_function()
+
+    def create_opd_cube(self):
+        """ Preallocate the cube for the DM surface maps of all actuators. """
+        util.create_frame_cube(os.path.join(self.resDir, 'OTE_images', OPD_CUBE_NAME),
+                               list(range(self.number_all_modes)), self.rst_cgi.dm1.surface.shape, dtype=np.float32)
+
+
+EFIELD_CUBE_NAME = 'efield_cube.npy'
+# Folder of the E-fields of each plane, keyed like the E-field dicts of the single modes
+EFIELD_DIRS = {'efield_science_plane': 'efields', 'efield_wfs_plane': 'efields_wfs'}
+EFIELD_PROGRESS_NAME = 'efield_cube_progress.npy'
+
+
+def save_mode_efield(efield, mode_no, efield_dir, name_prefix, saveefields):
+    """
+    Save the E-field of one mode, either as fits files of its real and imaginary part, or into the E-field cube.
+    :param efield: hcipy.Wavefront, Field or array, E-field of the mode
+    :param mode_no: int, mode index, which is also the frame number in the cube
+    :param efield_dir: str, "efields" or "efields_wfs" folder of the run
+    :param name_prefix: str, file name prefix of the fits files, e.g. 'focal' for "focal_real_mode<mode_no>.fits"
+    :param saveefields: bool or str, 'cube' to write into the preallocated cube "efield_cube.npy" in efield_dir,
+                        anything else that is True to write fits files
+    """
+    efield = getattr(efield, 'electric_field', efield)
+    if saveefields == 'cube':
+        util.write_cube_frame(os.path.join(efield_dir, EFIELD_CUBE_NAME), mode_no, efield)
+    else:
+        hcipy.write_fits(efield.real, os.path.join(efield_dir, f'{name_prefix}_real_mode{mode_no}.fits'))
+        hcipy.write_fits(efield.imag, os.path.join(efield_dir, f'{name_prefix}_imag_mode{mode_no}.fits'))
+
+
+def design_plane(design):
+    """ Key of the science plane E-fields of one coronagraph design, in the E-field dicts of MatrixEfieldLuvoirADesigns. """
+    return f'efield_science_plane_{design}'
+
+
+def mark_mode_done(resDir, mode_no):
+    """ Mark a mode as done in the progress bitmap of the E-field cubes, once all of its E-fields are in the cubes. """
+    util.write_cube_frame(os.path.join(resDir, 'efields', EFIELD_PROGRESS_NAME), mode_no, True)
+
+
+_WORKER_MATRIX = None
+
+
+def _init_efield_worker(matrix, num_threads=None):
+    """ Pool and task queue initializer: limit the math threads of a worker process, and set up the simulator of an
+    E-field matrix object once in it. """
+    global _WORKER_MATRIX
+    if num_threads is not None:
+        set_math_threads(num_threads)
+    matrix.setup_worker()
+    _WORKER_MATRIX = matrix
+
+
+def _calculate_one_mode_in_worker(mode_no):
+    """ Task queue function: calculate the E-fields of one mode with the simulator of the current worker process. """
+    return _WORKER_MATRIX.calculate_one_mode(mode_no)
+
+
+def _calculate_one_mode_without_result(mode_no):
+    """ Pool and task queue function: calculate the E-fields of one mode, which the single-mode function writes into the
+    E-field cubes, and only return the mode number. """
+    _WORKER_MATRIX.calculate_one_mode(mode_no)
+    return mode_no
+
+
+def _calculate_one_mode_into_shared_arrays(array_names, index_and_mode):
+    """
+    Pool function: calculate the E-fields of one mode and write them into shared arrays at the position of the mode.
+    :param array_names: dict, name of the shared array for each key of the E-field dict returned by calculate_one_mode
+    :param index_and_mode: tuple of int, position of the mode in the arrays, and mode number
+    :return: int, mode number
+    """
+    index, mode_no = index_and_mode
+    efields = _WORKER_MATRIX.calculate_one_mode(mode_no)
+    for key, name in array_names.items():
+        util.attach_shared_array(name)[index] = getattr(efields[key], 'electric_field', efields[key])
+    return mode_no
+
+
+def _calculate_one_mode_dh_vector(index_and_mode):
+    """
+    Pool function for streamed matrices: calculate the E-fields of one mode, and only send back the dark hole vector of
+    its science plane E-field, see IncrementalPastisMatrix, and its WFS plane E-field if that is calculated.
+    :param index_and_mode: tuple of int, position of the mode in the matrix, and mode number
+    :return: tuple of the position, the dark hole vector and the WFS plane E-field or None
+    """
+    index, mode_no = index_and_mode
+    efields = _WORKER_MATRIX.calculate_one_mode(mode_no)
+    in_dh = np.asarray(_WORKER_MATRIX.dh_mask).ravel() != 0
+    dh_vector = dh_difference_vectors(getattr(efields['efield_science_plane'], 'electric_field',
+                                              efields['efield_science_plane']), _WORKER_MATRIX.efield_ref, in_dh)[0]
+    efield_wfs = None
+    if _WORKER_MATRIX.calc_wfs:
+        efield_wfs = efields.get('efield_wfs_plane')
+        efield_wfs = getattr(efield_wfs, 'electric_field', efield_wfs)
+    return index, dh_vector, efield_wfs
+
+
+def _calculate_one_mode_design_dh_vectors(index_and_mode):
+    """ Calculate one mode in a pool worker of MatrixEfieldLuvoirADesigns and return its index, together with the
+    dark hole vectors of its science plane E-fields keyed by design and its WFS plane E-field, see
+    _calculate_one_mode_dh_vector(). """
+    index, mode_no = index_and_mode
+    efields = _WORKER_MATRIX.calculate_one_mode(mode_no)
+    dh_vectors = {}
+    for design, references in _WORKER_MATRIX.design_references.items():
+        in_dh = np.asarray(references['dh_mask']).ravel() != 0
+        dh_vectors[design] = dh_difference_vectors(efields[design_plane(design)], references['efield_ref'], in_dh)[0]
+    efield_wfs = None
+    if _WORKER_MATRIX.calc_wfs:
+        efield_wfs = efields.get('efield_wfs_plane')
+        efield_wfs = getattr(efield_wfs, 'electric_field', efield_wfs)
+    return index, dh_vectors, efield_wfs
+
 
 def _simulator_matrix_single_mode(which_dm, number_all_modes, wfe_aber, simulator, calc_science, calc_wfs,
                                   norm_one_photon, resDir, saveefields, saveopds, mode_no):
@@ -382,7 +1491,7 @@ def _simulator_matrix_single_mode(which_dm, number_all_modes, wfe_aber, simulato
     :param norm_one_photon: bool, whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
     :param resDir: str, directory for matrix calculation results
     :param saveefields: bool, Whether to save E-fields as fits file to disk or not
-    :param saveopds: bool, Whether to save images of pair-wise aberrated pupils to disk or not
+    :param saveopds: bool, Whether to store the DM phase of each mode in the OPD cube or not
     :param mode_no: int, which mode index to calculate the E-field for
     :return: dict, resulting E-fields
     """
@@ -417,24 +1526,21 @@ def _simulator_matrix_single_mode(which_dm, number_all_modes, wfe_aber, simulato
     if saveefields:
         # Save focal plane Efields
         if calc_science:
-            fname_real_focal = f'focal_real_mode{mode_no}'
-            hcipy.write_fits(efield_focal_plane.real, os.path.join(resDir, 'efields', fname_real_focal + '.fits'))
-            fname_imag_focal = f'focal_imag_mode{mode_no}'
-            hcipy.write_fits(efield_focal_plane.imag, os.path.join(resDir, 'efields', fname_imag_focal + '.fits'))
+            save_mode_efield(efield_focal_plane, mode_no, os.path.join(resDir, 'efields'), 'focal', saveefields)
 
         # Save wfs plane Efields
         if calc_wfs:
-            fname_real_wfs = f'wfs_real_mode{mode_no}'
-            hcipy.write_fits(efield_wfs_plane.real, os.path.join(resDir, 'efields_wfs', fname_real_wfs + '.fits'))
-            fname_imag_wfs = f'wfs_imag_mode{mode_no}'
-            hcipy.write_fits(efield_wfs_plane.imag, os.path.join(resDir, 'efields_wfs', fname_imag_wfs + '.fits'))
+            save_mode_efield(efield_wfs_plane, mode_no, os.path.join(resDir, 'efields_wfs'), 'wfs', saveefields)
 
+    # Store the DM phase inside the aperture, it can be rendered later with render_opds()
     if saveopds:
         opd_map = inter[which_dm].phase
-        opd_name = f'opd_mode_{mode_no}'
-        plt.clf()
-        hcipy.imshow_field(opd_map, grid=simulator.aperture.grid, mask=simulator.aperture, cmap='RdBu')
-        plt.savefig(os.path.join(resDir, 'OTE_images', opd_name + '.pdf'))
+        util.write_cube_frame(os.path.join(resDir, 'OTE_images', OPD_CUBE_NAME), mode_no,
+                              opd_map[simulator.aperture != 0])
+
+    # All E-fields of this mode are in the cubes, mark it as done for a resumed run
+    if saveefields == 'cube':
+        mark_mode_done(resDir, mode_no)
 
     # Format returned Efields
     efields = {'efield_science_plane': efield_focal_plane.electric_field,
@@ -443,6 +1549,98 @@ def _simulator_matrix_single_mode(which_dm, number_all_modes, wfe_aber, simulato
     return efields
 
 
+def _simulator_matrix_mode_batch(which_dm, number_all_modes, wfe_aber, simulator, calc_science, calc_wfs,
+                                 norm_one_photon, resDir, saveefields, saveopds, modes, design_simulators=None):
+    """
+    Calculate the E-fields of many aberrated modes like _simulator_matrix_single_mode(), in stacks of modes.
+
+    Each stack goes through the simulator with calc_psf_batch(), so that its Fourier transforms are matrix-matrix
+    products; the stacks are as large as the "batch_memory_gb" budget from the configfile allows.
+    With "design_simulators", the entrance pupil E-fields of each stack are only calculated once, on "simulator", and
+    then propagated through the coronagraph of each design, see MatrixEfieldLuvoirADesigns.
+    :param which_dm: string, which DM - "seg_mirror", "harris_seg_mirror", "zernike_mirror"
+    :param number_all_modes: int, total number of all modes
+    :param wfe_aber: float, calibration aberration in meters
+    :param simulator: instance of segmented telescope simulator
+    :param calc_science: bool, whether to calculate the Efields in the science focal plane.
+    :param calc_wfs: bool, whether to calculate the Efields in the out-of-band Zernike WFS plane.
+    :param norm_one_photon: bool, whether to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+    :param resDir: str, directory for matrix calculation results
+    :param saveefields: bool or str, whether to save E-fields as fits files, or 'cube' to write them into the E-field cubes
+    :param saveopds: bool, whether to store the DM phase of each mode in the OPD cube or not
+    :param modes: list of int, which mode indices to calculate the E-fields for
+    :param design_simulators: dict or None, simulators of coronagraph designs that share the entrance pupil of
+                              "simulator", keyed by design; their science plane E-fields are keyed by design_plane()
+                              and saved into the folder "<resDir>/<design>/efields"
+    :return: generator of the E-field dicts of the modes, in the order of "modes"
+    """
+    if calc_wfs and simulator.zwfs is None:
+        simulator.create_zernike_wfs()
+    dm = simulator.active_dms()[which_dm]
+    batch_size = simulator.batch_size()
+    if design_simulators is not None:
+        batch_size = min(design_simulator.batch_size() for design_simulator in design_simulators.values())
+        science_dirs = {design_plane(design): os.path.join(resDir, design, 'efields') for design in design_simulators}
+    elif calc_science:
+        science_dirs = {'efield_science_plane': os.path.join(resDir, 'efields')}
+    else:
+        science_dirs = {}
+
+    for start in range(0, len(modes), batch_size):
+        batch_modes = list(modes[start:start + batch_size])
+        log.info(f'MODE NUMBERS: {batch_modes[0]} to {batch_modes[-1]}')
+
+        # Apply the calibration aberration to one mode per command
+        commands = np.zeros((len(batch_modes), number_all_modes))
+        commands[np.arange(len(batch_modes)), batch_modes] = wfe_aber / 2    # simulator takes aberrations in surface
+
+        efields_science = {}
+        efields_wfs_plane = None
+        wf_pupils = None
+        if calc_wfs or design_simulators is not None:
+            wf_pupils = simulator.propagate_active_pupils_batch(commands, which_dm, norm_one_photon)
+        if design_simulators is not None:
+            for design, design_simulator in design_simulators.items():
+                efields_science[design_plane(design)] = design_simulator._propagate_batch_to_focal_plane(
+                    wf_pupils, norm_one_photon).electric_field
+        elif calc_science:
+            efields_science['efield_science_plane'] = simulator.calc_psf_batch(commands, which_dm, return_efield=True,
+                                                                               norm_one_photon=norm_one_photon)
+        if calc_wfs:
+            efields_wfs_plane = simulator.zwfs(wf_pupils)
+        if saveopds:
+            # Phase of the DM alone, like the intermediate plane of the DM in calc_psf()
+            wf_aper = simulator.wf_aper
+            opd_maps = np.angle(wf_aper.electric_field * np.exp(2j * wf_aper.wavenumber * dm_surfaces(dm, commands)))
+
+        for index, mode_no in enumerate(batch_modes):
+            efields = {'efield_science_plane': None, 'efield_wfs_plane': None}
+            for plane, plane_efields in efields_science.items():
+                efields[plane] = plane_efields[index]
+            if calc_wfs:
+                efields['efield_wfs_plane'] = hcipy.Wavefront(efields_wfs_plane.electric_field[index],
+                                                              efields_wfs_plane.wavelength)
+
+            if saveefields:
+                for plane, science_dir in science_dirs.items():
+                    save_mode_efield(efields[plane], mode_no, science_dir, 'focal', saveefields)
+                if calc_wfs:
+                    save_mode_efield(efields['efield_wfs_plane'], mode_no, os.path.join(resDir, 'efields_wfs'),
+                                     'wfs', saveefields)
+            if saveopds:
+                util.write_cube_frame(os.path.join(resDir, 'OTE_images', OPD_CUBE_NAME), mode_no,
+                                      opd_maps[index][simulator.aperture != 0])
+            if saveefields == 'cube':
+                mark_mode_done(resDir, mode_no)
+
+            yield efields
+
+
+def _single_mode_from_batch(mode_batch_function, mode_no):
+    """ Calculate the E-fields of one mode with a function that calculates them for a list of modes. """
+    return next(iter(mode_batch_function([mode_no])))
+
+
 def _rst_matrix_single_mode(wfe_aber, rst_sim, resDir, saveefields, saveopds, mode_no):
     """
     Function to calculate RST Electrical field (E_field) of one DM actuator in CGI.
@@ -450,7 +1648,7 @@ def _rst_matrix_single_mode(wfe_aber, rst_sim, resDir, saveefields, saveopds, mo
     :param rst_sim: instance of CGI simulator
     :param resDir: str, directory for matrix calculations
     :param saveefields: bool, if True, all E_field will be saved to disk individually, as fits files
-    :param savepods: bool, if True, all pupil surface maps of aberrated actuators pairs will be saved to disk as PDF
+    :param savepods: bool, if True, all DM surface maps of aberrated actuators will be stored in the OPD cube
     :param mode_no: int, which aberrated actuator to calculate the E-field for
     :return: dict, resulting E-fields
     """
@@ -470,19 +1668,14 @@ def _rst_matrix_single_mode(wfe_aber, rst_sim, resDir, saveefields, saveopds, mo
 
     # Save E field image to disk
     if saveefields:
-        fname_real = f'efield_real_mode{mode_no}'
-        hcipy.write_fits(efield_focal_plane.wavefront.real, os.path.join(resDir, 'efields', fname_real + '.fits'))
-        fname_imag = f'efield_imag_mode{mode_no}'
-        hcipy.write_fits(efield_focal_plane.wavefront.imag, os.path.join(resDir, 'efields', fname_imag + '.fits'))
+        save_mode_efield(efield_focal_plane.wavefront, mode_no, os.path.join(resDir, 'efields'), 'efield', saveefields)
 
-    # Plot deformable mirror WFE and save to disk
+    # Store deformable mirror surface, it can be rendered later with render_opds()
     if saveopds:
-        opd_name = f'opd_actuator_{mode_no}'
-        plt.clf()
-        plt.figure(figsize=(8, 8))
-        rst_sim.dm1.display(what='opd', opd_vmax=wfe_aber, colorbar_orientation='horizontal',
-                            title='Aberrated actuator pair')
-        plt.savefig(os.path.join(resDir, 'OTE_images', opd_name + '.pdf'))
+        util.write_cube_frame(os.path.join(resDir, 'OTE_images', OPD_CUBE_NAME), mode_no, rst_sim.dm1.surface)
+
+    if saveefields == 'cube':
+        mark_mode_done(resDir, mode_no)
 
     # Format returned Efields
     efields = {'efield_science_plane': efield_focal_plane.wavefront}
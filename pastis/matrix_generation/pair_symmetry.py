@@ -0,0 +1,148 @@
+"""
+Find segment pairs that are equivalent under the symmetries of a segmented coronagraph, to calculate only one of them.
+
+A rotation or reflection of the pupil that maps the segment centers onto each other, and that leaves the aperture,
+apodizer, Lyot stop, focal plane mask and dark hole unchanged, maps a segment pair onto another pair with the same dark
+hole contrast - as long as the aberration on the segments is itself invariant under the transformation, like piston.
+All pairs that are connected by such transformations form a pair class, of which only one representative needs to be
+calculated.
+"""
+
+import logging
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+import pastis.util as util
+
+log = logging.getLogger()
+
+
+def dihedral_transformations(order=6):
+    """
+    Create the rotation and reflection matrices of the dihedral group of a regular polygon with "order" corners.
+    :param order: int, rotational order of the symmetry group, 6 for hexagonal apertures
+    :return: list of tuples (name, 2x2 ndarray), starting with the identity
+    """
+    transformations = []
+    for k in range(order):
+        angle = 2 * np.pi * k / order
+        cos, sin = np.cos(angle), np.sin(angle)
+        transformations.append((f'rotation {360 * k / order:g}deg', np.array([[cos, -sin], [sin, cos]])))
+    for k in range(order):
+        angle = np.pi * k / order
+        cos, sin = np.cos(2 * angle), np.sin(2 * angle)
+        transformations.append((f'reflection {180 * k / order:g}deg', np.array([[cos, sin], [sin, -cos]])))
+    return transformations
+
+
+def segment_permutation(seg_pos_x, seg_pos_y, transformation, tolerance):
+    """
+    Find the segment that each segment center gets mapped onto by a transformation.
+    :param seg_pos_x: array, x-coordinates of the segment centers
+    :param seg_pos_y: array, y-coordinates of the segment centers
+    :param transformation: 2x2 ndarray, rotation or reflection matrix
+    :param tolerance: float, largest allowed distance between a transformed center and its closest segment center, as
+                      a fraction of the smallest distance between two segment centers
+    :return: int ndarray with the index of the segment that each segment is mapped onto, or None if the segment centers
+             are not invariant under the transformation
+    """
+    positions = np.stack([seg_pos_x, seg_pos_y], axis=1)
+    transformed = positions @ transformation.T
+    distances = np.linalg.norm(transformed[:, np.newaxis] - positions[np.newaxis], axis=2)
+
+    segment_distances = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis], axis=2)
+    min_separation = np.min(segment_distances[~np.eye(len(positions), dtype=bool)]) if len(positions) > 1 else 1.
+
+    permutation = np.argmin(distances, axis=1)
+    if np.any(distances[np.arange(len(positions)), permutation] > tolerance * min_separation):
+        return None
+    if len(np.unique(permutation)) != len(permutation):
+        return None
+    return permutation
+
+
+def field_asymmetry(field, transformation):
+    """
+    Measure how much a field on a regular Cartesian grid changes under a transformation of its coordinates.
+
+    The field is interpolated bilinearly at the transformed pixel positions, pixels that fall outside the grid take the
+    value of the closest edge pixel.
+    :param field: hcipy.Field on a regular, two-dimensional Cartesian grid
+    :param transformation: 2x2 ndarray, rotation or reflection matrix
+    :return: float, mean absolute difference between the transformed and the original field, relative to the mean
+             absolute value of the field
+    """
+    field_values = np.asarray(field, dtype=float)
+    x_sep, y_sep = field.grid.separated_coords
+    x_transformed, y_transformed = transformation @ np.stack([field.grid.x, field.grid.y])
+
+    # Fractional pixel indices of the transformed coordinates
+    ix = (x_transformed - x_sep[0]) / (x_sep[1] - x_sep[0])
+    iy = (y_transformed - y_sep[0]) / (y_sep[1] - y_sep[0])
+    transformed = map_coordinates(field_values.reshape(field.grid.shape), [iy, ix], order=1, mode='nearest')
+
+    norm = np.mean(np.abs(field_values))
+    if norm == 0:
+        return 0.
+    return np.mean(np.abs(transformed - field_values)) / norm
+
+
+def find_aperture_symmetries(seg_pos_x, seg_pos_y, fields, tolerance, order=6):
+    """
+    Find the rotations and reflections under which the segment centers and all given optics are invariant.
+    :param seg_pos_x: array, x-coordinates of the segment centers, centered on the optical axis
+    :param seg_pos_y: array, y-coordinates of the segment centers, centered on the optical axis
+    :param fields: dict of hcipy.Fields on regular Cartesian grids centered on the optical axis, e.g. aperture,
+                   apodizer, Lyot stop, focal plane mask and dark hole mask; keys are used for logging only
+    :param tolerance: float, tolerance for the segment centers (see segment_permutation()) and for the relative
+                      asymmetry of each field (see field_asymmetry())
+    :param order: int, rotational order of the symmetry group to test, 6 for hexagonal apertures
+    :return: list of segment permutation arrays, one per symmetry found, always including the identity
+    """
+    permutations = []
+    for name, transformation in dihedral_transformations(order):
+        permutation = segment_permutation(seg_pos_x, seg_pos_y, transformation, tolerance)
+        if permutation is None:
+            log.info(f'Aperture symmetry check: segment centers are not invariant under {name}')
+            continue
+
+        asymmetries = {field_name: field_asymmetry(field, transformation) for field_name, field in fields.items()}
+        broken = [field_name for field_name, asymmetry in asymmetries.items() if asymmetry > tolerance]
+        if broken:
+            log.info(f'Aperture symmetry check: {", ".join(broken)} not invariant under {name}, relative asymmetries: '
+                     f'{", ".join(f"{key}={value:.3g}" for key, value in asymmetries.items())}')
+            continue
+
+        log.info(f'Aperture symmetry check: found {name}')
+        permutations.append(permutation)
+
+    return permutations
+
+
+def segment_pair_classes(permutations, nseg):
+    """
+    Group all non-repeating segment pairs into classes of pairs that are mapped onto each other by the symmetries.
+    :param permutations: list of segment permutation arrays, as returned by find_aperture_symmetries()
+    :param nseg: int, number of segments
+    :return: int ndarray with the pair index of the representative of each pair, indexed by util.pair_index(); the
+             representative is the first pair of its class in the order of util.segment_pairs_non_repeating()
+    """
+    # Union-find over the pair indices
+    parent = np.arange(util.pastis_matrix_measurements(nseg))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for pair in util.segment_pairs_non_repeating(nseg):
+        pair_no = util.pair_index(pair, nseg)
+        for permutation in permutations:
+            mapped = sorted((permutation[pair[0]], permutation[pair[1]]))
+            root_a, root_b = find(pair_no), find(util.pair_index(mapped, nseg))
+            if root_a != root_b:
+                # Keep the smaller pair index as root, so that the representative is the first pair of its class
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    return np.array([find(index) for index in range(parent.size)])
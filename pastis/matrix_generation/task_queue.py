@@ -0,0 +1,353 @@
+"""
+A task queue on a shared file system, to distribute PASTIS matrix calculations over several machines.
+
+The coordinator (the PastisMatrix object) puts one task per segment pair or mode into a queue directory. Workers that
+are started on any node that can see this directory, and that has pastis installed, claim tasks by atomically creating
+a lease file, calculate them and write their results back into the queue directory. Leases that have not been renewed
+for longer than the lease timeout are considered abandoned, e.g. because the node died, and their task will be picked up
+by the next free worker. A task that raises an error is recorded as a failure and attempted again by the next free
+worker, until it failed "queue_max_attempts" times; then the coordinator gives up the job. The coordinator collects the
+results once all tasks are done.
+
+Layout of a queue directory:
+    job.pkl                 function to call on each task, optional initializer that gets called once per worker, and
+                            a fingerprint of the job to check that a resumed job is the same
+    tasks/<task_id>.pkl     argument of each task, e.g. a segment pair tuple or a mode index
+    leases/<task_id>.lease  exists while a worker is calculating a task
+    results/<task_id>.pkl   return value of each finished task
+    failures/<task_id>.pkl  traceback of the last error of a task, and the number of failed attempts
+
+Start a worker with:
+    python pastis/launchers/run_queue_worker.py /path/to/queue_dir
+"""
+
+import hashlib
+import os
+import pickle
+import socket
+import threading
+import time
+import traceback
+import logging
+
+from pastis.config import CONFIG_PASTIS
+
+log = logging.getLogger()
+
+
+class FileTaskQueue:
+    """ A task queue that lives in a directory on a shared file system.
+
+    Parameters:
+    ----------
+    queue_dir : string
+        Path to the queue directory; gets created if it does not exist yet.
+    lease_timeout : float or None
+        Time in seconds after which the lease of a task that has not been renewed is considered abandoned. If None,
+        it is read from the configfile.
+    max_attempts : int or None
+        Number of failed attempts after which a task is not claimed again. If None, it is read from the configfile.
+        It is stored with the job when it gets submitted, and the workers use the value of the job.
+
+    Attributes:
+    ----------
+    queue_dir : string
+        Path to the queue directory
+    lease_timeout : float
+        Time in seconds after which an abandoned lease can be taken over by another worker
+    max_attempts : int
+        Number of failed attempts after which a task has failed for good
+    worker_name : string
+        Host name and process ID of the current process, written into the lease files it creates
+    """
+    def __init__(self, queue_dir, lease_timeout=None, max_attempts=None):
+        self.queue_dir = queue_dir
+        if lease_timeout is None:
+            lease_timeout = CONFIG_PASTIS.getfloat('numerical', 'queue_lease_timeout', fallback=3600)
+        self.lease_timeout = lease_timeout
+        if max_attempts is None:
+            max_attempts = CONFIG_PASTIS.getint('numerical', 'queue_max_attempts', fallback=3)
+        self.max_attempts = max_attempts
+        self.worker_name = f'{socket.gethostname()}-{os.getpid()}'
+
+        self.task_dir = os.path.join(queue_dir, 'tasks')
+        self.lease_dir = os.path.join(queue_dir, 'leases')
+        self.result_dir = os.path.join(queue_dir, 'results')
+        self.failure_dir = os.path.join(queue_dir, 'failures')
+        self.job_path = os.path.join(queue_dir, 'job.pkl')
+        for directory in [self.task_dir, self.lease_dir, self.result_dir, self.failure_dir]:
+            os.makedirs(directory, exist_ok=True)
+
+    def submit(self, function, tasks, initializer=None, initargs=()):
+        """ Put a job into the queue, unless the queue already holds the same job, e.g. from an earlier interrupted run.
+
+        A job counts as the same if it has the same number of tasks and the same fingerprint, which is a hash of the
+        pickled function, tasks, initializer and initializer arguments; a queue with a different job raises an error,
+        instead of returning results that were calculated for other settings.
+
+        Parameters:
+        ----------
+        function : callable
+            Picklable function that gets called with each task as its only argument.
+        tasks : list
+            Picklable task arguments, e.g. segment pair tuples or mode indices.
+        initializer : callable or None
+            Picklable function that gets called once in each worker before its first task, e.g. to set up a simulator.
+        initargs : tuple
+            Arguments passed to the initializer.
+        """
+        fingerprint = job_fingerprint(function, tasks, initializer, initargs)
+        if os.path.isfile(self.job_path):
+            job = self.load_job()
+            if job.get('num_tasks', self.num_tasks()) != len(tasks) or job.get('fingerprint', fingerprint) != fingerprint:
+                raise ValueError(f'The queue {self.queue_dir} holds a different job than the one submitted now, e.g. '
+                                 f'from a run with other settings; remove the queue directory to start over.')
+            self.max_attempts = job.get('max_attempts', self.max_attempts)
+            log.info(f'Reusing existing job in {self.queue_dir} with {self.num_tasks()} tasks, '
+                     f'{self.num_finished()} of them finished')
+            return
+
+        for task_id, task in enumerate(tasks):
+            _write_pickle_atomic(os.path.join(self.task_dir, f'{task_id}.pkl'), task)
+        # The job file gets written last, so that workers only start once all tasks are in place
+        _write_pickle_atomic(self.job_path, {'function': function, 'initializer': initializer, 'initargs': initargs,
+                                             'num_tasks': len(tasks), 'fingerprint': fingerprint,
+                                             'max_attempts': self.max_attempts})
+        log.info(f'Submitted {len(tasks)} tasks to {self.queue_dir}')
+
+    def is_submitted(self):
+        """ Whether a job has been fully submitted to the queue. """
+        return os.path.isfile(self.job_path)
+
+    def load_job(self):
+        """ Read the job dict with the task function, initializer and initializer arguments. """
+        with open(self.job_path, 'rb') as job_file:
+            return pickle.load(job_file)
+
+    def task_ids(self):
+        """ Sorted list of all task IDs in the queue. """
+        return sorted(int(fname.split('.')[0]) for fname in os.listdir(self.task_dir) if fname.endswith('.pkl'))
+
+    def finished_ids(self):
+        """ Set of IDs of all tasks that have a result. """
+        return {int(fname.split('.')[0]) for fname in os.listdir(self.result_dir) if fname.endswith('.pkl')}
+
+    def num_tasks(self):
+        return len(self.task_ids())
+
+    def num_finished(self):
+        return len(self.finished_ids())
+
+    def is_done(self):
+        """ Whether all submitted tasks have a result. """
+        return self.is_submitted() and self.num_finished() == self.num_tasks()
+
+    def failed_ids(self):
+        """ Set of IDs of all tasks without a result that failed max_attempts times, and are not attempted again. """
+        failed = {int(fname.split('.')[0]) for fname in os.listdir(self.failure_dir) if fname.endswith('.pkl')}
+        return {task_id for task_id in failed - self.finished_ids()
+                if self.load_failure(task_id)['attempts'] >= self.max_attempts}
+
+    def is_settled(self):
+        """ Whether all submitted tasks have either a result or failed for good, so that no worker has anything left to
+        do. """
+        return self.is_submitted() and self.num_finished() + len(self.failed_ids()) == self.num_tasks()
+
+    def load_task(self, task_id):
+        with open(os.path.join(self.task_dir, f'{task_id}.pkl'), 'rb') as task_file:
+            return pickle.load(task_file)
+
+    def load_result(self, task_id):
+        with open(os.path.join(self.result_dir, f'{task_id}.pkl'), 'rb') as result_file:
+            return pickle.load(result_file)
+
+    def load_failure(self, task_id):
+        """ Read the failure record of a task, a dict with the 'traceback' of its last error and its failed 'attempts'. """
+        with open(os.path.join(self.failure_dir, f'{task_id}.pkl'), 'rb') as failure_file:
+            return pickle.load(failure_file)
+
+    def results(self):
+        """ Read all results, as a list ordered like the tasks were submitted. """
+        return [self.load_result(task_id) for task_id in self.task_ids()]
+
+    def _lease_path(self, task_id):
+        return os.path.join(self.lease_dir, f'{task_id}.lease')
+
+    def _lease_is_expired(self, task_id):
+        try:
+            return time.time() - os.path.getmtime(self._lease_path(task_id)) > self.lease_timeout
+        except FileNotFoundError:
+            return True
+
+    def claim(self):
+        """ Claim the next task that is neither finished, nor failed for good, nor leased by a live worker.
+
+        Returns:
+        --------
+        task_id : int or None
+            ID of the claimed task, None if no task is available right now.
+        """
+        finished = self.finished_ids() | self.failed_ids()
+        leased = {int(fname.split('.')[0]) for fname in os.listdir(self.lease_dir) if fname.endswith('.lease')}
+
+        for task_id in self.task_ids():
+            if task_id in finished:
+                continue
+            if task_id in leased:
+                if not self._lease_is_expired(task_id):
+                    continue
+                # Move the abandoned lease out of the way; only one worker can win this rename
+                try:
+                    os.rename(self._lease_path(task_id), self._lease_path(task_id) + f'.expired-{self.worker_name}')
+                except FileNotFoundError:
+                    continue
+                log.info(f'Taking over abandoned task {task_id}')
+            if self._create_lease(task_id):
+                return task_id
+
+        return None
+
+    def _create_lease(self, task_id):
+        """ Atomically create the lease file of a task, return whether it succeeded. """
+        try:
+            fd = os.open(self._lease_path(task_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as lease_file:
+            lease_file.write(f'{self.worker_name} {time.time()}\n')
+        return True
+
+    def renew(self, task_id):
+        """ Renew the lease of a task that is still being calculated. """
+        try:
+            os.utime(self._lease_path(task_id))
+        except FileNotFoundError:
+            pass
+
+    def release(self, task_id):
+        """ Give up the lease of a task, e.g. after it failed, so that another worker can take it. """
+        try:
+            os.remove(self._lease_path(task_id))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, task_id, error_traceback):
+        """ Record a failed attempt of a task with the traceback of its error, and drop its lease so that it can be
+        attempted again, until it failed max_attempts times. """
+        failure_path = os.path.join(self.failure_dir, f'{task_id}.pkl')
+        attempts = self.load_failure(task_id)['attempts'] + 1 if os.path.isfile(failure_path) else 1
+        _write_pickle_atomic(failure_path, {'traceback': error_traceback, 'attempts': attempts,
+                                            'worker': self.worker_name})
+        self.release(task_id)
+        log.error(f'Task {task_id} failed on attempt {attempts} of {self.max_attempts}:\n{error_traceback}')
+
+    def complete(self, task_id, result):
+        """ Write the result of a task and drop its lease. """
+        _write_pickle_atomic(os.path.join(self.result_dir, f'{task_id}.pkl'), result)
+        self.release(task_id)
+
+
+def job_fingerprint(function, tasks, initializer, initargs):
+    """ Hash of the pickled function, tasks, initializer and initializer arguments of a job. """
+    return hashlib.sha256(pickle.dumps((function, list(tasks), initializer, initargs))).hexdigest()
+
+
+def _write_pickle_atomic(path, obj):
+    """ Pickle an object to a temporary file first and then move it in place, so readers never see partial files. """
+    tmp_path = f'{path}.tmp-{socket.gethostname()}-{os.getpid()}'
+    with open(tmp_path, 'wb') as tmp_file:
+        pickle.dump(obj, tmp_file)
+    os.replace(tmp_path, path)
+
+
+def _renew_lease_periodically(queue, task_id, stop_event):
+    """ Renew a lease four times per lease timeout, until stop_event is set. """
+    while not stop_event.wait(queue.lease_timeout / 4):
+        queue.renew(task_id)
+
+
+def run_queue_worker(queue_dir, poll_interval=None):
+    """
+    Calculate tasks from a queue directory until all of its tasks are finished.
+
+    While a task is being calculated, its lease gets renewed in the background. If no task is available but some are
+    still leased by other workers, the worker waits and checks again, to take over tasks from workers that die. A task
+    that raises an error is recorded as failed, see FileTaskQueue.fail(), and the worker goes on with the next task;
+    once all tasks are finished or failed for good, the worker stops.
+    :param queue_dir: string, path to the queue directory
+    :param poll_interval: float, seconds to wait between checks for available tasks; if None, read from configfile
+    :return: int, number of tasks this worker calculated
+    """
+    if poll_interval is None:
+        poll_interval = CONFIG_PASTIS.getfloat('numerical', 'queue_poll_interval', fallback=10)
+    queue = FileTaskQueue(queue_dir)
+
+    while not queue.is_submitted():
+        log.info(f'Waiting for a job to be submitted to {queue_dir}')
+        time.sleep(poll_interval)
+
+    job = queue.load_job()
+    queue.max_attempts = job.get('max_attempts', queue.max_attempts)
+    if job['initializer'] is not None:
+        job['initializer'](*job['initargs'])
+
+    num_done = 0
+    while not queue.is_settled():
+        task_id = queue.claim()
+        if task_id is None:
+            time.sleep(poll_interval)
+            continue
+
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=_renew_lease_periodically, args=(queue, task_id, stop_event), daemon=True)
+        heartbeat.start()
+        try:
+            result = job['function'](queue.load_task(task_id))
+        except Exception:
+            queue.fail(task_id, traceback.format_exc())
+            continue
+        except BaseException:
+            queue.release(task_id)
+            raise
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+        queue.complete(task_id, result)
+        num_done += 1
+
+    log.info(f'Worker {queue.worker_name} finished {num_done} tasks, queue {queue_dir} is settled')
+    return num_done
+
+
+def wait_for_queue(queue, progress_function=None, poll_interval=None, timeout=None):
+    """
+    Block until all tasks in a queue are finished.
+
+    Raises a RuntimeError with the traceback of the last error as soon as a task failed for good, see
+    FileTaskQueue.fail(), and a TimeoutError if the tasks are not finished within "timeout".
+    :param queue: FileTaskQueue
+    :param progress_function: callable or None, gets called with the number of finished and total tasks after each check
+    :param poll_interval: float, seconds between checks; if None, read from configfile
+    :param timeout: float or None, seconds after which to give up waiting; wait for as long as it takes if None
+    """
+    if poll_interval is None:
+        poll_interval = CONFIG_PASTIS.getfloat('numerical', 'queue_poll_interval', fallback=10)
+
+    t_start = time.time()
+    num_tasks = queue.num_tasks()
+    while True:
+        num_finished = queue.num_finished()
+        if progress_function is not None:
+            progress_function(num_finished, num_tasks)
+        if num_finished == num_tasks:
+            break
+        failed = sorted(queue.failed_ids())
+        if failed:
+            failure = queue.load_failure(failed[0])
+            raise RuntimeError(f'{len(failed)} tasks of the queue {queue.queue_dir} failed {queue.max_attempts} times, '
+                               f'e.g. task {failed[0]} with:\n{failure["traceback"]}')
+        if timeout is not None and time.time() - t_start > timeout:
+            raise TimeoutError(f'Only {num_finished} of {num_tasks} tasks of the queue {queue.queue_dir} were finished '
+                               f'after {timeout} s.')
+        time.sleep(poll_interval)
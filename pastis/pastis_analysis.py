@@ -252,22 +252,28 @@ def cumulative_contrast_e2e(instrument, pmodes, sigmas, sim_instance, dh_mask, n
     :return: cont_cum_e2e, list of cumulative or individual contrasts
     """
 
-    cont_cum_e2e = []
+    opds = []
     for maxmode in range(pmodes.shape[0]):
-        log.info(f'Working on mode {maxmode+1}/{pmodes.shape[0]}.')
-
         if individual:
             opd = pmodes[:, maxmode] * sigmas[maxmode]
         else:
             opd = np.nansum(pmodes[:, :maxmode+1] * sigmas[:maxmode+1], axis=1)
         opd *= u.nm    # the package is currently set up to spit out the modes in units of nm
+        opds.append(opd)
 
-        if instrument == 'LUVOIR':
-            sim_instance.flatten()
-            for seg, val in enumerate(opd):
-                sim_instance.set_segment(seg + 1, val.to(u.m).value/2, 0, 0)
-            im_data = sim_instance.calc_psf()
-            psf = im_data.shaped
+    if instrument == 'LUVOIR':
+        # Propagate the segment pistons of all modes through the simulator in stacks, see calc_psf_batch()
+        log.info(f'Working on {len(opds)} modes, in stacks of {sim_instance.batch_size()}.')
+        sim_instance.flatten()
+        commands = np.zeros((len(opds), sim_instance.sm.segnum, 3))
+        commands[:, :, 0] = [opd.to(u.m).value / 2 for opd in opds]
+        psfs = sim_instance.calc_psf_batch(commands.reshape(len(opds), -1), 'seg_mirror')
+        psfs = np.reshape(psfs, (len(opds),) + tuple(sim_instance.focal_det.shape))
+        return [util.dh_mean(psf / norm_direct, dh_mask) for psf in psfs]
+
+    cont_cum_e2e = []
+    for maxmode, opd in enumerate(opds):
+        log.info(f'Working on mode {maxmode+1}/{pmodes.shape[0]}.')
 
         if instrument == 'HiCAT':
             sim_instance.iris_dm.flatten()
@@ -2,6 +2,8 @@
 Plotting and animation functions for the PASTIS code.
 """
 import copy
+import functools
+import multiprocessing
 import os
 import glob
 import progressbar
@@ -723,7 +725,10 @@ def animate_contrast_matrix(data_path, instrument='LUVOIR', design='small', disp
     all_ote_images = read_ote_fits_files(data_path)
     print('All OTE fits files read')
     print('Reading PSF images...')
-    all_psf_images = read_psf_fits_files(data_path)
+    if os.path.isfile(os.path.join(data_path, 'matrix_numerical', 'psfs', 'psf_cube.npy')):
+        all_psf_images, _index = read_psf_cube(data_path)
+    else:
+        all_psf_images = read_psf_fits_files(data_path)
     print('All PSF fits files read')
 
     # Define some instrument specific parameters
@@ -980,6 +985,74 @@ def read_psf_fits_files(data_path):
     return all_psf_images
 
 
+def read_psf_cube(data_path):
+    """
+    Open the PSF cube of a PASTIS matrix calculation that was run with savepsfs='cube'.
+
+    The cube is memory-mapped, so PSFs are only read from disk when they are accessed, e.g. with all_psf_images[i] or
+    all_psf_images[start:stop].
+    :param data_path: string, path to PASTIS folder containing subdir "matrix_numerical" ff
+    :return: all_psf_images, array of shape (number of pairs, y, x) with the PSFs in the same order as the sorted PSF
+             fits files; index table, array with the frame number and the two (0-indexed) segments of each PSF
+    """
+    cube_path = os.path.join(data_path, 'matrix_numerical', 'psfs', 'psf_cube.npy')
+    if not os.path.isfile(cube_path):
+        raise FileNotFoundError(f'No PSF cube found at {cube_path}.')
+
+    return pastis.util.read_frame_cube(cube_path)
+
+
+def render_opd_cube(cube_path, out_dir, frame_numbers=None, name_prefix='opd', label_offset=0, num_processes=None,
+                    file_format='pdf'):
+    """
+    Render OPD maps that were stored in a frame cube during a matrix calculation to individual image files.
+
+    The frames are split over a multiprocessing pool. Frames that hold only the pixels inside the aperture get put
+    back onto the full pupil with the aperture mask stored next to the cube ("<name>_aperture.npy").
+    :param cube_path: string, path to the .npy OPD cube, e.g. ".../matrix_numerical/OTE_images/opd_cube.npy"
+    :param out_dir: string, directory to save the images to
+    :param frame_numbers: list of int, optional, frames to render; renders all frames if None
+    :param name_prefix: string, file names are the prefix followed by the frame labels from the index table
+    :param label_offset: int, added to the frame labels for the file names, e.g. 1 for segment numbers starting at 1
+    :param num_processes: int, optional, number of processes to use; uses all CPU cores if None
+    :param file_format: string, file extension of the images, e.g. 'pdf' or 'png'
+    """
+    _cube, index = pastis.util.read_frame_cube(cube_path)
+    if frame_numbers is None:
+        frame_numbers = index[:, 0]
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    chunks = [chunk for chunk in np.array_split(np.asarray(frame_numbers), num_processes) if chunk.size > 0]
+    if not chunks:
+        return
+
+    render_chunk = functools.partial(_render_opd_frames, cube_path, out_dir, name_prefix, label_offset, file_format)
+    with pastis.util.get_multiprocessing_context(['pastis.plotting']).Pool(len(chunks)) as pool:
+        pool.map(render_chunk, chunks)
+
+
+def _render_opd_frames(cube_path, out_dir, name_prefix, label_offset, file_format, frame_numbers):
+    """ Render a set of frames from an OPD cube; for render_opd_cube(). """
+    cube, index = pastis.util.read_frame_cube(cube_path)
+    aperture_path = os.path.splitext(cube_path)[0] + '_aperture.npy'
+    aperture = np.load(aperture_path) if cube.ndim == 2 else None
+
+    for frame_number in frame_numbers:
+        if aperture is not None:
+            opd_map = np.zeros(aperture.shape)
+            opd_map[aperture] = cube[frame_number]
+            opd_map = np.ma.masked_where(~aperture, opd_map)
+        else:
+            opd_map = np.asarray(cube[frame_number])
+
+        label = '-'.join(str(entry + label_offset) for entry in index[frame_number, 1:])
+        fig = plt.figure(figsize=(8, 8))
+        plt.imshow(opd_map, cmap='RdBu')
+        plt.colorbar(orientation='horizontal')
+        plt.savefig(os.path.join(out_dir, f'{name_prefix}_{label}.{file_format}'))
+        plt.close(fig)
+
+
 def atoi(text):
     # Taken from jost-package
     return int(text) if text.isdigit() else text
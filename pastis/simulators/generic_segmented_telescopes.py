@@ -11,8 +11,15 @@ import hcipy
 from hcipy.field import Field
 from hcipy.plotting import imshow_field
 
+from pastis.config import CONFIG_PASTIS
+
 log = logging.getLogger()
 
+# Complex arrays of the size of the pupil and of the final focal plane that exist for each wavefront of a stack while it
+# propagates through a coronagraph, see Telescope.batch_size()
+BATCH_PUPIL_ARRAYS = 8
+BATCH_FOCAL_ARRAYS = 2
+
 
 class SegmentedMirror(hcipy.OpticalElement):
     """A segmented mirror from a segmented aperture.
@@ -149,6 +156,28 @@ class SegmentedMirror(hcipy.OpticalElement):
                                self._coef[i - 1, 2] * self._seg_y[wseg])
         return Field(keep_surf, self.input_grid)
 
+    def surfaces(self, coefs):
+        """ Calculate the surfaces of a stack of PTT coefficient sets, without changing the mirror.
+
+        Parameters
+        ----------
+        coefs : array
+            Segment coefficients of shape (number of sets, segnum, 3), in the units of set_segment()
+        Returns
+        -------
+        ndarray
+            One surface in meters per coefficient set, of shape (number of sets, number of pupil pixels)
+        """
+        self._setup_grids()
+        coefs = np.asarray(coefs)
+        surfaces = np.zeros((coefs.shape[0], self._seg_x.size))
+        for i in self.segmentlist:
+            wseg = self._seg_indices[i][0]
+            surfaces[:, wseg] = (coefs[:, i - 1, 0, np.newaxis] +
+                                 coefs[:, i - 1, 1, np.newaxis] * self._seg_x[wseg] +
+                                 coefs[:, i - 1, 2, np.newaxis] * self._seg_y[wseg])
+        return surfaces
+
     def phase_for(self, wavelength):
         """Get the phase that is added to a wavefront with a specified wavelength.
         Parameters
@@ -163,6 +192,25 @@ class SegmentedMirror(hcipy.OpticalElement):
         return 2 * self.surface * 2 * np.pi / wavelength
 
 
+def dm_surfaces(dm, actuator_matrix):
+    """ Calculate the surfaces of a DM for a stack of commands, without changing the DM.
+
+    Parameters:
+    ----------
+    dm : hcipy.DeformableMirror or SegmentedMirror
+        The DM to calculate the surfaces of
+    actuator_matrix : array
+        One command per row; for a SegmentedMirror, its PTT coefficients of shape (segnum, 3), flattened
+
+    Returns:
+    --------
+    ndarray of shape (number of commands, number of pupil pixels), surfaces in meters
+    """
+    if isinstance(dm, SegmentedMirror):
+        return dm.surfaces(np.reshape(actuator_matrix, (-1, dm.segnum, 3)))
+    return np.asarray((dm.influence_functions.transformation_matrix @ np.transpose(actuator_matrix)).T)
+
+
 def load_segment_centers(input_dir, aper_ind_path, nseg, diameter):
     """ Load segment positions from fits header
 
@@ -226,6 +274,8 @@ class Telescope:
         Telescope aperture
     focal_det : hcipy.Grid
         Grid of focal plane coordinates that the final detector image gets sampled on.
+    focal_det_full : hcipy.Grid
+        Grid of the full detector image; focal_det can be a cropped part of it, see SegmentedAPLC.use_dh_focal_grid()
     sampling : float
         Sampling in focal plane in pixels per lambda/D
     imlamD : float
@@ -247,6 +297,7 @@ class Telescope:
         self.diam = diameter
         self.aperture = aper
         self.focal_det = focal_grid
+        self.focal_det_full = focal_grid
         self.sampling = sampling
         self.imlamD = imlamD
         self.lam_over_d = wvln / diameter
@@ -269,7 +320,7 @@ class Telescope:
         input_efield : hcipy.Wavefront
         """
 
-        norm_fac = np.max(self.focal_det.x) * self.pupil_grid.dims[0] / np.max(self.pupil_grid.x) / self.focal_det.dims[0]
+        norm_fac = np.max(self.focal_det_full.x) * self.pupil_grid.dims[0] / np.max(self.pupil_grid.x) / self.focal_det_full.dims[0]
         prop_before_norm = self.prop(input_efield)
         normalize = norm_fac * prop_before_norm.electric_field
         normalized_efield = hcipy.Wavefront(normalize, self.wvln)
@@ -468,6 +519,107 @@ class Telescope:
 
         return wf_image.intensity
 
+    def active_dms(self):
+        """ Return the entrance pupil DMs that calc_psf_batch() can command, keyed by their names in the intermediate
+        planes of calc_psf(); DMs that have not been created are None. """
+        return {'zernike_mirror': self.zernike_mirror,
+                'ripple_mirror': self.ripple_mirror,
+                'dm': self.dm}
+
+    def batch_size(self, memory_budget=None):
+        """ Number of wavefronts that calc_psf_batch() propagates at once, to stay within a memory budget.
+
+        Parameters:
+        ----------
+        memory_budget : float
+            Memory in bytes that one stack of wavefronts may use; "batch_memory_gb" from the configfile if None.
+
+        Returns:
+        --------
+        int, at least 1
+        """
+        if memory_budget is None:
+            memory_budget = CONFIG_PASTIS.getfloat('numerical', 'batch_memory_gb', fallback=2) * 1e9
+        bytes_per_wavefront = np.dtype(complex).itemsize * (BATCH_PUPIL_ARRAYS * self.pupil_grid.size +
+                                                            BATCH_FOCAL_ARRAYS * self.focal_det.size)
+        return max(1, int(memory_budget // bytes_per_wavefront))
+
+    def propagate_active_pupils_batch(self, actuator_matrix, which_dm, norm_one_photon=False):
+        """ Calculate the E-fields after all entrance pupil DMs, for a stack of commands of one of them.
+
+        The other DMs keep their current state, and so does the commanded DM itself.
+
+        Parameters:
+        ----------
+        actuator_matrix : array
+            One command of the DM per row, see dm_surfaces()
+        which_dm : string
+            Name of the DM to command, see active_dms()
+        norm_one_photon : bool
+            Whether or not to normalize the returned E-fields to one photon in the entrance pupil.
+
+        Returns:
+        --------
+        hcipy.Wavefront with one E-field per command
+        """
+        dm = self.active_dms().get(which_dm)
+        if dm is None:
+            raise ValueError(f'DM with name "{which_dm}" does not exist on this telescope.')
+
+        # All DMs only multiply their phase onto the same pupil, so each command changes the current E-field by the
+        # difference between its surface and the current surface of the DM
+        wf_active_pupil = self._propagate_active_pupils(norm_one_photon)[0]
+        surfaces = dm_surfaces(dm, actuator_matrix) - dm.surface
+        efields = wf_active_pupil.electric_field * np.exp(2j * wf_active_pupil.wavenumber * surfaces)
+        return hcipy.Wavefront(hcipy.Field(efields, self.pupil_grid), self.wvln)
+
+    def _propagate_batch_to_focal_plane(self, wf_pupils, norm_one_photon=False):
+        """ Propagate a stack of entrance pupil E-fields to the final focal plane, the same way as calc_psf(). """
+        if norm_one_photon:
+            return self.prop_norm_one_photon(wf_pupils)
+        return self.prop(wf_pupils)
+
+    def calc_psf_batch(self, actuator_matrix, which_dm, return_efield=False, norm_one_photon=False, memory_budget=None):
+        """ Calculate the PSFs of many commands of one DM, propagating them as stacks of wavefronts.
+
+        Every optic acts on a whole stack at once, so that each Fourier transform becomes one matrix-matrix product
+        instead of one matrix-vector product per command. The stacks are as large as batch_size() allows.
+
+        Parameters:
+        ----------
+        actuator_matrix : array
+            One command of the DM per row, see dm_surfaces()
+        which_dm : string
+            Name of the DM to command, see active_dms()
+        return_efield : bool
+            Whether to return the focal plane E-fields instead of the intensities.
+        norm_one_photon : bool
+            Whether or not to normalize the returned E-fields and intensities to one photon in the entrance pupil.
+        memory_budget : float
+            Memory in bytes that one stack of wavefronts may use, see batch_size()
+
+        Returns:
+        --------
+        Field of shape (number of commands, number of focal plane pixels)
+            Intensities, or complex E-fields if return_efield is True, of the same normalization as from calc_psf()
+        """
+        actuator_matrix = np.atleast_2d(actuator_matrix)
+        batch_size = self.batch_size(memory_budget)
+
+        images = None
+        for start in range(0, actuator_matrix.shape[0], batch_size):
+            wf_pupils = self.propagate_active_pupils_batch(actuator_matrix[start:start + batch_size], which_dm,
+                                                           norm_one_photon)
+            batch = self._propagate_batch_to_focal_plane(wf_pupils, norm_one_photon).electric_field
+            if not return_efield:
+                # hcipy takes a stack of E-fields for one vector field, whose intensity is the sum over the stack
+                batch = np.abs(batch) ** 2
+            if images is None:
+                images = np.empty((actuator_matrix.shape[0], batch.shape[-1]), dtype=batch.dtype)
+            images[start:start + batch_size] = batch
+
+        return hcipy.Field(images, self.focal_det)
+
     def create_zernike_wfs(self, step=None, spot_diam=None, spot_points=None):
         """ Create a Zernike wavefront sensor object. """
         if step is None:
@@ -562,6 +714,13 @@ class SegmentedTelescope(Telescope):
         self.sm = SegmentedMirror(indexed_aperture=indexed_aper, seg_pos=seg_pos)    # TODO: replace this with None when fully ready to start using create_segmented_mirror()
         self.harris_sm = None
 
+    def active_dms(self):
+        """ Return the entrance pupil DMs that calc_psf_batch() can command, including the segmented mirrors. """
+        dms = super().active_dms()
+        dms['seg_mirror'] = self.sm
+        dms['harris_seg_mirror'] = self.harris_sm
+        return dms
+
     def set_segment(self, segid, piston, tip, tilt):
         """ Set an individual segment of the SegmentedMirror to a piston/tip/tilt command.
 
@@ -1031,9 +1190,49 @@ class SegmentedAPLC(SegmentedTelescope):
         self.coro_no_ls = hcipy.LyotCoronagraph(self.pupil_grid, fpm)
         self.iwa = iwa
         self.owa = owa
-        dh_outer = hcipy.circular_aperture(2 * owa * self.lam_over_d)(self.focal_det)
-        dh_inner = hcipy.circular_aperture(2 * iwa * self.lam_over_d)(self.focal_det)
-        self.dh_mask = (dh_outer - dh_inner).astype('bool')
+        self.dh_mask = self._create_dh_mask(self.focal_det)
+
+    def _create_dh_mask(self, focal_grid):
+        """ Create the boolean DH mask between IWA and OWA on a focal plane grid. """
+        dh_outer = hcipy.circular_aperture(2 * self.owa * self.lam_over_d)(focal_grid)
+        dh_inner = hcipy.circular_aperture(2 * self.iwa * self.lam_over_d)(focal_grid)
+        return (dh_outer - dh_inner).astype('bool')
+
+    def use_dh_focal_grid(self, dh_only=True):
+        """ Propagate onto a focal grid that only covers the dark hole, or back onto the full detector grid.
+
+        The dark hole grid is the smallest rectangular part of the detector grid that contains all DH pixels, so that
+        the final matrix Fourier transform can stay separable. It shrinks the last propagation, and all focal plane
+        images and E-fields, by the fraction of the detector outside of the DH. The remaining pixels are the same as on
+        the full grid, including the optical axis that the direct PSF peaks on, and so is the normalization; dh_mask
+        is replaced by the DH mask on the new grid.
+
+        Parameters:
+        ----------
+        dh_only : bool
+            Whether to use the dark hole grid, or the full detector grid again.
+        """
+        full_mask = self._create_dh_mask(self.focal_det_full)
+        if dh_only:
+            # Crop the coordinates and the mask of the full grid, so that the DH pixels are exactly the same
+            rows = slice(*np.flatnonzero(np.any(full_mask.shaped, axis=1))[[0, -1]] + [0, 1])
+            cols = slice(*np.flatnonzero(np.any(full_mask.shaped, axis=0))[[0, -1]] + [0, 1])
+            x, y = self.focal_det_full.separated_coords
+            self.focal_det = hcipy.CartesianGrid(hcipy.SeparatedCoords((x[cols], y[rows])))
+            self.dh_mask = hcipy.Field(full_mask.shaped[rows, cols].ravel(), self.focal_det)
+            log.info(f'Propagating onto the {self.focal_det.dims[0]}x{self.focal_det.dims[1]} pixels around the dark '
+                     f'hole, out of {self.focal_det_full.dims[0]}x{self.focal_det_full.dims[1]} detector pixels')
+        else:
+            self.focal_det = self.focal_det_full
+            self.dh_mask = full_mask
+
+        self.prop = hcipy.FraunhoferPropagator(self.pupil_grid, self.focal_det)
+
+    def _propagate_batch_to_focal_plane(self, wf_pupils, norm_one_photon=False):
+        """ Propagate a stack of entrance pupil E-fields through the APLC to the final focal plane. """
+        wf_apod = hcipy.Apodizer(self.apodizer)(wf_pupils)
+        wf_lyot = self.coro(wf_apod)
+        return super()._propagate_batch_to_focal_plane(wf_lyot, norm_one_photon)
 
     def calc_psf(self, ref=False, display_intermediate=False,  return_intermediate=None, norm_one_photon=False):
         """ Calculate the PSF of the segmented APLC, normalized to contrast units. Optionally return reference (direct
@@ -49,6 +49,12 @@ class Habex_VC(Telescope):
         dh_inner = hcipy.circular_aperture(2 * self.iwa * self.lam_over_d)(self.focal_det)
         self.dh_mask = (dh_outer - dh_inner).astype('bool')
         
+    def _propagate_batch_to_focal_plane(self, wf_pupils, norm_one_photon=False):
+        """ Propagate a stack of entrance pupil E-fields through the vortex coronagraph to the final focal plane. """
+        wf_lyot = self.lyot_mask(self.coro(wf_pupils))
+        wf_lyot.wavelength = self.wvln
+        return self.prop(wf_lyot)
+
     def calc_psf(self, ref=False, display_intermediate=False,  return_intermediate=None, norm_one_photon=False):
         """ Calculate the PSF of this telescope, and return optionally all E-fields.
 
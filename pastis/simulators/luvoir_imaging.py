@@ -176,6 +176,19 @@ class LuvoirBVortex(SegmentedTelescope):
         # Calculate segment circumscribed diameter from flat-to-flat distance, and scale from 8m to pupil size used here
         self.segment_circum_diameter = 2 / np.sqrt(3) * 0.955 * (self.D_pup/8)   # m
 
+    def _propagate_batch_to_focal_plane(self, wf_pupils, norm_one_photon=False):
+        """ Propagate a stack of entrance pupil E-fields through the DMs and the vortex coronagraph of LUVOIR B to the
+        final focal plane. """
+        wf_dm1_coro = hcipy.Wavefront(wf_pupils.electric_field * np.exp(4 * 1j * np.pi/self.wavelength * self.DM1), self.wavelength)
+        wf_dm2_coro_before = self.fresnel(wf_dm1_coro)
+        wf_dm2_coro_after = hcipy.Wavefront(wf_dm2_coro_before.electric_field * np.exp(4 * 1j * np.pi / self.wavelength * self.DM2) * self.DM2_circle, self.wavelength)
+        wf_back_at_dm1 = self.fresnel_back(wf_dm2_coro_after)
+        wf_apod_stop = hcipy.Wavefront(wf_back_at_dm1.electric_field * self.apod_stop, self.wavelength)
+
+        wf_lyot = self.lyot_mask(self.coro(wf_apod_stop))
+        wf_lyot.wavelength = self.wavelength
+        return self.prop(wf_lyot)
+
     def calc_psf(self, ref=False, display_intermediate=False,  return_intermediate=None):
         """ Calculate the PSF of LUVOIR B, and return optionally all E-fields.
 
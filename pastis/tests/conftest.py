@@ -0,0 +1,26 @@
+import pytest
+
+from pastis.config import CONFIG_PASTIS
+
+
+@pytest.fixture
+def numerical_config():
+    """ Set keys of the [numerical] section of the configfile, and restore their values after the test.
+
+    The fixture is a function that takes the keys and their values as keyword arguments, and can be called again
+    during the test to change them.
+    """
+    saved_values = {}
+
+    def set_numerical_config(**values):
+        for key, value in values.items():
+            saved_values.setdefault(key, CONFIG_PASTIS.get('numerical', key, fallback=None))
+            CONFIG_PASTIS.set('numerical', key, value)
+
+    yield set_numerical_config
+
+    for key, value in saved_values.items():
+        if value is None:
+            CONFIG_PASTIS.remove_option('numerical', key)
+        else:
+            CONFIG_PASTIS.set('numerical', key, value)
@@ -0,0 +1,53 @@
+""" Small segmented telescopes built from hcipy only, for tests that need a simulator but no optics files. """
+import hcipy
+import numpy as np
+
+from pastis.simulators.generic_segmented_telescopes import SegmentedAPLC
+
+WAVELENGTH = 500e-9    # m
+DIAMETER = 1.          # m
+GAP_SIZE = 0.01        # m
+
+
+def make_segmented_aplc(fpm_rad=3, owa=10, lyot_stop_diameter=0.9, apodizer_width=None, num_rings=1, npix=128,
+                        sampling=4):
+    """ Create an APLC on a hexagonal segmented aperture, with 7 segments for one segment ring.
+
+    :param fpm_rad: float, FPM radius in lambda/D; the IWA is half a lambda/D further out
+    :param owa: float, outer working angle in lambda/D
+    :param lyot_stop_diameter: float, diameter of the circular Lyot stop as a fraction of the pupil diameter
+    :param apodizer_width: float or None, 1/e radius of a Gaussian apodizer in m, or None for a clear apodizer
+    :param num_rings: int, number of segment rings around the central segment
+    :param npix: int, number of pupil pixels across
+    :param sampling: float, focal plane sampling in pixels per lambda/D
+    :return: SegmentedAPLC
+    """
+    pupil_grid = hcipy.make_pupil_grid(npix, DIAMETER * 1.05)
+    segment_flat_to_flat = (DIAMETER - 2 * num_rings * GAP_SIZE) / (2 * num_rings + 1)
+    aperture, segments = hcipy.make_hexagonal_segmented_aperture(num_rings, segment_flat_to_flat, GAP_SIZE,
+                                                                 return_segments=True)
+    aperture = hcipy.evaluate_supersampled(aperture, pupil_grid, 2)
+    indexed_aperture = np.zeros(pupil_grid.size)
+    for segment_index, segment in enumerate(hcipy.evaluate_supersampled(segments, pupil_grid, 2)):
+        indexed_aperture[segment > 0.5] = segment_index + 1
+    indexed_aperture = hcipy.Field(indexed_aperture, pupil_grid)
+    segment_positions = hcipy.make_hexagonal_grid(segment_flat_to_flat + GAP_SIZE, num_rings)
+
+    if apodizer_width is None:
+        apodizer = hcipy.Field(np.ones(pupil_grid.size), pupil_grid)
+    else:
+        apodizer = hcipy.Field(np.exp(-(pupil_grid.as_('polar').r / apodizer_width) ** 2), pupil_grid)
+    lyot_stop = hcipy.circular_aperture(lyot_stop_diameter * DIAMETER)(pupil_grid)
+
+    lam_over_d = WAVELENGTH / DIAMETER
+    fpm_grid = hcipy.make_focal_grid(8, fpm_rad + 1, pupil_diameter=DIAMETER, focal_length=1,
+                                     reference_wavelength=WAVELENGTH)
+    fpm = 1 - hcipy.circular_aperture(2 * fpm_rad * lam_over_d)(fpm_grid)
+    imlamD = int(np.ceil(1.2 * owa))
+    focal_grid = hcipy.make_focal_grid(sampling, imlamD, pupil_diameter=DIAMETER, focal_length=1,
+                                       reference_wavelength=WAVELENGTH)
+
+    return SegmentedAPLC(apod=apodizer, lyot_stop=lyot_stop, fpm=fpm, fpm_rad=fpm_rad, iwa=fpm_rad + 0.5, owa=owa,
+                         indexed_aper=indexed_aperture, seg_pos=segment_positions,
+                         seg_diameter=segment_flat_to_flat * 2 / np.sqrt(3), wvln=WAVELENGTH, diameter=DIAMETER,
+                         aper=aperture, focal_grid=focal_grid, sampling=sampling, imlamD=imlamD)
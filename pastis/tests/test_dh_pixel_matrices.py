@@ -0,0 +1,34 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+
+from pastis.matrix_generation.dh_pixel_matrices import annulus_mask, pastis_matrix_from_dh_pixels
+from pastis.matrix_generation.matrix_building_numerical import (PastisMatrixIntensities, pastis_from_contrast_matrix,
+                                                                save_pair_psf)
+from pastis import util
+
+
+def test_dh_zone_matrices(tmpdir):
+    # Check that matrices of a dark hole zone calculated from the stored dark hole pixels match those from the full PSFs.
+
+    nseg = 4
+    shape = (12, 12)
+    rng = np.random.default_rng(5)
+    dh_mask = annulus_mask(shape, 2, 6)
+    coro_psf = rng.uniform(size=shape) * 1e-10
+    matrix = SimpleNamespace(resDir=str(tmpdir), nb_seg=nseg, reference_images={'dh_mask': dh_mask, 'coro_psf': coro_psf})
+    os.makedirs(os.path.join(matrix.resDir, 'psfs'))
+    PastisMatrixIntensities.create_dh_pixel_cube(matrix)
+
+    zone = dh_mask & (np.indices(shape)[1] > 6)
+    expected_contrast = np.zeros((nseg, nseg))
+    for pair in util.segment_pairs_non_repeating(nseg):
+        psf = coro_psf + rng.uniform(size=shape) * 1e-9
+        save_pair_psf(psf, pair, '', matrix.resDir, 'dh')
+        expected_contrast[pair[0], pair[1]] = np.mean(psf[zone])
+
+    contrast_matrix, matrix_pastis = pastis_matrix_from_dh_pixels(matrix.resDir, zone, 1e-9)
+    expected_pastis = pastis_from_contrast_matrix(expected_contrast.copy(), np.arange(nseg), 1e-9, np.mean(coro_psf[zone]))
+    assert np.allclose(contrast_matrix, expected_contrast, rtol=1e-6, atol=0), 'Zone contrasts are wrong.'
+    assert np.allclose(matrix_pastis, expected_pastis, rtol=1e-4, atol=1e-6 * np.abs(expected_pastis).max()), \
+        'Zone PASTIS matrix is wrong.'
@@ -117,3 +117,41 @@ def test_continuous_dm():
     tel.dm.actuators = dm_command
     coro_aberrated = tel.calc_psf()
     assert np.sum(coro_perfect/ref.max()) < np.sum(coro_aberrated/ref.max())
+
+
+def test_dh_focal_grid():
+    tel = HexRingAPLC(OPTICS_DIR, num_rings=1, sampling=SAMPLING)
+    tel.create_segmented_mirror(3)
+    tel.sm.actuators = np.random.default_rng(2).normal(0, 1e-9, tel.sm.num_actuators)
+    coro_full, ref_full = tel.calc_psf(ref=True, norm_one_photon=True)
+    dh_mask_full = tel.dh_mask
+
+    tel.use_dh_focal_grid()
+    coro_dh, ref_dh = tel.calc_psf(ref=True, norm_one_photon=True)
+    assert tel.focal_det.size < tel.focal_det_full.size, 'The dark hole grid is not smaller than the detector.'
+    assert np.count_nonzero(tel.dh_mask) == np.count_nonzero(dh_mask_full), 'The dark hole grid lost DH pixels.'
+    assert np.allclose(coro_dh[tel.dh_mask], coro_full[dh_mask_full], rtol=1e-8, atol=0), 'DH intensities differ.'
+    assert np.max(ref_dh) == np.max(ref_full), 'Direct PSF peak differs.'
+
+    tel.use_dh_focal_grid(False)
+    assert tel.calc_psf().size == coro_full.size, 'Switching back to the full detector grid failed.'
+
+
+def test_calc_psf_batch():
+    tel = HexRingAPLC(OPTICS_DIR, num_rings=1, sampling=SAMPLING)
+    tel.create_segmented_mirror(3)
+    commands = np.random.default_rng(3).normal(0, 1e-9, (5, tel.sm.num_actuators))
+
+    # Stacks of two wavefronts at a time, so that the batches get split and put back together
+    memory_budget = 2 * 16 * (8 * tel.pupil_grid.size + 2 * tel.focal_det.size)
+    efields = tel.calc_psf_batch(commands, 'seg_mirror', return_efield=True, norm_one_photon=True,
+                                 memory_budget=memory_budget)
+    intensities = tel.calc_psf_batch(commands, 'seg_mirror', memory_budget=memory_budget)
+    assert tel.batch_size(memory_budget) == 2
+    assert np.all(tel.sm.actuators == 0), 'The batch changed the state of the DM.'
+
+    for command, efield, intensity in zip(commands, efields, intensities):
+        tel.sm.actuators = command
+        wf_single, _inter = tel.calc_psf(return_intermediate='efield', norm_one_photon=True)
+        assert np.allclose(efield, wf_single.electric_field, rtol=1e-8, atol=1e-12 * np.abs(efield).max())
+        assert np.allclose(intensity, tel.calc_psf(), rtol=1e-8, atol=1e-12 * intensity.max())
@@ -0,0 +1,24 @@
+import numpy as np
+
+from pastis.matrix_generation import matrix_completion
+
+
+def test_low_rank_completion():
+    # Check that a rank-4 PSD matrix is recovered from its diagonal and 30% of its off-diagonal elements.
+
+    rng = np.random.default_rng(5)
+    nseg = 40
+    root = rng.normal(size=(nseg, 4))
+    matrix = root @ root.T
+
+    known = np.eye(nseg, dtype=bool)
+    seg_i, seg_j = np.triu_indices(nseg, k=1)
+    measured = rng.random(seg_i.size) < 0.3
+    known[seg_i[measured], seg_j[measured]] = True
+    known |= known.T
+
+    rank = matrix_completion.choose_completion_rank(matrix, known, np.random.default_rng(0))
+    assert rank == 4, 'Wrong completion rank chosen.'
+
+    completed = matrix_completion.complete_psd_matrix(matrix, known, rank)
+    assert matrix_completion.relative_rms_error(completed[~known], matrix[~known]) < 1e-3, 'Missing elements not recovered.'
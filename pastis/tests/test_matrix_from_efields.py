@@ -0,0 +1,275 @@
+import functools
+import os
+from types import SimpleNamespace
+import numpy as np
+
+from pastis.matrix_generation.matrix_from_efields import (EFIELD_CUBE_NAME, EFIELD_PROGRESS_NAME,
+                                                           IncrementalPastisMatrix, MatrixEfieldLuvoirA,
+                                                           MatrixEfieldLuvoirADesigns, PastisMatrixEfields,
+                                                           calculate_semi_analytic_pastis_from_efields,
+                                                           dh_difference_vectors, mark_mode_done, pastis_cross_matrix,
+                                                           pastis_matrix_from_efield_cube, pastis_matrix_from_efields,
+                                                           save_mode_efield)
+from pastis import util
+from pastis.tests.synthetic_telescopes import make_segmented_aplc
+
+
+def test_semi_analytic_pastis_from_efields():
+    # Check that the matrix product over the dark hole pixels gives the pair-wise dark hole means of the E-field products.
+
+    rng = np.random.default_rng(7)
+    nb_modes = 6
+    efield_ref = rng.normal(size=(10, 10)) + 1j * rng.normal(size=(10, 10))
+    efields = efield_ref + 1e-2 * (rng.normal(size=(nb_modes, 10, 10)) + 1j * rng.normal(size=(nb_modes, 10, 10)))
+    dh_mask = np.zeros((10, 10))
+    dh_mask[2:5, 3:9] = 1
+    direct_norm = 3.
+
+    expected = np.zeros((nb_modes, nb_modes))
+    for pair in util.segment_pairs_non_repeating(nb_modes):
+        intensity_im = np.real((efields[pair[0]] - efield_ref) * np.conj(efields[pair[1]] - efield_ref))
+        expected[pair[0], pair[1]] = util.dh_mean(intensity_im / direct_norm, dh_mask)
+
+    matrix_half = calculate_semi_analytic_pastis_from_efields(efields, efield_ref, direct_norm, dh_mask)
+    assert np.allclose(matrix_half, expected, rtol=1e-12, atol=0), 'Half PASTIS matrix does not match pair-wise calculation.'
+
+    # Flattened E-fields, as from the hcipy simulators, and a weighted dark hole
+    dh_mask[2, 3] = 0.5
+    expected[0, 0] = util.dh_mean(np.abs(efields[0] - efield_ref) ** 2 / direct_norm, dh_mask)
+    matrix_half = calculate_semi_analytic_pastis_from_efields(efields.reshape(nb_modes, -1), efield_ref.ravel(),
+                                                              direct_norm, dh_mask.ravel())
+    assert np.isclose(matrix_half[0, 0], expected[0, 0], rtol=1e-12, atol=0), 'Weighted dark hole mean is wrong.'
+
+
+def test_efield_cube(tmpdir):
+    # Check that E-fields written into the cube one mode at a time are read back in place, with their progress flags.
+
+    efield_dir = os.path.join(str(tmpdir), 'efields')
+    os.makedirs(efield_dir)
+    nb_modes = 5
+    util.create_frame_cube(os.path.join(efield_dir, EFIELD_CUBE_NAME), list(range(nb_modes)), (4, 3), complex)
+    progress = np.lib.format.open_memmap(os.path.join(efield_dir, EFIELD_PROGRESS_NAME), mode='w+', dtype=bool,
+                                         shape=(nb_modes,))
+    del progress
+
+    rng = np.random.default_rng(3)
+    efields = rng.normal(size=(nb_modes, 4, 3)) + 1j * rng.normal(size=(nb_modes, 4, 3))
+    for mode_no in [3, 0, 4]:
+        save_mode_efield(efields[mode_no], mode_no, efield_dir, 'focal', 'cube')
+        mark_mode_done(str(tmpdir), mode_no)
+
+    cube, _ = util.read_frame_cube(os.path.join(efield_dir, EFIELD_CUBE_NAME))
+    progress = np.load(os.path.join(efield_dir, EFIELD_PROGRESS_NAME))
+    assert np.array_equal(progress, [True, False, False, True, True]), 'Wrong modes are marked as done.'
+    assert np.array_equal(cube[progress], efields[progress]), 'E-fields in the cube are wrong.'
+
+
+def test_pastis_matrix_from_efield_cube(tmpdir):
+    # Check that the matrix calculated block by block from an E-field cube on disk is the same as the one in memory.
+
+    rng = np.random.default_rng(11)
+    nb_modes = 23
+    efield_ref = rng.normal(size=(12, 12)) + 1j * rng.normal(size=(12, 12))
+    cube_path = os.path.join(str(tmpdir), EFIELD_CUBE_NAME)
+    cube = util.create_frame_cube(cube_path, list(range(nb_modes)), (12, 12), complex)
+    cube[:] = efield_ref + 1e-2 * (rng.normal(size=(nb_modes, 12, 12)) + 1j * rng.normal(size=(nb_modes, 12, 12)))
+    cube.flush()
+    efields, _index = util.read_frame_cube(cube_path)
+    dh_mask = np.zeros((12, 12))
+    dh_mask[3:9, 2:10] = rng.uniform(0.5, 1, size=(6, 8))
+
+    # A budget for tiles of a few modes only, so that the matrix is put together from many blocks
+    matrix_path = os.path.join(str(tmpdir), 'pastis_matrix.npy')
+    matrix_pastis = pastis_matrix_from_efield_cube(efields, efield_ref, 2., dh_mask, 1e-9, matrix_path,
+                                                   memory_budget=20000)
+    expected = pastis_matrix_from_efields(np.asarray(efields), efield_ref, 2., dh_mask, 1e-9)
+    assert isinstance(matrix_pastis, np.memmap), 'The matrix is not memory-mapped.'
+    assert np.allclose(matrix_pastis, expected, rtol=1e-10, atol=0), 'The blocked PASTIS matrix is wrong.'
+    assert np.array_equal(matrix_pastis, matrix_pastis.T), 'The blocked PASTIS matrix is not symmetric.'
+    assert not os.path.exists(os.path.join(str(tmpdir), 'pastis_matrix_dh_differences.npy'))
+
+
+def test_incremental_pastis_matrix():
+    # Check that the matrix filled one mode at a time, in any order, is the same as the one calculated at once.
+
+    rng = np.random.default_rng(13)
+    nb_modes = 9
+    efield_ref = rng.normal(size=(10, 10)) + 1j * rng.normal(size=(10, 10))
+    efields = efield_ref + 1e-2 * (rng.normal(size=(nb_modes, 10, 10)) + 1j * rng.normal(size=(nb_modes, 10, 10)))
+    dh_mask = np.zeros((10, 10))
+    dh_mask[1:6, 2:8] = rng.uniform(0.5, 1, size=(5, 6))
+
+    incremental = IncrementalPastisMatrix(nb_modes, efield_ref, 2., dh_mask)
+    for index in rng.permutation(nb_modes):
+        dh_vector = incremental.dh_vector(efields[index])
+        assert dh_vector.size == 2 * np.count_nonzero(dh_mask), 'Only the dark hole pixels should be kept.'
+        incremental.add_mode(index, dh_vector)
+
+    wfe_aber = 2e-9
+    expected = pastis_matrix_from_efields(efields, efield_ref, 2., dh_mask, wfe_aber)
+    assert np.allclose(incremental.matrix / (wfe_aber * 1e9)**2, expected, rtol=1e-10, atol=0), \
+        'The incremental PASTIS matrix is wrong.'
+    assert np.array_equal(incremental.matrix, incremental.matrix.T), 'The incremental PASTIS matrix is not symmetric.'
+
+
+def test_pastis_cross_matrix():
+    # Check that the cross block between two sets of modes is the off-diagonal block of the matrix of all modes together.
+
+    rng = np.random.default_rng(17)
+    efield_ref = rng.normal(size=(10, 10)) + 1j * rng.normal(size=(10, 10))
+    efields = efield_ref + 1e-2 * (rng.normal(size=(11, 10, 10)) + 1j * rng.normal(size=(11, 10, 10)))
+    dh_mask = np.zeros((10, 10))
+    dh_mask[2:8, 1:7] = rng.uniform(0.5, 1, size=(6, 6))
+    in_dh = dh_mask.ravel() != 0
+
+    cross_matrix = pastis_cross_matrix(dh_difference_vectors(efields[:4], efield_ref, in_dh),
+                                       dh_difference_vectors(efields[4:], efield_ref, in_dh), 2., dh_mask, 1e-9)
+    expected = pastis_matrix_from_efields(efields, efield_ref, 2., dh_mask, 1e-9)
+    assert cross_matrix.shape == (4, 7), 'The cross matrix has the wrong shape.'
+    assert np.allclose(cross_matrix, expected[:4, 4:], rtol=1e-10, atol=0), 'The cross PASTIS matrix is wrong.'
+
+
+def test_zone_matrices(tmpdir):
+    # Check that the matrices of parts of the dark hole are the PASTIS matrices calculated with the zones as masks.
+
+    rng = np.random.default_rng(19)
+    nb_modes = 5
+    efield_ref = rng.normal(size=100) + 1j * rng.normal(size=100)
+    efields = efield_ref + 1e-2 * (rng.normal(size=(nb_modes, 100)) + 1j * rng.normal(size=(nb_modes, 100)))
+    dh_mask = np.zeros((10, 10), dtype=bool)
+    dh_mask[1:9, 2:9] = True
+    zones = {'left': dh_mask & (np.indices((10, 10))[1] < 5), 'weighted': dh_mask * rng.uniform(size=(10, 10))}
+    matrix = SimpleNamespace(resDir=str(tmpdir), dh_mask=dh_mask.ravel(), efield_ref=efield_ref, norm=2., wfe_aber=1e-9,
+                             wvln=500e-9, streamed_matrix=None, efields_per_mode=efields,
+                             versioned_name=lambda name: name)
+    matrix.mode_dh_vectors = lambda: PastisMatrixEfields.mode_dh_vectors(matrix)
+    PastisMatrixEfields.calculate_zone_matrices(matrix, {name: zone.ravel() for name, zone in zones.items()})
+
+    for name, zone in zones.items():
+        expected = pastis_matrix_from_efields(efields, efield_ref, 2., zone.ravel(), 1e-9)
+        assert np.allclose(matrix.zone_matrices[name], expected, rtol=1e-10, atol=0), f'Matrix of zone {name} is wrong.'
+        assert os.path.isfile(os.path.join(str(tmpdir), f'pastis_matrix_{name}.fits'))
+        assert np.array_equal(np.load(os.path.join(str(tmpdir), f'dh_zone_{name}_mask.npy')), zone.ravel())
+
+
+def _analytic_single_mode(efield_ref, mode_differences, mode_no):
+    return {'efield_science_plane': efield_ref + mode_differences[mode_no]}
+
+
+class _AnalyticEfieldMatrix(PastisMatrixEfields):
+    """ E-field matrix of fixed random modes, whose E-field dicts only have a science plane, like the ones of RST. """
+    instrument = 'RST'
+
+    def __init__(self, initial_path):
+        super().__init__(nb_seg=6, seglist=np.arange(6), calc_science=True, calc_wfs=False, initial_path=initial_path,
+                         saveefields=False, saveopds=False)
+
+    def calculate_ref_efield(self):
+        rng = np.random.default_rng(29)
+        self.efield_ref = rng.normal(size=64) + 1j * rng.normal(size=64)
+        self.mode_differences = 1e-2 * (rng.normal(size=(6, 64)) + 1j * rng.normal(size=(6, 64)))
+        self.norm = 2.
+        self.dh_mask = np.zeros(64)
+        self.dh_mask[10:40] = 1
+
+    def setup_deformable_mirror(self):
+        self.number_all_modes = 6
+
+    def setup_single_mode_function(self):
+        self.calculate_one_mode = functools.partial(_analytic_single_mode, self.efield_ref, self.mode_differences)
+
+    def setup_worker(self):
+        self.setup_single_mode_function()
+
+
+def test_streaming_without_wfs(tmpdir, numerical_config):
+    # Check that a streamed matrix of modes without WFS plane E-fields is the one from the full E-fields, in this process
+    # and in a pool.
+
+    numerical_config(threads_per_process='1', num_processes='1')
+    expected = _AnalyticEfieldMatrix(str(tmpdir))
+    expected.calc()
+
+    for num_processes in ['1', '2']:
+        numerical_config(num_processes=num_processes)
+        streamed = _AnalyticEfieldMatrix(str(tmpdir))
+        streamed.calc(streaming=True)
+        assert np.allclose(streamed.matrix_pastis, expected.matrix_pastis, rtol=1e-10, atol=0), \
+            f'Streamed PASTIS matrix with {num_processes} processes is wrong.'
+        assert len(streamed.efields_per_mode_wfs) == 0, 'No WFS plane E-fields should be kept.'
+
+
+# Two APLC designs on the same synthetic segmented aperture, standing in for the LUVOIR-A designs
+SYNTHETIC_DESIGNS = {'small': {'fpm_rad': 3, 'owa': 10},
+                     'large': {'fpm_rad': 4, 'owa': 14, 'lyot_stop_diameter': 0.8, 'apodizer_width': 0.4}}
+
+
+class _SyntheticDesigns(MatrixEfieldLuvoirADesigns):
+    def create_design_simulator(self, design):
+        return make_segmented_aplc(**SYNTHETIC_DESIGNS[design])
+
+
+class _SyntheticDesign(MatrixEfieldLuvoirA):
+    def instantiate_simulator(self):
+        self.simulator = make_segmented_aplc(**SYNTHETIC_DESIGNS[self.design])
+
+
+def test_design_matrices(tmpdir, numerical_config):
+    # Check that the matrix of each design calculated together with the other designs is the one of a separate run of
+    # that design, also when streamed in a pool, and that the matrices can be updated per segment.
+
+    numerical_config(threads_per_process='1', num_processes='1')
+    expected = {}
+    for design in SYNTHETIC_DESIGNS:
+        single_design = _SyntheticDesign('seg_mirror', 1, design=design, initial_path=str(tmpdir),
+                                         saveefields=False, saveopds=False)
+        single_design.calc()
+        expected[design] = single_design.matrix_pastis
+
+    designs = _SyntheticDesigns('seg_mirror', 1, designs=list(SYNTHETIC_DESIGNS), initial_path=str(tmpdir),
+                                saveopds=False)
+    designs.calc()
+    for design in SYNTHETIC_DESIGNS:
+        assert np.allclose(designs.design_matrices[design], expected[design], rtol=1e-10, atol=0), \
+            f'PASTIS matrix of design {design} is wrong.'
+
+    # An update without any change of the model gives the same matrices again
+    update = _SyntheticDesigns('seg_mirror', 1, designs=list(SYNTHETIC_DESIGNS), resume_dir=designs.overall_dir)
+    update.update_segments([0, 4])
+    for design in SYNTHETIC_DESIGNS:
+        assert np.allclose(update.design_matrices[design], expected[design], rtol=1e-10, atol=0), \
+            f'Updated PASTIS matrix of design {design} is wrong.'
+        assert os.path.isfile(os.path.join(update.resDir, design, 'pastis_matrix_v2.fits'))
+
+    numerical_config(num_processes='2')
+    streamed = _SyntheticDesigns('seg_mirror', 1, designs=list(SYNTHETIC_DESIGNS), initial_path=str(tmpdir),
+                                 saveefields=False, saveopds=False)
+    streamed.calc(streaming=True, dh_zones={'large': {'all': streamed.design_simulators['large'].dh_mask}})
+    for design in SYNTHETIC_DESIGNS:
+        assert np.allclose(streamed.design_matrices[design], expected[design], rtol=1e-10, atol=0), \
+            f'Streamed PASTIS matrix of design {design} is wrong.'
+    assert list(streamed.design_zone_matrices) == ['large'], 'Zone matrices of the wrong designs.'
+    assert np.allclose(streamed.design_zone_matrices['large']['all'], expected['large'], rtol=1e-10, atol=0), \
+        'Matrix of the zone that covers the whole dark hole is wrong.'
+
+
+def test_efields_in_pool(tmpdir, numerical_config):
+    # Check that the E-fields that pool workers write into shared memory are the ones calculated in this process.
+
+    numerical_config(threads_per_process='1')
+    efields = {}
+    for num_processes in ['1', '2']:
+        numerical_config(num_processes=num_processes)
+        matrix = _SyntheticDesign('seg_mirror', 1, design='small', calc_wfs=True, initial_path=str(tmpdir),
+                                  saveefields=False, saveopds=False)
+        matrix.calculate_ref_efield()
+        matrix.calculate_ref_efield_wfs()
+        matrix.setup_deformable_mirror()
+        matrix.setup_single_mode_function()
+        matrix.calculate_efields()
+        efields[num_processes] = (matrix.efields_per_mode, matrix.efields_per_mode_wfs)
+
+    for here, in_pool, plane in zip(efields['1'], efields['2'], ['science', 'WFS']):
+        assert in_pool.shape == here.shape == (7,) + here.shape[1:], f'Wrong shape of the {plane} plane E-fields.'
+        assert np.allclose(in_pool, here, rtol=1e-10, atol=1e-12 * np.abs(here).max()), \
+            f'{plane} plane E-fields from the pool are wrong.'
@@ -0,0 +1,31 @@
+import hcipy
+import numpy as np
+
+from pastis.matrix_generation import pair_symmetry
+
+
+def test_hexagonal_pair_classes():
+    # Check that all twelve symmetries of a one-ring hexagonal aperture are found and reduce its pairs to six classes.
+
+    seg_pos = hcipy.make_hexagonal_grid(1., 1)
+    pupil_grid = hcipy.make_pupil_grid(128, 4.)
+    fields = {'lyot_stop': hcipy.circular_aperture(2.5)(pupil_grid)}
+
+    permutations = pair_symmetry.find_aperture_symmetries(seg_pos.x, seg_pos.y, fields, tolerance=0.05)
+    assert len(permutations) == 12, 'Not all symmetries of the hexagonal aperture were found.'
+
+    representatives = pair_symmetry.segment_pair_classes(permutations, seg_pos.size)
+    # Center segment, outer segment, center-outer pair, and outer-outer pairs at three distances
+    assert len(np.unique(representatives)) == 6, 'Wrong number of pair classes.'
+    assert np.all(representatives <= np.arange(representatives.size)), 'Representative is not the first pair of its class.'
+
+
+def test_broken_symmetry():
+    # Check that an off-center Lyot stop only leaves the symmetries that keep it in place.
+
+    seg_pos = hcipy.make_hexagonal_grid(1., 1)
+    pupil_grid = hcipy.make_pupil_grid(128, 4.)
+    fields = {'lyot_stop': hcipy.circular_aperture(2.5, center=[0.3, 0])(pupil_grid)}
+
+    permutations = pair_symmetry.find_aperture_symmetries(seg_pos.x, seg_pos.y, fields, tolerance=0.05)
+    assert len(permutations) == 2, 'Only the identity and the reflection about the x-axis should be found.'
@@ -1,9 +1,16 @@
+import functools
+import multiprocessing
 import os
+from types import SimpleNamespace
 from astropy.io import fits
 import astropy.units as u
+import hcipy
 import numpy as np
+import pytest
 
 import pastis.matrix_generation.matrix_building_numerical as matrix_calc
+from pastis.matrix_generation import pair_symmetry
+from pastis.tests.synthetic_telescopes import make_segmented_aplc
 from pastis import util
 
 
@@ -60,6 +67,38 @@ def test_semi_analytic_matrix_from_contrast_matrix():
     assert np.allclose(pastis_matrix_drift, LUVOIR_INTENSITY_MATRIX_SMALL, rtol=1e-8, atol=1e-24), 'Calculated LUVOIR small PASTIS matrix is wrong.'
 
 
+def _semi_analytic_pastis_loop(contrast_matrix, coro_floor):
+    """ Pair-by-pair calculation of the half PASTIS matrix, as it was done before it was vectorized. """
+    matrix_pastis_half = np.zeros_like(contrast_matrix)
+    drifting = isinstance(coro_floor, np.ndarray)
+    np.fill_diagonal(matrix_pastis_half, np.diag(contrast_matrix) - (np.diag(coro_floor) if drifting else coro_floor))
+    for pair in util.segment_pairs_non_repeating(contrast_matrix.shape[0]):
+        if pair[0] != pair[1]:
+            if drifting:
+                matrix_pastis_half[pair[0], pair[1]] = (contrast_matrix[pair[0], pair[1]] - coro_floor[pair[0], pair[1]] - matrix_pastis_half[pair[0], pair[0]] - matrix_pastis_half[pair[1], pair[1]]) / 2.
+            else:
+                matrix_pastis_half[pair[0], pair[1]] = (contrast_matrix[pair[0], pair[1]] + coro_floor - contrast_matrix[pair[0], pair[0]] - contrast_matrix[pair[1], pair[1]]) / 2.
+    return matrix_pastis_half
+
+
+def test_semi_analytic_matrix_against_loop():
+    """ Test that the vectorized half PASTIS matrix is the one of the pair-by-pair calculation, for a constant and for a
+    drifting coronagraph floor. """
+
+    rng = np.random.default_rng(5)
+    nseg = 9
+    seglist = np.arange(nseg) + 1
+    contrast_matrix = rng.uniform(1e-11, 1e-9, (nseg, nseg))
+    contrast_matrix = (contrast_matrix + contrast_matrix.T) / 2
+    coro_floor = 4.2e-11
+    coro_floor_matrix = np.triu(rng.uniform(3e-11, 5e-11, (nseg, nseg)))
+
+    for floor in [coro_floor, coro_floor_matrix]:
+        matrix_half = matrix_calc.calculate_semi_analytic_pastis_from_contrast(contrast_matrix, seglist, floor)
+        assert np.array_equal(matrix_half, _semi_analytic_pastis_loop(contrast_matrix, floor)), \
+            f'Half PASTIS matrix differs from the pair-by-pair calculation for a {type(floor).__name__} floor'
+
+
 def test_pastis_forward_model():
     """ Test that the PASTIS matrix propagates aberrations correctly
     This is essentially a test for the hockey stick curve, inside its valid range. """
@@ -103,3 +142,274 @@ def test_luvoir_intensity_matrix_regression():
     # Check that new matrix is equal to previously computed matrix that is known to be correct, down to numerical noise
     # on the order of 1e-23
     assert np.allclose(new_matrix, LUVOIR_INTENSITY_MATRIX_SMALL, rtol=1e-8, atol=1e-24), 'Calculated LUVOIR small PASTIS matrix is wrong.'
+
+
+def test_contrast_journal_roundtrip(tmpdir):
+    """ Test that pair contrasts written to the journal are read back exactly, and that a truncated last line is skipped. """
+
+    journal_path = os.path.join(tmpdir, 'contrast_journal.txt')
+    contrasts = {(0, 0): 4.2376360700565846e-11, (0, 5): 1.3e-10, (7, 119): 2.0000000000000003e-09}
+    with open(journal_path, 'w') as journal:
+        for pair, contrast in contrasts.items():
+            journal.write(f'{pair[0]} {pair[1]} {contrast!r}\n')
+        journal.write('8 9')    # incomplete entry of an interrupted run
+
+    read_contrasts = matrix_calc.read_contrast_journal(journal_path)
+    assert read_contrasts == contrasts, 'Contrasts read from journal do not match the ones that were written'
+    assert matrix_calc.read_contrast_journal(os.path.join(tmpdir, 'no_journal.txt')) == {}, 'Missing journal should read as empty'
+
+
+def test_process_split_from_configfile(numerical_config):
+    """ Test that a process and thread number given in the configfile is used and completed to all CPU cores. """
+
+    num_cpu = multiprocessing.cpu_count()
+    numerical_config(num_processes='1', threads_per_process='auto')
+    assert matrix_calc.get_process_split(None, [], 'LUVOIR') == (1, num_cpu), 'Threads not completed to all cores'
+
+    numerical_config(num_processes='3', threads_per_process='2')
+    assert matrix_calc.get_process_split(None, [], 'LUVOIR') == (3, 2), 'Configfile values not used'
+
+
+def test_separation_cutoff_error_estimate():
+    """ Test that the error estimate of a separation cutoff recovers the skipped PASTIS matrix elements. """
+
+    nseg = 6
+    coro_floor = 1e-11
+    wfe_aber = 1e-9    # 1 nm, so that the PASTIS matrix is in the same units as the contrasts
+    rng = np.random.default_rng(1)
+    matrix = rng.uniform(1e-12, 1e-11, (nseg, nseg))
+    matrix = (matrix + matrix.T) / 2
+
+    # Contrast matrix that produces this PASTIS matrix
+    contrast_matrix = np.zeros_like(matrix)
+    for seg_i, seg_j in util.segment_pairs_non_repeating(nseg):
+        if seg_i == seg_j:
+            contrast_matrix[seg_i, seg_j] = matrix[seg_i, seg_i] + coro_floor
+        else:
+            contrast_matrix[seg_i, seg_j] = matrix[seg_i, seg_i] + matrix[seg_j, seg_j] + 2 * matrix[seg_i, seg_j] + coro_floor
+
+    computed_pairs = [(seg, seg) for seg in range(nseg)] + [(0, 1), (1, 2)]
+    sampled_pairs = [(0, 5), (2, 4), (3, 5)]
+    error = matrix_calc.estimate_separation_cutoff_error(contrast_matrix, computed_pairs, sampled_pairs, 10, coro_floor,
+                                                         wfe_aber)
+
+    sampled_elements = np.array([matrix[pair] for pair in sampled_pairs])
+    assert error['num_samples'] == 3, 'Wrong number of sampled pairs'
+    assert np.isclose(error['max_abs_skipped_element'], sampled_elements.max(), rtol=1e-8), 'Wrong largest skipped element'
+    assert np.isclose(error['skipped_frobenius_norm_estimate'], np.sqrt(20 * np.mean(sampled_elements ** 2)),
+                      rtol=1e-8), 'Wrong extrapolated norm of the skipped matrix elements'
+
+
+class _SyntheticPairMatrix(matrix_calc.PastisMatrixIntensities):
+    """ Intensity matrix whose pair contrasts follow from a known PASTIS matrix, calculated without a simulator. """
+    instrument = 'LUVOIR'
+
+    def __init__(self, true_matrix, contrast_floor, **kwargs):
+        super().__init__(nb_seg=true_matrix.shape[0], seglist=np.arange(true_matrix.shape[0]), savepsfs=False,
+                         saveopds=False, **kwargs)
+        self.true_matrix = true_matrix
+        self.floor = contrast_floor
+        self.wfe_aber = 1e-9    # 1 nm, so that the PASTIS matrix is in the same units as the contrasts
+
+    def calculate_ref_image(self, save_coro_floor=True, save_psfs=True):
+        self.contrast_floor = self.floor
+        self.norm = 1.
+        if save_coro_floor:
+            with open(os.path.join(self.overall_dir, 'coronagraph_floor.txt'), 'w') as file:
+                file.write(f'Coronagraph floor: {self.floor}')
+
+    def setup_one_pair_function(self):
+        self.calculate_matrix_pair = self.pair_contrast
+
+    def pair_contrast(self, pair):
+        seg_i, seg_j = pair
+        contrast = self.true_matrix[seg_i, seg_i] + self.floor
+        if seg_i != seg_j:
+            contrast += self.true_matrix[seg_j, seg_j] + 2 * self.true_matrix[seg_i, seg_j]
+        return contrast, pair
+
+    def _calculate_pairs_in_pool(self, pairs):
+        return [self.pair_contrast(pair) for pair in pairs]
+
+
+# One-ring hexagonal aperture and Lyot stop, which have all twelve symmetries of a hexagon
+HEX_SEG_POS = hcipy.make_hexagonal_grid(1., 1)
+HEX_LYOT_STOP = hcipy.circular_aperture(2.5)(hcipy.make_pupil_grid(128, 4.))
+
+
+class _SyntheticHexPairMatrix(_SyntheticPairMatrix):
+    """ Synthetic intensity matrix on the one-ring hexagonal aperture. """
+
+    def segment_positions(self):
+        return HEX_SEG_POS.x, HEX_SEG_POS.y
+
+    def symmetry_fields(self):
+        return {'lyot_stop': HEX_LYOT_STOP}
+
+
+def test_symmetry_verification(tmpdir):
+    # Check that contrasts that follow the aperture symmetries pass the verification, and that others fail it.
+
+    permutations = pair_symmetry.find_aperture_symmetries(HEX_SEG_POS.x, HEX_SEG_POS.y, {'lyot_stop': HEX_LYOT_STOP},
+                                                          tolerance=0.05)
+    representatives = pair_symmetry.segment_pair_classes(permutations, 7)
+
+    # A PASTIS matrix with one value per pair class, and one with independent values
+    rng = np.random.default_rng(3)
+    class_values = rng.uniform(0.5, 1, representatives.size)
+    symmetric_matrix = np.zeros((7, 7))
+    for pair in util.segment_pairs_non_repeating(7):
+        symmetric_matrix[pair] = class_values[representatives[util.pair_index(pair, 7)]]
+    symmetric_matrix = util.symmetrize(symmetric_matrix)
+    root = rng.uniform(0.1, 1, (7, 7))
+    non_symmetric_matrix = root @ root.T
+
+    for true_matrix, verified in [(symmetric_matrix, True), (non_symmetric_matrix, False)]:
+        matrix = _SyntheticHexPairMatrix(true_matrix, 0.1, initial_path=str(tmpdir.mkdir(str(verified))))
+        matrix.calculate_ref_image()
+        matrix.setup_one_pair_function()
+        matrix.calculate_contrast_matrix_with_symmetry(num_verification_samples=10, verification_rtol=1e-6)
+        assert matrix.symmetry_verified is verified, f'Symmetry verification should give {verified}'
+
+
+def test_fresh_runs_do_not_share_journal(tmpdir):
+    # Check that runs started in the same second get their own folders, and that only a resumed run reads the journal.
+
+    rng = np.random.default_rng(6)
+    root = rng.uniform(0.1, 1, (5, 5))
+    first_matrix = root @ root.T
+    second_matrix = 2 * first_matrix
+    first = _SyntheticPairMatrix(first_matrix, 0.1, initial_path=str(tmpdir))
+    second = _SyntheticPairMatrix(second_matrix, 0.1, initial_path=str(tmpdir))
+    assert first.overall_dir != second.overall_dir, 'Two new runs share a result folder'
+
+    first.calc()
+    second.calc()
+    assert np.allclose(second.matrix_pastis, second_matrix), 'The second run used contrasts of the first one'
+
+    # A resumed run takes the contrasts from the journal of its folder
+    resumed = _SyntheticPairMatrix(first_matrix, 0.1, resume_dir=second.overall_dir)
+    resumed.calc()
+    assert np.allclose(resumed.matrix_pastis, second_matrix), 'A resumed run did not read its journal'
+
+
+def test_update_segments(tmpdir):
+    """ Test that an incremental update of one segment reproduces the full matrix of the changed model. """
+
+    rng = np.random.default_rng(2)
+    root = rng.uniform(0.1, 1, (6, 6))
+    original_matrix = root @ root.T
+    original = _SyntheticPairMatrix(original_matrix, 0.1, initial_path=str(tmpdir))
+    original.calc()
+
+    changed_matrix = original_matrix.copy()
+    changed_matrix[2] *= 1.3
+    changed_matrix[:, 2] *= 1.3
+    update = _SyntheticPairMatrix(changed_matrix, 0.12, resume_dir=original.overall_dir)
+    update.update_segments([2])
+
+    assert np.allclose(fits.getdata(os.path.join(update.resDir, 'pastis_matrix_v2.fits')), changed_matrix), 'Updated matrix is wrong'
+    assert np.allclose(fits.getdata(os.path.join(update.resDir, 'pastis_matrix.fits')), original_matrix), 'Original matrix was modified'
+    assert update.next_matrix_version() == 3, 'Next update does not get a new version'
+
+
+def _synthetic_luvoir_pair_function(monkeypatch, resDir):
+    """ Let the LUVOIR pair-wise function run on a small synthetic telescope, in this process and in workers forked
+    from it, and return it as the partial function of a matrix calculation. """
+    monkeypatch.setattr(matrix_calc, 'create_pair_simulator',
+                        lambda instrument, design=None: make_segmented_aplc(apodizer_width=0.4))
+    monkeypatch.setattr(matrix_calc, '_SIMULATOR_CACHE', {})
+    _coro, direct = matrix_calc.get_cached_simulator('LUVOIR', 'synthetic').calc_psf(ref=True)
+    return functools.partial(matrix_calc._luvoir_matrix_one_pair, 'synthetic', float(direct.max()), 50e-9, resDir,
+                             False, False)
+
+
+def test_pairs_in_pool(tmpdir, monkeypatch, numerical_config):
+    """ Test that the pool calculates every pair like this process does, and that its workers are stopped when the
+    results are not read to the end. """
+
+    calculate_matrix_pair = _synthetic_luvoir_pair_function(monkeypatch, str(tmpdir))
+    pairs = list(util.segment_pairs_non_repeating(7))
+    expected = dict((pair, contrast) for contrast, pair in map(calculate_matrix_pair, pairs))
+
+    matrix = SimpleNamespace(calculate_matrix_pair=calculate_matrix_pair, nb_seg=7, instrument='LUVOIR',
+                             design='synthetic', resDir=str(tmpdir))
+    # Forked workers get the synthetic telescope of this process
+    numerical_config(num_processes='2', threads_per_process='1', start_method='fork')
+    results = dict((pair, contrast) for contrast, pair in
+                   matrix_calc.PastisMatrixIntensities._calculate_pairs_in_pool(matrix, pairs))
+    assert results.keys() == expected.keys(), 'The pool did not return every pair once'
+    for pair, contrast in results.items():
+        assert np.isclose(contrast, expected[pair], rtol=1e-10, atol=0), f'Contrast of pair {pair} is wrong'
+    assert not multiprocessing.active_children(), 'Workers of a finished pool are still running'
+
+    results = matrix_calc.PastisMatrixIntensities._calculate_pairs_in_pool(matrix, pairs * 4)
+    next(results)
+    results.close()
+    assert not multiprocessing.active_children(), 'Workers are still running after the results were abandoned'
+
+
+def test_cached_simulator_contrasts(tmpdir, monkeypatch, numerical_config):
+    """ Test that workers that reuse one simulator for all their pairs get the contrasts of a new simulator per pair. """
+
+    calculate_matrix_pair = _synthetic_luvoir_pair_function(monkeypatch, str(tmpdir))
+    pairs = list(util.segment_pairs_non_repeating(7))
+    np.random.default_rng(4).shuffle(pairs)
+
+    fresh_contrasts = {}
+    for pair in pairs:
+        matrix_calc._SIMULATOR_CACHE.clear()
+        contrast, _pair = calculate_matrix_pair(pair)
+        fresh_contrasts[pair] = contrast
+
+    matrix_calc._SIMULATOR_CACHE.clear()
+    numerical_config(start_method='fork')
+    pool = matrix_calc.create_pair_pool(2, 1, 'LUVOIR', 'synthetic')
+    try:
+        results = pool.map(calculate_matrix_pair, pairs, chunksize=4)
+    finally:
+        pool.close()
+        pool.join()
+
+    for contrast, pair in results:
+        assert np.isclose(contrast, fresh_contrasts[pair], rtol=1e-12, atol=0), \
+            f'Contrast of pair {pair} with a reused simulator is wrong'
+
+
+def test_process_split_tuned_once(tmpdir, monkeypatch, numerical_config):
+    """ Test that the tuned process split is kept in the result folder, together with the results of the trial pairs. """
+
+    calculate_matrix_pair = _synthetic_luvoir_pair_function(monkeypatch, str(tmpdir))
+    trial_pairs = [(0, 0), (1, 1), (2, 2)]
+    numerical_config(num_processes='auto', threads_per_process='auto', start_method='fork')
+    trial_results = {}
+    split = matrix_calc.get_process_split(calculate_matrix_pair, trial_pairs, 'LUVOIR', 'synthetic',
+                                          cache_dir=str(tmpdir), trial_results=trial_results)
+    assert trial_results, 'Results of the trial pairs were not kept'
+    for pair, result in trial_results.items():
+        assert result == calculate_matrix_pair(pair), f'Wrong result of trial pair {pair}'
+
+    # A second calculation in the same folder reads the split instead of calculating any pair
+    trial_results = {}
+    assert matrix_calc.get_process_split(None, trial_pairs, 'LUVOIR', 'synthetic', cache_dir=str(tmpdir),
+                                         trial_results=trial_results) == split, 'Tuned split was not reused'
+    assert trial_results == {}, 'The split was tuned again'
+
+
+def test_failed_trial_terminates_pool(monkeypatch):
+    """ Test that the pool of a process split trial gets terminated when one of its pairs fails. """
+
+    class _FailingPool:
+        terminated = False
+
+        def map(self, *args, **kwargs):
+            raise RuntimeError('Pair failed')
+
+        def terminate(self):
+            self.terminated = True
+
+    pool = _FailingPool()
+    monkeypatch.setattr(matrix_calc, 'create_pair_pool', lambda *args, **kwargs: pool)
+    with pytest.raises(RuntimeError):
+        matrix_calc.tune_process_split(None, [(0, 0)], 'LUVOIR', 'synthetic')
+    assert pool.terminated, 'Trial pool was not terminated'
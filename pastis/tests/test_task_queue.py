@@ -0,0 +1,91 @@
+import os
+import time
+import pytest
+
+from pastis.matrix_generation.task_queue import FileTaskQueue, run_queue_worker, wait_for_queue
+
+
+def _fail_on_negative(task):
+    """ Task function that raises an error for negative tasks. """
+    if task < 0:
+        raise ValueError(f'Negative task {task}')
+    return 2 * task
+
+
+def test_queue_worker_calculates_all_tasks(tmpdir):
+    """ Test that a worker calculates every task once and results come back in task order. """
+
+    queue_dir = os.path.join(tmpdir, 'task_queue')
+    queue = FileTaskQueue(queue_dir)
+    tasks = [-3, 5, -1, 0]
+    queue.submit(abs, tasks)
+    assert not queue.is_done(), 'Queue should not be done before any worker ran'
+
+    num_done = run_queue_worker(queue_dir, poll_interval=0.01)
+    assert num_done == len(tasks), 'Worker did not calculate all tasks'
+    assert queue.is_done(), 'Queue is not done after worker finished'
+    assert queue.results() == [3, 5, 1, 0], 'Results are not in task order'
+
+    # Submitting the same job again must not replace the existing job and its results
+    queue.submit(abs, tasks)
+    assert queue.results() == [3, 5, 1, 0], 'Resubmission overwrote an existing job'
+
+    # A different job must not reuse the results of the existing one
+    with pytest.raises(ValueError):
+        queue.submit(abs, [10, 20, 30, 40])
+    with pytest.raises(ValueError):
+        queue.submit(abs, [10, 20])
+    with pytest.raises(ValueError):
+        queue.submit(abs, tasks, initializer=print, initargs=('other settings',))
+
+
+def test_queue_lease_expiry(tmpdir):
+    """ Test that a leased task is skipped while its lease is alive, and taken over once it expired. """
+
+    queue = FileTaskQueue(os.path.join(tmpdir, 'task_queue'), lease_timeout=60)
+    queue.submit(abs, [1, 2])
+
+    assert queue.claim() == 0, 'First free task should be claimed first'
+    assert queue.claim() == 1, 'Leased task was claimed a second time'
+    assert queue.claim() is None, 'No task should be available while all leases are alive'
+
+    # Age the lease of task 0, as if its worker had died an hour ago
+    old_time = time.time() - 3600
+    os.utime(os.path.join(queue.lease_dir, '0.lease'), (old_time, old_time))
+    assert queue.claim() == 0, 'Abandoned task was not taken over'
+
+    queue.complete(0, 1)
+    queue.complete(1, 2)
+    assert queue.is_done(), 'Queue is not done after all tasks were completed'
+    remaining_leases = [fname for fname in os.listdir(queue.lease_dir) if fname.endswith('.lease')]
+    assert remaining_leases == [], 'Leases of completed tasks were not removed'
+
+
+def test_queue_failing_task(tmpdir):
+    """ Test that a task that raises is attempted max_attempts times, while the worker goes on with the other tasks, and
+    that the coordinator then raises instead of waiting forever. """
+
+    queue_dir = os.path.join(tmpdir, 'task_queue')
+    queue = FileTaskQueue(queue_dir, max_attempts=2)
+    queue.submit(_fail_on_negative, [1, -2, 3])
+
+    num_done = run_queue_worker(queue_dir, poll_interval=0.01)
+    assert num_done == 2, 'Worker did not calculate the tasks that do not fail'
+    assert queue.finished_ids() == {0, 2}, 'Wrong tasks have results'
+    assert queue.failed_ids() == {1}, 'Failing task is not recorded as failed for good'
+    failure = queue.load_failure(1)
+    assert failure['attempts'] == 2, 'Failing task was not attempted max_attempts times'
+    assert 'Negative task -2' in failure['traceback'], 'Traceback of the failing task was not recorded'
+    assert queue.claim() is None, 'Task that failed for good was claimed again'
+
+    with pytest.raises(RuntimeError, match='Negative task -2'):
+        wait_for_queue(queue, poll_interval=0.01)
+
+
+def test_wait_for_queue_timeout(tmpdir):
+    """ Test that waiting for a queue without workers gives up after the timeout. """
+
+    queue = FileTaskQueue(os.path.join(tmpdir, 'task_queue'))
+    queue.submit(abs, [1, 2])
+    with pytest.raises(TimeoutError):
+        wait_for_queue(queue, poll_interval=0.01, timeout=0.05)
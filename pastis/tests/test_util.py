@@ -1,5 +1,7 @@
+import multiprocessing
 import astropy.units as u
 import numpy as np
+import pytest
 from pastis import util
 
 
@@ -74,3 +76,82 @@ def test_create_random_rms_values():
     resulting_rms = util.rms(random_array)
     assert resulting_rms.unit == target_rms.unit, 'The resulting total rms has wrong units.'
     assert np.isclose(resulting_rms, target_rms, 1e-13), 'Calculated total rms does not agree with target rms value.'
+
+
+def test_pair_index():
+    # Check that the pair index follows the order of the non-repeating segment pairs, and that it can be inverted.
+
+    nseg = 17
+    indices = [util.pair_index(pair, nseg) for pair in util.segment_pairs_non_repeating(nseg)]
+    assert indices == list(range(util.pastis_matrix_measurements(nseg))), 'Pair indices are not in pair order.'
+    assert util.nseg_from_measurements(util.pastis_matrix_measurements(nseg)) == nseg, 'Number of segments not recovered.'
+
+
+def test_segment_pairs_within_separation():
+    # Check that pairs are split by the distance of their segment centers, and that no pair is lost.
+
+    seg_pos_x = np.array([0., 1., 2., 0.])
+    seg_pos_y = np.array([0., 0., 0., 3.])
+    within, beyond = util.segment_pairs_within_separation(seg_pos_x, seg_pos_y, 1.5)
+
+    assert within == [(0, 0), (0, 1), (1, 1), (1, 2), (2, 2), (3, 3)], 'Wrong pairs within the separation cutoff.'
+    assert beyond == [(0, 2), (0, 3), (1, 3), (2, 3)], 'Wrong pairs beyond the separation cutoff.'
+
+
+def test_frame_cube(tmpdir):
+    # Check that frames written into a cube end up at the right place and can be read back with the index table.
+
+    nseg = 4
+    pairs = list(util.segment_pairs_non_repeating(nseg))
+    cube_path = str(tmpdir.join('psf_cube.npy'))
+    util.create_frame_cube(cube_path, pairs, (5, 6))
+
+    frame = np.arange(30).reshape(5, 6)
+    util.write_cube_frame(cube_path, util.pair_index((1, 3), nseg), frame)
+
+    cube, index = util.read_frame_cube(cube_path)
+    assert cube.shape == (len(pairs), 5, 6), 'Cube has wrong shape.'
+    assert np.all(cube[util.pair_index((1, 3), nseg)] == frame), 'Frame was not written to its pair position.'
+    assert np.all(index[util.pair_index((1, 3), nseg)] == [util.pair_index((1, 3), nseg), 1, 3]), 'Index table is wrong.'
+    assert np.count_nonzero(cube) == np.count_nonzero(frame), 'Other frames were modified.'
+
+
+def _write_into_shared_array(name, index):
+    util.attach_shared_array(name)[index] = index + 1
+
+
+def test_shared_array(tmpdir):
+    # Check that worker processes can write into a shared array by index, and that the parent sees what they wrote.
+
+    name = util.shared_array_name(str(tmpdir.join('psf_cube.npy')))
+    array = util.create_shared_array(name, (6, 3, 2), dtype=np.float32)
+    try:
+        with multiprocessing.Pool(2) as pool:
+            pool.starmap(_write_into_shared_array, [(name, index) for index in range(6)])
+        assert util.attach_shared_array(name) is array, 'Parent process did not reuse its own block.'
+        assert array.dtype == np.float32, 'Shared array has wrong dtype.'
+        assert np.all(array == np.arange(1, 7)[:, np.newaxis, np.newaxis]), 'Workers did not write into the shared array.'
+    finally:
+        del array
+        util.release_shared_array(name)
+
+
+def test_detach_shared_array(tmpdir):
+    # Check that a detached shared array keeps its values, and that no other process can attach to it anymore.
+
+    name = util.shared_array_name(str(tmpdir.join('efields')))
+    util.create_shared_array(name, (3, 4), dtype=np.complex128)[1] = 1j
+    array = util.detach_shared_array(name)
+    assert np.all(array[1] == 1j) and np.all(array[[0, 2]] == 0), 'Detached array lost its values.'
+    with pytest.raises(FileNotFoundError):
+        util.attach_shared_array(name)
+
+
+def test_multiprocessing_context():
+    # Check that pools can be created with the start method from the configfile.
+
+    context = util.get_multiprocessing_context(['numpy'])
+    assert context.get_start_method() in multiprocessing.get_all_start_methods(), 'Unknown start method.'
+    with context.Pool(2) as pool:
+        assert pool.map(abs, [-1, -2, 3]) == [1, 2, 3], 'Pool did not work.'
+
@@ -3,6 +3,7 @@ Helper functions for PASTIS.
 """
 
 import glob
+import hashlib
 import os
 import datetime
 import importlib
@@ -10,11 +11,14 @@ import itertools
 import time
 from shutil import copy
 import sys
+import weakref
 from astropy.io import fits
 import astropy.units as u
 import fpdf
 import logging
 import logging.handlers
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 from PyPDF2 import PdfFileMerger
 
@@ -280,6 +284,238 @@ def pastis_matrix_measurements(nseg):
     return int(total_number)
 
 
+def pair_index(segment_pair, nseg):
+    """
+    Return the position of a segment pair in the order of segment_pairs_non_repeating().
+
+    E.g. if segments are 0, 1, 2, then the pairs 00, 01, 02, 11, 12, 22 have the indices 0, 1, 2, 3, 4, 5.
+    :param segment_pair: tuple of two segment indices, 0-indexed, with segment_pair[0] <= segment_pair[1]
+    :param nseg: int, number of segments
+    :return: int, pair index
+    """
+    i, j = int(segment_pair[0]), int(segment_pair[1])
+    return i * nseg - i * (i - 1) // 2 + j - i
+
+
+def nseg_from_measurements(num_measurements):
+    """
+    Inverse of pastis_matrix_measurements(): number of segments from the number of non-repeating segment pairs.
+    :param num_measurements: int, number of non-repeating segment pairs
+    :return: int, number of segments
+    """
+    return int(round((np.sqrt(8 * num_measurements + 1) - 1) / 2))
+
+
+def segment_pairs_within_separation(seg_pos_x, seg_pos_y, separation_cutoff):
+    """
+    Split the non-repeating segment pairs into those whose segment centers are closer than a cutoff, and the others.
+
+    Pairs of a segment with itself always have zero separation and are therefore always in the first list.
+    :param seg_pos_x: array, x-coordinates of the segment centers, in order of the segment indices
+    :param seg_pos_y: array, y-coordinates of the segment centers, in order of the segment indices
+    :param separation_cutoff: float, largest center-to-center separation of a pair to keep, same units as the positions
+    :return: two lists of segment pair tuples, (pairs within the cutoff, pairs beyond it), both in the order of
+             segment_pairs_non_repeating()
+    """
+    seg_pos_x = np.asarray(seg_pos_x)
+    seg_pos_y = np.asarray(seg_pos_y)
+    separations = np.hypot(seg_pos_x[:, np.newaxis] - seg_pos_x, seg_pos_y[:, np.newaxis] - seg_pos_y)
+
+    within, beyond = [], []
+    for pair in segment_pairs_non_repeating(seg_pos_x.size):
+        if separations[pair[0], pair[1]] <= separation_cutoff:
+            within.append(pair)
+        else:
+            beyond.append(pair)
+    return within, beyond
+
+
+# Frame cubes opened for writing in the current process, keyed by path
+_OPEN_FRAME_CUBES = {}
+
+
+def create_frame_cube(path, labels, frame_shape, dtype=np.float64):
+    """
+    Preallocate a cube of 2D frames on disk, to be filled frame by frame by one or many processes.
+
+    The cube is a .npy file that can be memory-mapped, so that single frames can be written and read without loading
+    the whole cube. Next to it, an index table "<name>_index.txt" lists the frame number and the label of each frame,
+    e.g. the segment pair or the mode number the frame belongs to.
+    :param path: string, path of the .npy cube file
+    :param labels: list of tuples or ints, label of each frame, in frame order
+    :param frame_shape: tuple, shape of a single frame
+    :param dtype: numpy dtype of the cube
+    :return: the cube as writable numpy memmap
+    """
+    _OPEN_FRAME_CUBES.pop(path, None)
+    cube = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(labels),) + tuple(frame_shape))
+
+    with open(cube_index_path(path), 'w') as index_file:
+        index_file.write('# frame label\n')
+        for frame_number, label in enumerate(labels):
+            label = ' '.join(str(int(entry)) for entry in np.atleast_1d(label))
+            index_file.write(f'{frame_number} {label}\n')
+
+    return cube
+
+
+def cube_index_path(path):
+    """ Return the path of the index table that belongs to the frame cube in "path". """
+    return os.path.splitext(path)[0] + '_index.txt'
+
+
+def open_cube_for_writing(path):
+    """
+    Open a cube created by create_frame_cube() as writable memory map.
+
+    The cube stays open in the current process for all subsequent calls, so this is cheap to call from the workers of
+    a multiprocessing pool for every frame they write.
+    :param path: string, path of the .npy cube file
+    :return: the cube as writable numpy memmap
+    """
+    if path not in _OPEN_FRAME_CUBES:
+        _OPEN_FRAME_CUBES[path] = np.load(path, mmap_mode='r+')
+    return _OPEN_FRAME_CUBES[path]
+
+
+def write_cube_frame(path, frame_number, frame):
+    """
+    Write a single frame into a cube created by create_frame_cube(), and flush it to disk.
+    :param path: string, path of the .npy cube file
+    :param frame_number: int, index of the frame in the cube
+    :param frame: array, frame of the same shape as the frames in the cube
+    """
+    cube = open_cube_for_writing(path)
+    cube[frame_number] = frame
+    cube.flush()
+
+
+def read_frame_cube(path):
+    """
+    Open a cube created by create_frame_cube() as read-only memory map, together with its index table.
+    :param path: string, path of the .npy cube file
+    :return: the cube as numpy memmap (frames are only read from disk when they are sliced), and the index table as
+             int array with the frame number in the first column and the frame labels in the remaining columns
+    """
+    cube = np.load(path, mmap_mode='r')
+    index = np.loadtxt(cube_index_path(path), dtype=int, ndmin=2)
+    return cube, index
+
+
+def get_multiprocessing_context(preload_modules=()):
+    """
+    Return the multiprocessing context to create worker pools with, for the start method set in the configfile.
+
+    With 'forkserver', a server process imports pastis and the "preload_modules" once, and every worker is forked from
+    it, so that workers do not import hcipy, astropy etc. again. 'spawn' starts each worker as a fresh interpreter that
+    imports everything itself, 'fork' copies the current process. Start methods that are not available on this platform
+    fall back to 'spawn'. The global start method of multiprocessing is left untouched.
+    The preloaded modules are fixed once the forkserver of this process is running, which happens with its first pool.
+    :param preload_modules: list of str, names of additional modules to import in the forkserver
+    :return: multiprocessing context
+    """
+    start_method = CONFIG_PASTIS.get('numerical', 'start_method', fallback='forkserver')
+    if start_method not in multiprocessing.get_all_start_methods():
+        log.warning(f'Start method "{start_method}" is not available on this platform, using "spawn" instead.')
+        start_method = 'spawn'
+
+    context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        context.set_forkserver_preload(['pastis.util'] + list(preload_modules))
+    return context
+
+
+# Bytes in front of each shared array that hold its number of dimensions, shape and dtype, see create_shared_array()
+_SHARED_ARRAY_HEADER_BYTES = 64
+_ATTACHED_SHARED_ARRAYS = {}
+
+
+def shared_array_name(path):
+    """ Return the name of the shared memory block that belongs to a file path; it is the same in every process. """
+    return 'pastis_' + hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:20]
+
+
+def create_shared_array(name, shape, dtype=np.float64):
+    """
+    Allocate a zero-filled array in a named shared memory block, for the processes of a multiprocessing pool to write
+    their results into directly, without pickling them back to the parent process.
+
+    The shape and dtype are stored in front of the array, so that the workers only need the name of the block to attach
+    to it with attach_shared_array(). The block lives until it is released with release_shared_array().
+    :param name: string, name of the shared memory block, e.g. from shared_array_name()
+    :param shape: tuple, shape of the array, with at most 6 dimensions
+    :param dtype: numpy dtype of the array
+    :return: the array, backed by the shared memory block
+    """
+    dtype = np.dtype(dtype)
+    size = _SHARED_ARRAY_HEADER_BYTES + int(np.prod(shape)) * dtype.itemsize
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        # Left over from a run that got killed before it could release the block
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    header = np.ndarray(_SHARED_ARRAY_HEADER_BYTES // 8, dtype=np.int64, buffer=shm.buf)
+    header[:] = 0
+    header[0] = len(shape)
+    header[1:1 + len(shape)] = shape
+    header[-1] = ord(dtype.char)
+
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=_SHARED_ARRAY_HEADER_BYTES)
+    array[:] = 0
+    _ATTACHED_SHARED_ARRAYS[name] = (shm, array)
+    return array
+
+
+def attach_shared_array(name):
+    """
+    Attach to an array created by create_shared_array(), possibly in another process.
+
+    The block stays attached in the current process for all subsequent calls, so this is cheap to call from the workers
+    of a multiprocessing pool for every result they write.
+    :param name: string, name of the shared memory block
+    :return: the array, backed by the shared memory block
+    """
+    if name not in _ATTACHED_SHARED_ARRAYS:
+        shm = shared_memory.SharedMemory(name=name)
+        header = np.ndarray(_SHARED_ARRAY_HEADER_BYTES // 8, dtype=np.int64, buffer=shm.buf)
+        shape = tuple(int(entry) for entry in header[1:1 + header[0]])
+        array = np.ndarray(shape, dtype=np.dtype(chr(header[-1])), buffer=shm.buf, offset=_SHARED_ARRAY_HEADER_BYTES)
+        _ATTACHED_SHARED_ARRAYS[name] = (shm, array)
+    return _ATTACHED_SHARED_ARRAYS[name][1]
+
+
+def detach_shared_array(name):
+    """
+    Keep an array created by create_shared_array() in the current process only, without copying it.
+
+    The name of the shared memory block is removed, so that no other process can attach to it anymore; the memory is
+    freed once the array, and all views of it, are garbage collected.
+    :param name: string, name of the shared memory block
+    :return: the array, backed by the shared memory block
+    """
+    shm, array = _ATTACHED_SHARED_ARRAYS.pop(name)
+    shm.unlink()
+    weakref.finalize(array, shm.close)
+    return array
+
+
+def release_shared_array(name):
+    """
+    Free the shared memory block of an array created by create_shared_array() in the current process.
+
+    All other references to the array in the current process have to be dropped before.
+    :param name: string, name of the shared memory block
+    """
+    shm, array = _ATTACHED_SHARED_ARRAYS.pop(name)
+    del array
+    shm.close()
+    shm.unlink()
+
+
 def symmetrize(array):
     """
     Return a symmetrized version of NumPy array a.
@@ -479,6 +715,30 @@ def create_data_path(initial_path, telescope="", suffix=""):
     return full_path
 
 
+def create_unique_data_path(initial_path, telescope="", suffix=""):
+    """
+    Create a new, empty folder with a timestamped name like create_data_path() does, and return its path.
+
+    Runs that start within the same second would get the same timestamp; a counter is appended to the name of the later
+    ones (ex: 2017-06-15T12-12-12_luvoir_2), so that every run writes into its own folder.
+    :param initial_path: str, output directory as defined in the configfile
+    :param telescope: str, telescope name that gets added to data path name
+    :param suffix: str, appends this to the end of the timestamp
+    :return: path of the created folder
+    """
+    base_path = create_data_path(initial_path, telescope=telescope, suffix=suffix)
+    os.makedirs(initial_path or '.', exist_ok=True)
+    full_path = base_path
+    counter = 1
+    while True:
+        try:
+            os.mkdir(full_path)
+            return full_path
+        except FileExistsError:
+            counter += 1
+            full_path = f'{base_path}_{counter}'
+
+
 def copy_config(outdir):
     """
     Copy the config_local, or if non-existent, config_pastis.ini to outdir